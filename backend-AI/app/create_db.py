@@ -1,6 +1,5 @@
 from models import Base
-from database import engine
+from database import get_sync_engine
 
 # Create tables in the database 
-Base.metadata.create_all(bind=engine)
-
+Base.metadata.create_all(bind=get_sync_engine())
@@ -1,20 +1,462 @@
-from sqlalchemy.orm import Session 
-from models import User
+from datetime import date, timedelta
+
+from sqlalchemy import (
+    select, update, case, func, tuple_, or_, and_, literal_column, text, bindparam, cast, values, column,
+    Date, Float, Integer, Text,
+)
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import User, UserToken, SavedOutput, ContentBlob, ImageJob, SEARCH_CONFIG
+from utils import content_store
+
+# Serializes image job claims across app processes (pg_advisory_xact_lock key)
+IMAGE_JOB_CLAIM_LOCK = 7_301_019
+
+# Inlined as a constant so that, with the query text bound, the planner can
+# fold the tsquery and use the column statistics to choose between the GIN
+# index and the per-user index
+search_config = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
 
 
 # Create user function
-def create_user(db: Session, email: str,username: str, password: str):
+async def create_user(db: AsyncSession, email: str,username: str, password: str):
     db_user = User(email=email, username=username, hashed_password=password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 # Get user
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str):
+    return await db.scalar(select(User).where(User.email == email))
 
 
 # Get user by username
-def get_user_by_username(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    return await db.scalar(select(User).where(User.username == username))
+
+
+# Atomically check and charge the daily token quota
+async def reserve_tokens(db: AsyncSession, user_id: int, tokens: int, limit: int) -> int | None:
+    """
+    Charges `tokens` against the user's daily quota in a single UPSERT.
+
+    The row is created on first use, reset when `last_used` is not today and
+    only updated if the new total stays within `limit`, so concurrent
+    requests can never push a user past the limit.
+
+    Returns the new daily total, or None if the charge was rejected.
+    """
+    if tokens > limit:
+        return None
+    today = func.current_date()
+    used_today = case(
+        (UserToken.last_used == today, func.coalesce(UserToken.tokens_used, 0)),
+        else_=0,
+    )
+    stmt = insert(UserToken).values(user_id=user_id, tokens_used=tokens, last_used=today, data_version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserToken.user_id],
+        set_={
+            "tokens_used": used_today + stmt.excluded.tokens_used,
+            "last_used": today,
+            "data_version": UserToken.data_version + 1,
+        },
+        where=used_today + stmt.excluded.tokens_used <= limit,
+    ).returning(UserToken.tokens_used)
+    total = await db.scalar(stmt)
+    await db.commit()
+    return total
+
+
+# Give back a reservation charged on `day` when the upstream call failed
+async def refund_tokens(db: AsyncSession, user_id: int, tokens: int, day: date):
+    await db.execute(
+        update(UserToken)
+        .where(UserToken.user_id == user_id, UserToken.last_used == day)
+        .values(
+            tokens_used=func.greatest(UserToken.tokens_used - tokens, 0),
+            data_version=UserToken.data_version + 1,
+        )
+    )
+    await db.commit()
+
+
+# Current daily usage as (tokens_used, last_used), or None if never charged
+async def get_token_usage(db: AsyncSession, user_id: int):
+    row = (await db.execute(
+        select(UserToken.tokens_used, UserToken.last_used).where(UserToken.user_id == user_id)
+    )).first()
+    return tuple(row) if row is not None else None
+
+
+# Apply buffered usage deltas for many users in one statement
+async def apply_token_deltas(db: AsyncSession, deltas: list) -> dict:
+    """
+    Adds (user_id, day, delta) rows to user_tokens with one multi-row UPSERT.
+
+    A delta for an older day than the stored row is dropped, a newer day
+    resets the counter first. Negative deltas (refunds) only lower a row
+    already charged on their day, never below zero, and create no row.
+    Returns {user_id: tokens_used} for updated rows.
+    """
+    if not deltas:
+        return {}
+    totals = {}
+    charges = [(user_id, day, delta) for user_id, day, delta in deltas if delta >= 0]
+    refunds = [(user_id, day, delta) for user_id, day, delta in deltas if delta < 0]
+    if charges:
+        totals.update(await _charge_token_deltas(db, charges))
+    if refunds:
+        rows = values(
+            column("user_id", Integer), column("day", Date), column("delta", Integer), name="refunds"
+        ).data(refunds)
+        stmt = (
+            update(UserToken)
+            .where(UserToken.user_id == rows.c.user_id, UserToken.last_used == rows.c.day)
+            .values(
+                tokens_used=func.greatest(UserToken.tokens_used + rows.c.delta, 0),
+                data_version=UserToken.data_version + 1,
+            )
+            .returning(UserToken.user_id, UserToken.tokens_used)
+        )
+        totals.update({user_id: tokens_used for user_id, tokens_used in (await db.execute(stmt)).all()})
+    await db.commit()
+    return totals
+
+
+async def _charge_token_deltas(db: AsyncSession, deltas: list) -> dict:
+    stmt = insert(UserToken).values([
+        {"user_id": user_id, "tokens_used": delta, "last_used": day, "data_version": 1}
+        for user_id, day, delta in deltas
+    ])
+    used_that_day = case(
+        (UserToken.last_used == stmt.excluded.last_used, func.coalesce(UserToken.tokens_used, 0)),
+        else_=0,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserToken.user_id],
+        set_={
+            "tokens_used": used_that_day + stmt.excluded.tokens_used,
+            "last_used": stmt.excluded.last_used,
+            "data_version": UserToken.data_version + 1,
+        },
+        where=UserToken.last_used <= stmt.excluded.last_used,
+    ).returning(UserToken.user_id, UserToken.tokens_used)
+    rows = (await db.execute(stmt)).all()
+    return {user_id: tokens_used for user_id, tokens_used in rows}
+
+
+# Version of everything the profile and the output listing show, 0 before the first change
+async def get_data_version(db: AsyncSession, user_id: int) -> int:
+    version = await db.scalar(select(UserToken.data_version).where(UserToken.user_id == user_id))
+    return version or 0
+
+
+# Bump the version when outputs change; part of the caller's transaction
+async def bump_data_version(db: AsyncSession, user_id: int):
+    stmt = insert(UserToken).values(user_id=user_id, tokens_used=0, last_used=func.current_date(), data_version=1)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[UserToken.user_id],
+        set_={"data_version": UserToken.data_version + 1},
+    ))
+
+
+# Number of saved outputs per template type
+async def count_outputs_by_type(db: AsyncSession, user_id: int) -> dict:
+    rows = (await db.execute(
+        select(SavedOutput.template_type, func.count())
+        .where(SavedOutput.user_id == user_id)
+        .group_by(SavedOutput.template_type)
+    )).all()
+    return {template_type: count for template_type, count in rows}
+
+
+# One page of a user's saved outputs, newest first, without the full content
+async def list_output_previews(
+    db: AsyncSession,
+    user_id: int,
+    limit: int,
+    preview_chars: int,
+    before: tuple | None = None,
+    template_type: str | None = None,
+):
+    """
+    Keyset-paginated listing ordered by (created_at, id) descending.
+
+    `before` is the (created_at, id) of the last row of the previous page.
+    The content itself is not read: the preview comes from the blob's
+    uncompressed prefix (at most CONTENT_PREVIEW_CHARS characters), with
+    the content's size in bytes. Returns up to `limit` rows.
+    """
+    stmt = (
+        select(
+            SavedOutput.id,
+            SavedOutput.template_type,
+            func.substr(ContentBlob.preview, 1, preview_chars).label("preview"),
+            ContentBlob.size.label("content_bytes"),
+            SavedOutput.created_at,
+        )
+        .join(ContentBlob, ContentBlob.digest == SavedOutput.content_digest)
+        .where(SavedOutput.user_id == user_id)
+        .order_by(SavedOutput.created_at.desc(), SavedOutput.id.desc())
+        .limit(limit)
+    )
+    if before is not None:
+        stmt = stmt.where(tuple_(SavedOutput.created_at, SavedOutput.id) < tuple_(*before))
+    if template_type is not None:
+        stmt = stmt.where(SavedOutput.template_type == template_type)
+    return (await db.execute(stmt)).all()
+
+
+# Ranked full-text search over a user's saved outputs
+async def search_outputs(
+    db: AsyncSession,
+    user_id: int,
+    query: str,
+    limit: int,
+    headline_options: str,
+    after: tuple | None = None,
+    template_type: str | None = None,
+):
+    """
+    Matches `query` (web search syntax: quoted phrases, OR, -word) against
+    the outputs' search_vector, best match first.
+
+    `after` is the (rank, id) of the last row of the previous page. The
+    headline (snippet) is built only for the rows of the page: their content
+    is decompressed here and sent back for ts_headline in one statement.
+    Returns up to `limit` (row, headline) pairs; rows have id,
+    template_type, created_at and rank.
+    """
+    tsquery = func.websearch_to_tsquery(search_config, query)
+    rank = func.ts_rank_cd(SavedOutput.search_vector, tsquery).cast(Float)
+    page = (
+        select(
+            SavedOutput.id,
+            SavedOutput.template_type,
+            SavedOutput.created_at,
+            SavedOutput.content_digest,
+            rank.label("rank"),
+        )
+        .where(SavedOutput.user_id == user_id, SavedOutput.search_vector.op("@@")(tsquery))
+        .order_by(rank.desc(), SavedOutput.id.desc())
+        .limit(limit)
+    )
+    if after is not None:
+        page = page.where(tuple_(rank, SavedOutput.id) < tuple_(*after))
+    if template_type is not None:
+        page = page.where(SavedOutput.template_type == template_type)
+    page = page.subquery()
+    # How selective a term is decides the plan, so asyncpg's cached prepared
+    # statement must not fall back to a generic plan; that was 5-10x slower
+    # for common terms in benchmarks/bench_search.py
+    await db.execute(text("SET LOCAL plan_cache_mode = force_custom_plan"))
+    rows = (await db.execute(
+        select(page.c.id, page.c.template_type, page.c.created_at, page.c.rank, ContentBlob.encoding, ContentBlob.data)
+        .join(ContentBlob, ContentBlob.digest == page.c.content_digest)
+        .order_by(page.c.rank.desc(), page.c.id.desc())
+    )).all()
+    if not rows:
+        return []
+    contents = func.unnest(
+        cast([content_store.decode(row.encoding, row.data) for row in rows], ARRAY(Text))
+    ).table_valued("content", with_ordinality="n").render_derived()
+    headlines = (await db.scalars(
+        select(func.ts_headline(search_config, contents.c.content, tsquery, headline_options))
+        .order_by(contents.c.n)
+    )).all()
+    return list(zip(rows, headlines))
+
+
+# Full saved output, only if it belongs to the user
+async def get_output(db: AsyncSession, user_id: int, output_id: int):
+    return await db.scalar(
+        select(SavedOutput).where(SavedOutput.id == output_id, SavedOutput.user_id == user_id)
+    )
+
+
+# Store texts in content_blobs, once per distinct text
+async def store_contents(db: AsyncSession, contents: list) -> list:
+    """
+    Inserts the blobs that do not exist yet and returns the digest of each
+    text in `contents`, in order. Does not commit.
+    """
+    blobs = {}
+    digests = []
+    for content in contents:
+        blob = content_store.encode(content)
+        blobs[blob["digest"]] = blob
+        digests.append(blob["digest"])
+    # Sorted, so concurrent transactions storing the same texts take the
+    # unique index locks in the same order and cannot deadlock
+    await db.execute(
+        insert(ContentBlob).on_conflict_do_nothing(index_elements=[ContentBlob.digest]),
+        [blobs[digest] for digest in sorted(blobs)],
+    )
+    return digests
+
+
+# Insert one saved output per content digest, indexing the text for search
+def _insert_outputs():
+    return insert(SavedOutput).values(
+        search_vector=func.to_tsvector(search_config, bindparam("content", type_=Text)),
+    )
+
+
+# Insert many saved outputs in one statement and transaction
+async def create_outputs(db: AsyncSession, user_id: int, items: list, created_at) -> list:
+    """
+    Inserts (template_type, content) pairs with a multi-row INSERT ... RETURNING.
+
+    The texts go to content_blobs first (see store_contents). SQLAlchemy
+    pages very large batches into several multi-row statements, all inside
+    one transaction. Returns (id, template_type, created_at) rows in the
+    order of `items`.
+    """
+    digests = await store_contents(db, [content for _, content in items])
+    rows = (await db.execute(
+        _insert_outputs().returning(
+            SavedOutput.id, SavedOutput.template_type, SavedOutput.created_at, sort_by_parameter_order=True
+        ),
+        [
+            {
+                "user_id": user_id,
+                "template_type": template_type,
+                "content_digest": digest,
+                "content": content,
+                "created_at": created_at,
+            }
+            for (template_type, content), digest in zip(items, digests)
+        ],
+    )).all()
+    await bump_data_version(db, user_id)
+    await db.commit()
+    return rows
+
+
+# Queue an image job
+async def create_image_job(db: AsyncSession, job_id: str, user_id: int, prompt: str, style: str, size: str,
+                           image_url: str, auto_save: bool, tokens: int) -> ImageJob:
+    job = ImageJob(
+        id=job_id,
+        user_id=user_id,
+        status="queued",
+        prompt=prompt,
+        style=style,
+        size=size,
+        image_url=image_url,
+        auto_save=auto_save,
+        tokens=tokens,
+    )
+    db.add(job)
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+
+# Image job, only if it belongs to the user
+async def get_image_job(db: AsyncSession, user_id: int, job_id: str):
+    return await db.scalar(select(ImageJob).where(ImageJob.id == job_id, ImageJob.user_id == user_id))
+
+
+# Jobs of a user that have not finished yet
+async def count_unfinished_image_jobs(db: AsyncSession, user_id: int) -> int:
+    return await db.scalar(
+        select(func.count())
+        .select_from(ImageJob)
+        .where(ImageJob.user_id == user_id, ImageJob.status.in_(("queued", "running")))
+    )
+
+
+async def claim_image_job(db: AsyncSession, max_running: int, lease_seconds: float):
+    """
+    Marks the oldest claimable image job as running and returns it.
+
+    Claimable are queued jobs and running jobs whose lease expired (their
+    worker died). Claims are serialized with an advisory lock, so at most
+    `max_running` jobs with a live lease exist across all processes.
+    Returns None when nothing is claimable or the cap is reached.
+    """
+    await db.execute(select(func.pg_advisory_xact_lock(IMAGE_JOB_CLAIM_LOCK)))
+    lease_start = func.now() - timedelta(seconds=lease_seconds)
+    running = await db.scalar(
+        select(func.count())
+        .select_from(ImageJob)
+        .where(ImageJob.status == "running", ImageJob.started_at >= lease_start)
+    )
+    if running >= max_running:
+        await db.commit()
+        return None
+    next_job = (
+        select(ImageJob.id)
+        .where(or_(
+            ImageJob.status == "queued",
+            and_(ImageJob.status == "running", ImageJob.started_at < lease_start),
+        ))
+        .order_by(ImageJob.created_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    job = await db.scalar(
+        update(ImageJob)
+        .where(ImageJob.id == next_job)
+        .values(status="running", started_at=func.now(), attempts=ImageJob.attempts + 1)
+        .returning(ImageJob)
+    )
+    await db.commit()
+    return job
+
+
+# Put a running job back in the queue, e.g. when its worker shuts down
+async def requeue_image_job(db: AsyncSession, job_id: str):
+    await db.execute(
+        update(ImageJob)
+        .where(ImageJob.id == job_id, ImageJob.status == "running")
+        .values(status="queued", started_at=None)
+    )
+    await db.commit()
+
+
+# Both finishers only touch the attempt the worker claimed; a job reclaimed
+# after its lease ran out belongs to the newer attempt. They return whether
+# the job was still theirs to finish.
+async def fail_image_job(db: AsyncSession, job: ImageJob, error: str) -> bool:
+    result = await db.execute(
+        update(ImageJob)
+        .where(ImageJob.id == job.id, ImageJob.status == "running", ImageJob.attempts == job.attempts)
+        .values(status="failed", error=error, finished_at=func.now())
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def complete_image_job(db: AsyncSession, job: ImageJob) -> bool:
+    """
+    Marks the job succeeded and, if it asked for it, saves the image to the
+    user's outputs, in one transaction.
+    """
+    result = await db.execute(
+        update(ImageJob)
+        .where(ImageJob.id == job.id, ImageJob.status == "running", ImageJob.attempts == job.attempts)
+        .values(status="succeeded", error=None, finished_at=func.now())
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        return False
+    if job.auto_save:
+        [digest] = await store_contents(db, [job.image_url])
+        saved_output_id = await db.scalar(
+            _insert_outputs().returning(SavedOutput.id),
+            {
+                "user_id": job.user_id,
+                "template_type": "image",
+                "content_digest": digest,
+                "content": job.image_url,
+            },
+        )
+        await bump_data_version(db, job.user_id)
+        await db.execute(update(ImageJob).where(ImageJob.id == job.id).values(saved_output_id=saved_output_id))
+    await db.commit()
+    return True
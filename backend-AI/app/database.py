@@ -1,41 +1,208 @@
-# backend app database 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
-from models import User, SavedOutput, UserToken  # Ensure these paths are correct
+# backend app database
+import time
 
-import os 
-from dotenv import load_dotenv
+from sqlalchemy import create_engine, event, exc, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.schema import CreateColumn
+from models import Base, User, SavedOutput, UserToken  # Ensure these paths are correct
 
-load_dotenv() # Load environment variables 
+import os
+import settings
+from utils import metrics
 
-DB_NAME=os.getenv("DB_NAME")
-DB_USER=os.getenv("DB_USERNAME")
-DB_PASSWORD=os.getenv("DB_PASSWORD")
-DB_HOST=os.getenv("DB_HOST")
-DB_PORT=os.getenv("DB_PORT") 
+DB_NAME=settings.DB_NAME
+DB_USER=settings.DB_USER
+DB_PASSWORD=settings.DB_PASSWORD
+DB_HOST=settings.DB_HOST
+DB_PORT=settings.DB_PORT
 
-connection=f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Connection pool tuning
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
 
-engine = create_engine(connection)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Keeps app processes that start together from setting up the schema at the same time (pg_advisory_lock key)
+INIT_DB_LOCK = 7_301_021
 
-Base = declarative_base()
+connection=f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+sync_connection=f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 
+class PoolMetrics:
+    """
+    Running totals of how long requests waited to check out a connection.
+
+    Attributes:
+        checkouts (int): Number of connections handed out.
+        wait_seconds_total (float): Sum of checkout wait times.
+        wait_seconds_max (float): Longest single checkout wait.
+        timeouts (int): Checkouts that gave up after DB_POOL_TIMEOUT.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+
+    def record(self, waited: float, timed_out: bool = False):
+        if timed_out:
+            self.timeouts += 1
+            return
+        self.checkouts += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # Times every checkout, including the wait for a free connection
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            waited = time.perf_counter() - start
+            pool_metrics.record(waited, timed_out=True)
+            metrics.observe_pool_checkout(waited, timed_out=True)
+            raise
+        waited = time.perf_counter() - start
+        pool_metrics.record(waited)
+        metrics.observe_pool_checkout(waited)
+        return conn
+
+
+engine = create_async_engine(
+    connection,
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+
+
+# Per-statement timing and pool occupancy for /metrics
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.observe_query(time.perf_counter() - conn.info["query_start"].pop())
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _handle_error(context):
+    starts = context.connection.info.get("query_start") if context.connection is not None else None
+    if starts:
+        metrics.observe_query(time.perf_counter() - starts.pop())
+
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.db_pool_checked_out.inc()
+
+
+@event.listens_for(engine.sync_engine, "checkin")
+def _checkin(dbapi_connection, connection_record):
+    metrics.db_pool_checked_out.dec()
+
+
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+def pool_status() -> dict:
+    pool = engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checked_in": pool.checkedin(),
+        "checkouts": pool_metrics.checkouts,
+        "checkout_wait_seconds_total": round(pool_metrics.wait_seconds_total, 6),
+        "checkout_wait_seconds_max": round(pool_metrics.wait_seconds_max, 6),
+        "checkout_timeouts": pool_metrics.timeouts,
+    }
+
+
+# Synchronous engine for scripts such as create_db.py; created on first use
+_sync_engine = None
+
+
+def get_sync_engine():
+    global _sync_engine
+    if _sync_engine is None:
+        _sync_engine = create_engine(
+            sync_connection,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+    return _sync_engine
+
+
+def get_sync_session():
+    return sessionmaker(autocommit=False, autoflush=False, bind=get_sync_engine())()
 
 
 # Create all tables (automatically)
-def init_db() -> None:
+async def init_db() -> None:
     """
     Initializes the database by creating all tables.
     """
-    Base.metadata.create_all(bind=engine)
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": INIT_DB_LOCK})
+        try:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.commit()
+            if "content" in await conn.run_sync(saved_output_columns):
+                raise RuntimeError(
+                    "saved_outputs still stores content inline; run `python migrate_content_blobs.py` "
+                    "before starting this version"
+                )
+            # create_all skips tables that already exist, so add columns and indexes introduced since
+            await conn.run_sync(_add_missing_columns)
+            await conn.run_sync(_create_missing_indexes)
+            await conn.commit()
+        finally:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INIT_DB_LOCK})
+            await conn.commit()
+
+
+def saved_output_columns(conn) -> set:
+    return {column["name"] for column in inspect(conn).get_columns("saved_outputs")}
+
+
+def _add_missing_columns(conn) -> None:
+    # Must be nullable or have a default; saved_outputs columns that need data are added by migrate_content_blobs.py
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+
+
+def _create_missing_indexes(conn) -> None:
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -1,32 +1,48 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt, JWTError
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
+from utils.auth import verify_token
+from utils.principal_cache import Principal, PrincipalCache, token_digest
 import models
 import os 
-from dotenv import load_dotenv
-load_dotenv()
+import settings  # noqa: F401  (loads .env)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM =os.getenv("ALGORITHM")
+# Verified tokens are cached briefly so most requests skip JWT decoding and the user lookup
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+principal_cache = None
+if PRINCIPAL_CACHE_TTL_SECONDS > 0:
+    principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_ENTRIES)
+    principal_cache.watch_user_changes()
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    digest = token_digest(token)
+    principal = principal_cache.get(digest) if principal_cache is not None else None
+    if principal is None:
+        payload = verify_token(token)
         user_email: str = payload.get("sub")
         if user_email is None:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = db.query(models.User).filter(models.User.email == user_email).first()
-    if user is None:
-        raise credentials_exception
-    return user
+        user = await db.scalar(select(models.User).where(models.User.email == user_email))
+        if user is None:
+            raise credentials_exception
+        principal = Principal.from_user(user)
+        # End the read so the connection goes back to the pool instead of
+        # being held for the rest of the request (e.g. a long upstream call)
+        await db.rollback()
+        if principal_cache is not None:
+            principal_cache.set(digest, principal, payload.get("exp"))
+    if not principal.is_active:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User account is inactive")
+    return principal
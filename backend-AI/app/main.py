@@ -1,19 +1,111 @@
 # import necessary modules 
-from fastapi import FastAPI, Depends
-from sqlalchemy.orm import Session 
-from database import init_db
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, Response
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import init_db, engine, pool_status
+from dependencies import principal_cache
+from utils.usage_buffer import usage_buffer
 from fastapi.security import OAuth2PasswordBearer
 import  models
-from utils import auth 
+import os
+from utils import auth, openai_api, metrics
+from utils.compression import CompressionMiddleware
+from utils.responses import FastJSONResponse
+from utils.idempotency import (
+    IdempotencyMiddleware,
+    IdempotencyStore,
+    InMemoryIdempotencyBackend,
+    SqliteIdempotencyBackend,
+)
+from utils.rate_limit import (
+    InMemoryRateLimitBackend,
+    RateLimitMiddleware,
+    SqliteRateLimitBackend,
+    parse_rules,
+)
+import settings
 from fastapi.middleware.cors import CORSMiddleware
 from routes import auth_routes, generate_routes, save_routes
 
 
 
-app=FastAPI() 
+logger = logging.getLogger(__name__)
+
+# Token-bucket rate limits per route group, as "user=<requests>/<seconds>,ip=<requests>/<seconds>".
+# Users are keyed by the token subject; an empty value turns a group off.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMITS = {
+    "/auth": parse_rules(os.getenv("RATE_LIMIT_AUTH", "ip=20/60")),
+    "/generate": parse_rules(os.getenv("RATE_LIMIT_GENERATE", "user=30/60,ip=120/60")),
+    "/save": parse_rules(os.getenv("RATE_LIMIT_SAVE", "user=120/60,ip=600/60")),
+}
+# Generated images are static, content-addressed files
+RATE_LIMIT_EXEMPT = tuple(p for p in os.getenv("RATE_LIMIT_EXEMPT", "/generate/images/").split(",") if p)
+# "memory" (per worker) or "sqlite" (shared by the workers on a host)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "rate_limits.sqlite3")
+RATE_LIMIT_TRUST_FORWARDED_FOR = os.getenv("RATE_LIMIT_TRUST_FORWARDED_FOR", "false").lower() == "true"
+
+# Idempotency-Key support on the POST routes that spend quota or insert rows.
+# Streaming routes (the NDJSON batch) are left out: their responses cannot be replayed
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_PATHS = tuple(p for p in os.getenv(
+    "IDEMPOTENCY_PATHS",
+    "/generate/generate-template,/generate/generate-image-template,"
+    "/generate/image-jobs,/save/save-output,/save/save-outputs",
+).split(",") if p)
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# A duplicate takes over a key whose original has been running for this long
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "300"))
+IDEMPOTENCY_POLL_SECONDS = float(os.getenv("IDEMPOTENCY_POLL_SECONDS", "0.1"))
+# "memory" (per worker) or "sqlite" (shared by the workers on a host)
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory")
+IDEMPOTENCY_MAX_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BYTES", str(64 * 1024 * 1024)))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "100000"))
+IDEMPOTENCY_MAX_RESPONSE_BYTES = int(os.getenv("IDEMPOTENCY_MAX_RESPONSE_BYTES", str(256 * 1024)))
+IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH", "idempotency.sqlite3")
+
+# brotli (if installed) or gzip for responses sent in one piece, above this size
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+
+async def warm_up_clients():
+    try:
+        await asyncio.to_thread(openai_api.warm_up)
+    except Exception:
+        # Not fatal: the first generation builds them instead
+        logger.exception("Warming up the LLM clients failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema creation runs here, not at import, so importing main needs no database
+    await init_db()
+    if usage_buffer is not None:
+        usage_buffer.start()
+    generate_routes.image_jobs.start()
+    warm_up = asyncio.create_task(warm_up_clients()) if settings.WARM_UP_CLIENTS else None
+    yield
+    if warm_up is not None:
+        await warm_up
+    # Running image jobs go back to the queue for the next start
+    await generate_routes.image_jobs.close()
+    if usage_buffer is not None:
+        # Final flush so buffered quota charges are not lost on shutdown
+        await usage_buffer.close()
+    await engine.dispose()
+    auth.password_hasher.shutdown()
+    metrics.mark_process_dead()
 
-# Initialize DB tables 
-init_db()
+
+app=FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse) 
 
 
 
@@ -25,6 +117,49 @@ origins=[
          ]
 
 
+# Innermost, so retries are still rate limited and replays show up in /metrics
+if IDEMPOTENCY_ENABLED:
+    app.add_middleware(
+        IdempotencyMiddleware,
+        store=IdempotencyStore(
+            (
+                SqliteIdempotencyBackend(IDEMPOTENCY_PATH, IDEMPOTENCY_MAX_ENTRIES) if IDEMPOTENCY_BACKEND == "sqlite"
+                else InMemoryIdempotencyBackend(IDEMPOTENCY_MAX_BYTES)
+            ),
+            ttl=IDEMPOTENCY_TTL_SECONDS,
+            lease=IDEMPOTENCY_LEASE_SECONDS,
+            poll_interval=IDEMPOTENCY_POLL_SECONDS,
+        ),
+        paths=IDEMPOTENCY_PATHS,
+        max_response_bytes=IDEMPOTENCY_MAX_RESPONSE_BYTES,
+        principal_cache=principal_cache,
+    )
+
+# Rejected requests still get CORS headers and show up in /metrics
+if RATE_LIMIT_ENABLED:
+    app.add_middleware(
+        RateLimitMiddleware,
+        backend=(
+            SqliteRateLimitBackend(RATE_LIMIT_PATH) if RATE_LIMIT_BACKEND == "sqlite"
+            else InMemoryRateLimitBackend(RATE_LIMIT_MAX_KEYS)
+        ),
+        groups=RATE_LIMITS,
+        exempt=RATE_LIMIT_EXEMPT,
+        trust_forwarded_for=RATE_LIMIT_TRUST_FORWARDED_FOR,
+        principal_cache=principal_cache,
+    )
+
+# Per-route latency and SQL statement counts for /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
+if COMPRESSION_ENABLED:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=COMPRESSION_MIN_BYTES,
+        gzip_level=COMPRESSION_GZIP_LEVEL,
+        brotli_quality=COMPRESSION_BROTLI_QUALITY,
+    )
+
 #apply CORS settings 
 app.add_middleware(
     CORSMiddleware,
@@ -49,13 +184,26 @@ async def  protected_route(token: str=Depends(oauth2_scheme)):
     return {"message":"This is a protected route"}
 
 @app.get("/test-db")
-async def test_db(db: Session = Depends(auth.get_db)):
+async def test_db(db: AsyncSession = Depends(auth.get_db)):
     try:
         # Just a basic query to see if db connection works
-        users = db.query(models.User).all()
-        return {"message": "DB Connection Successful!", "users_count": len(users)}
+        users_count = await db.scalar(select(func.count()).select_from(models.User))
+        return {"message": "DB Connection Successful!", "users_count": users_count}
     except Exception as e:
         return {"error": str(e)}
+
+
+# Connection pool saturation and checkout wait times
+@app.get("/db-pool")
+async def db_pool():
+    return pool_status()
+
+
+# Prometheus scrape endpoint, aggregated over all workers in multiprocess mode
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
       
     
 if __name__=="__main__":
@@ -0,0 +1,128 @@
+"""
+One-off migration of saved_outputs.content into content_blobs.
+
+Databases created before content_blobs existed keep each output's text
+inline. This moves it into compressed, deduplicated blobs, fills
+search_vector from it and drops the content column; the app refuses to
+start until it has run. The last pass locks saved_outputs against writes
+and the column drop takes an exclusive lock, so run it in a maintenance
+window, with the app stopped or quiet:
+
+    python migrate_content_blobs.py
+"""
+import asyncio
+import logging
+import os
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from database import INIT_DB_LOCK, engine, init_db, saved_output_columns
+from models import Base, ContentBlob, SEARCH_CONFIG
+from utils import content_store
+
+logger = logging.getLogger(__name__)
+
+# Rows per committed batch when moving inline saved_outputs.content to content_blobs
+CONTENT_MIGRATION_BATCH = int(os.getenv("CONTENT_MIGRATION_BATCH", "1000"))
+
+
+async def main() -> None:
+    async with engine.connect() as conn:
+        # Not alongside an app process that is setting up the schema
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": INIT_DB_LOCK})
+        try:
+            # content_blobs itself
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.commit()
+            await migrate_inline_content(conn)
+        finally:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INIT_DB_LOCK})
+            await conn.commit()
+    # Columns and indexes added since, as on a normal start
+    await init_db()
+    await engine.dispose()
+
+
+async def migrate_inline_content(conn) -> None:
+    """
+    Moves saved_outputs.content, from databases created before content_blobs
+    existed, into compressed and deduplicated blobs.
+
+    Rows are moved in committed batches of CONTENT_MIGRATION_BATCH, so an
+    interrupted migration carries on where it stopped when run again.
+    Rows written meanwhile are caught by a last pass under a table lock,
+    after which the content column is dropped. Postgres only gives the
+    dropped column's space back once the table is rewritten, e.g. by
+    VACUUM FULL saved_outputs.
+    """
+    if "content" not in await conn.run_sync(saved_output_columns):
+        return
+    await conn.execute(text(
+        "ALTER TABLE saved_outputs ADD COLUMN IF NOT EXISTS content_digest varchar(64) "
+        "REFERENCES content_blobs (digest)"
+    ))
+    await conn.execute(text("ALTER TABLE saved_outputs ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+    # search_vector used to be generated from content; keep its values, drop the dependency
+    generated = await conn.scalar(text(
+        "SELECT is_generated = 'ALWAYS' FROM information_schema.columns "
+        "WHERE table_name = 'saved_outputs' AND column_name = 'search_vector'"
+    ))
+    if generated:
+        await conn.execute(text("ALTER TABLE saved_outputs ALTER COLUMN search_vector DROP EXPRESSION"))
+    await conn.commit()
+
+    pending = text(
+        "SELECT id, content FROM saved_outputs WHERE content_digest IS NULL AND id > :after ORDER BY id LIMIT :limit"
+    )
+    moved, after = 0, 0
+    while True:
+        rows = (await conn.execute(pending, {"after": after, "limit": CONTENT_MIGRATION_BATCH})).all()
+        if not rows:
+            break
+        await _move_contents(conn, rows)
+        await conn.commit()
+        moved += len(rows)
+        after = rows[-1].id
+        logger.info("Moved %d saved outputs to content_blobs", moved)
+
+    await conn.execute(text("LOCK TABLE saved_outputs IN SHARE ROW EXCLUSIVE MODE"))
+    rows = (await conn.execute(text("SELECT id, content FROM saved_outputs WHERE content_digest IS NULL"))).all()
+    await _move_contents(conn, rows)
+    await conn.execute(text("ALTER TABLE saved_outputs ALTER COLUMN content_digest SET NOT NULL"))
+    await conn.execute(text("ALTER TABLE saved_outputs DROP COLUMN content"))
+    await conn.commit()
+    logger.info(
+        "Moved %d saved outputs to content_blobs; run VACUUM FULL saved_outputs to reclaim the old space",
+        moved + len(rows),
+    )
+
+
+async def _move_contents(conn, rows) -> None:
+    if not rows:
+        return
+    blobs = {}
+    digests = []
+    for row in rows:
+        blob = content_store.encode(row.content)
+        blobs[blob["digest"]] = blob
+        digests.append(blob["digest"])
+    await conn.execute(
+        insert(ContentBlob).on_conflict_do_nothing(index_elements=[ContentBlob.digest]),
+        [blobs[digest] for digest in sorted(blobs)],
+    )
+    await conn.execute(
+        text(
+            "UPDATE saved_outputs o SET content_digest = v.digest, "
+            f"search_vector = coalesce(o.search_vector, to_tsvector('{SEARCH_CONFIG}', o.content)) "
+            "FROM unnest(CAST(:ids AS integer[]), CAST(:digests AS varchar[])) AS v (id, digest) "
+            "WHERE o.id = v.id"
+        ),
+        {"ids": [row.id for row in rows], "digests": digests},
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
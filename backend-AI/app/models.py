@@ -1,18 +1,31 @@
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     String,
     Boolean,
     ForeignKey,
     Text,
     Date,
     DateTime,
-    func
+    Index,
+    LargeBinary,
+    DDL,
+    event,
+    func,
+    text,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.orm import declarative_base
 
+from utils import content_store
+
 Base = declarative_base()
+
+# Text search configuration of saved_outputs.search_vector; queries must use the same one
+SEARCH_CONFIG = "english"
+
 class User(Base):
     """
     Represents an application user.
@@ -47,6 +60,44 @@ class User(Base):
     )
 
 
+class ContentBlob(Base):
+    """
+    The text of saved outputs, stored once per distinct text.
+
+    Rows are keyed by the SHA-256 of the text, so saving the same text again
+    only adds a saved_outputs row. Texts of CONTENT_COMPRESS_MIN_BYTES or
+    more are compressed (see utils/content_store.py). Rows are never updated.
+
+    Attributes:
+        digest (str): SHA-256 hex digest of the UTF-8 text.
+        encoding (str): 'raw', 'zlib' or 'zstd'.
+        data (bytes): The UTF-8 text, compressed as `encoding` says.
+        size (int): Length of the UTF-8 text in bytes.
+        preview (str): Leading characters of the text, for listings.
+        created_at (datetime): When the text was first saved.
+    """
+    __tablename__ = "content_blobs"
+
+    digest = Column(String(64), primary_key=True)
+    encoding = Column(String(8), nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer, nullable=False)
+    preview = Column(Text, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+    @property
+    def content(self) -> str:
+        return content_store.decode(self.encoding, self.data)
+
+
+# The data is compressed already; keep Postgres from trying again when it is toasted
+event.listen(
+    ContentBlob.__table__,
+    "after_create",
+    DDL("ALTER TABLE content_blobs ALTER COLUMN data SET STORAGE EXTERNAL"),
+)
+
+
 class SavedOutput(Base):
     """
     Represents content generated by the AI and saved by the user.
@@ -55,18 +106,34 @@ class SavedOutput(Base):
         id (int): Primary key.
         user_id (int): Foreign key to users table.
         template_type (str): Type of template ('blog_post', 'image', etc.).
-        content (str): The generated text or image URL.
+        content_digest (str): The ContentBlob holding the generated text or image URL.
         created_at (datetime): Timestamp of when the generation was saved.
+        search_vector (tsvector): Full-text index of the content, written with the row.
+        blob (ContentBlob): The content, loaded together with the output.
+        content (str): The decompressed content.
     """
     __tablename__ = "saved_outputs"
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     template_type = Column(String(50), nullable=False)
-    content = Column(Text, nullable=False)
+    content_digest = Column(String(64), ForeignKey("content_blobs.digest"), nullable=False)
     created_at = Column(DateTime, server_default=func.now())
+    # Filled in on insert from the plain text, which the database never sees again
+    search_vector = deferred(Column(TSVECTOR))
 
     user = relationship("User", back_populates="outputs")
+    blob = relationship("ContentBlob", lazy="joined", innerjoin=True)
+
+    @property
+    def content(self) -> str:
+        return self.blob.content
+
+    __table_args__ = (
+        # Serves the per-user listing newest first; id breaks created_at ties
+        Index("ix_saved_outputs_user_created", "user_id", "created_at", "id"),
+        Index("ix_saved_outputs_search", "search_vector", postgresql_using="gin"),
+    )
 
 
 class UserToken(Base):
@@ -77,11 +144,61 @@ class UserToken(Base):
         user_id (int): One-to-one relationship with users table.
         tokens_used (int): Total tokens used by the user.
         last_used (date): The last date the tokens were used.
+        data_version (int): Bumped whenever the user's quota or saved outputs
+            change; the ETags of the profile and the output listing are built
+            from it.
     """
     __tablename__ = "user_tokens"
 
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
     tokens_used = Column(Integer, default=0)
     last_used = Column(Date, default=func.current_date())
+    data_version = Column(BigInteger, nullable=False, server_default=text("0"))
+
+    user = relationship("User", back_populates="token_usage")
+
+
+class ImageJob(Base):
+    """
+    An image generation queued for the background job workers.
 
-    user = relationship("User", back_populates="token_usage")
\ No newline at end of file
+    Attributes:
+        id (str): Random hex job id.
+        user_id (int): Foreign key to users table.
+        status (str): 'queued', 'running', 'succeeded' or 'failed'.
+        prompt (str): The image prompt as submitted.
+        style (str): Prompt style ('product', 'art', 'fantasy').
+        size (str): Requested image size.
+        image_url (str): Where the image is served once the job succeeds.
+        auto_save (bool): Whether to add the image to saved_outputs when done.
+        saved_output_id (int): The SavedOutput created by auto_save.
+        tokens (int): Quota held for the job, refunded if it fails.
+        error (str): Why the job failed.
+        attempts (int): Times a worker has picked the job up.
+        created_at (datetime): When the job was submitted.
+        started_at (datetime): When the current attempt started.
+        finished_at (datetime): When the job succeeded or failed.
+    """
+    __tablename__ = "image_jobs"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    status = Column(String(16), nullable=False, default="queued")
+    prompt = Column(Text, nullable=False)
+    style = Column(String(50), nullable=False)
+    size = Column(String(20), nullable=False)
+    image_url = Column(Text, nullable=False)
+    auto_save = Column(Boolean, nullable=False, default=False)
+    saved_output_id = Column(Integer, ForeignKey("saved_outputs.id", ondelete="SET NULL"))
+    tokens = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        # Workers claim the oldest unfinished job; finished jobs stay out of the index
+        Index("ix_image_jobs_unfinished", "created_at", postgresql_where=text("status IN ('queued', 'running')")),
+        Index("ix_image_jobs_user", "user_id", "status"),
+    )
@@ -1,21 +1,23 @@
 # app/routes/auth_routes.py
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Header, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import schemas, crud
-from utils.auth import get_password_hash, create_access_token, verify_password
 from database import get_db
 from utils import auth 
-from datetime import timedelta, date 
+from datetime import timedelta
 from dependencies import get_current_user
-from models import User, UserToken, SavedOutput
+from models import UserToken
+from utils.principal_cache import Principal
+from utils.responses import data_etag, etag_matches, not_modified, set_etag
 router = APIRouter()
 
 
 # Create api route for user registration 
 @router.post("/register")
-async def register(user: schemas.UserCreate, db: Session = Depends(auth.get_db)):
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(auth.get_db)):
     # Check if the email already exists 
-    db_user = crud.get_user_by_email(db, email=user.email)
+    db_user = await crud.get_user_by_email(db, email=user.email)
     
     # if it exists raise httpexception
     
@@ -24,29 +26,37 @@ async def register(user: schemas.UserCreate, db: Session = Depends(auth.get_db))
     
     # Check if username already exists 
     
-    db_username=crud.get_user_by_username(db, username=user.username)
+    db_username=await crud.get_user_by_username(db, username=user.username)
     if db_username:
         raise HTTPException(status_code=400, detail="Username already registered")
     
     # hash the password to create a new user
     
-    hashed_password = auth.get_password_hash(user.password)
-    new_user = crud.create_user(db, email=user.email, username=user.username,password=hashed_password)
+    hashed_password = await auth.hash_password(user.password)
+    new_user = await crud.create_user(db, email=user.email, username=user.username,password=hashed_password)
     return {"message": "User created successfully!", "user": new_user.email}
 
 
 # api to handle user login 
 
 @router.post("/login")
-async def login(user: schemas.UserLogin, db: Session = Depends(auth.get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def login(user: schemas.UserLogin, db: AsyncSession = Depends(auth.get_db)):
+    db_user = await crud.get_user_by_email(db, email=user.email)
 
     if not db_user:
-        db_user = crud.get_user_by_username(db, username=user.username)
+        db_user = await crud.get_user_by_username(db, username=user.username)
 
-    if not db_user or not auth.verify_password(user.password, db_user.hashed_password):
+    valid, new_hash = False, None
+    if db_user:
+        valid, new_hash = await auth.verify_and_update_password(user.password, db_user.hashed_password)
+    if not valid:
         raise HTTPException(status_code=400, detail="Incorrect email/username or password")
 
+    # Upgrade hashes made with deprecated settings while we have the plain password
+    if new_hash:
+        db_user.hashed_password = new_hash
+        await db.commit()
+
     access_token_expires = timedelta(minutes=30)
     access_token = auth.create_access_token(
         data={"sub": db_user.email}, expires_delta=access_token_expires
@@ -60,33 +70,34 @@ async def login(user: schemas.UserLogin, db: Session = Depends(auth.get_db)):
     }
     
 @router.get("/profile")
-def get_profile(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_profile(
+    response: Response,
+    if_none_match: str | None = Header(None),
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
     try:
-        # Check if user is active
-        if not user.is_active:
-            raise HTTPException(status_code=403, detail="User account is inactive")
-
-        # Get tokens used
-        token_record = db.query(UserToken).filter(UserToken.user_id == user.id).first()
+        # Get tokens used; the row also carries the data version, so pollers
+        # that are up to date get a 304 after this one lookup
+        token_record = await db.scalar(select(UserToken).where(UserToken.user_id == user.id))
+        version = token_record.data_version if token_record else 0
+        etag = data_etag("profile", user.id, version, user.username, user.email)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
         tokens_used = token_record.tokens_used if token_record else 0
 
-        # Get saved outputs
-        outputs = db.query(SavedOutput).filter(SavedOutput.user_id == user.id).all()
-        output_list = [
-            {
-                "id": output.id,
-                "template_type": output.template_type,
-                "content": output.content,
-                "created_at": output.created_at,
-            }
-            for output in outputs
-        ]
+        # Only summary counts here; the outputs themselves are paged via /save/outputs
+        outputs_by_type = await crud.count_outputs_by_type(db, user.id)
 
+        set_etag(response, etag)
         return {
             "username": user.username,
             "email": user.email,
             "tokens_used": tokens_used,
-            "saved_outputs": output_list
+            "saved_outputs_count": sum(outputs_by_type.values()),
+            "saved_outputs_by_type": outputs_by_type,
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching profile: {str(e)}")
@@ -1,51 +1,175 @@
-from fastapi import APIRouter, HTTPException, Depends
-from schemas import TemplateRequest, TemplateResponse, ImageResponse, ImageRequest
-from utils.openai_api import generate_text_template, generate_image_template
-from datetime import date 
-from models import UserToken, User
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, HTTPException, Depends, Request, Header, Query
+from fastapi.responses import StreamingResponse, Response
+from schemas import (
+    TemplateRequest,
+    TemplateResponse,
+    ImageResponse,
+    ImageRequest,
+    BatchTemplateRequest,
+    ImageJobRequest,
+    ImageJobResponse,
+)
+from utils.openai_api import (
+    generate_text_template,
+    generate_image_template,
+    stream_text_template,
+    generation_cache,
+    semantic_cache,
+    image_store,
+    IMAGE_SIZES,
+    GENERATION_MAX_CONCURRENCY_PER_USER,
+    estimate_prompt_tokens,
+    image_request_digest,
+    IMAGE_TIMEOUT_SECONDS,
+)
+from utils.image_jobs import ImageJobWorkers, FINISHED_STATUSES
+from utils.tokens import TokenMeter
+from utils import metrics
+from utils.usage_buffer import usage_buffer
+from utils.image_store import is_digest, THUMBNAIL_WIDTHS
+from utils.principal_cache import Principal
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud
 from dependencies import  get_current_user
-from database import get_db
+from database import get_db, AsyncSessionLocal
+import asyncio
+import json
+import os
+import uuid
+from settings import MAX_COMPLETION_TOKENS
+from datetime import date
 
 router = APIRouter()
 
-FREE_TOKEN_LIMIT = 1000  # Daily or total limit depending on business model
-TOKENS_PER_OUTPUT = 100  # Estimate or calculate dynamically
+# Quota is metered in model tokens, as reported by the LLM for each call
+FREE_TOKEN_LIMIT = int(os.getenv("FREE_TOKEN_LIMIT", "20000"))  # per user per day
+# Not worth calling the model when less than this is left for the completion
+MIN_COMPLETION_TOKENS = int(os.getenv("MIN_COMPLETION_TOKENS", "64"))
+# Images are not billed in tokens; each is charged this flat equivalent
+TOKENS_PER_IMAGE = int(os.getenv("TOKENS_PER_IMAGE", "1000"))
+TEXT_TEMPLATE_TYPES = ("blog_post", "email_draft")
 
-def get_or_create_token_usage(user: User, db: Session) -> UserToken:
-    today = date.today()
-    token_usage = db.query(UserToken).filter(UserToken.user_id == user.id).first()
-    if not token_usage:
-        token_usage = UserToken(user_id=user.id, tokens_used=0, last_used=today)
-        db.add(token_usage)
-        db.commit()
-        db.refresh(token_usage)
-    elif token_usage.last_used != today:
-        token_usage.tokens_used = 0
-        token_usage.last_used = today
-    return token_usage
+# Batch generation; by default a batch runs as many items at once as one user may
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", str(GENERATION_MAX_CONCURRENCY_PER_USER)))
 
+# Image jobs: workers per process, and running jobs across all processes
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", "4"))
+IMAGE_JOB_MAX_RUNNING = int(os.getenv("IMAGE_JOB_MAX_RUNNING", "8"))
+IMAGE_JOB_MAX_ATTEMPTS = int(os.getenv("IMAGE_JOB_MAX_ATTEMPTS", "3"))
+IMAGE_JOB_LEASE_SECONDS = float(os.getenv("IMAGE_JOB_LEASE_SECONDS", str(IMAGE_TIMEOUT_SECONDS * 2)))
+IMAGE_JOB_POLL_SECONDS = float(os.getenv("IMAGE_JOB_POLL_SECONDS", "5"))
+IMAGE_JOB_MAX_PENDING_PER_USER = int(os.getenv("IMAGE_JOB_MAX_PENDING_PER_USER", "10"))
+# Longest a status request may block waiting for the job to finish
+IMAGE_JOB_MAX_WAIT_SECONDS = float(os.getenv("IMAGE_JOB_MAX_WAIT_SECONDS", "30"))
+
+async def reserve_quota(user: Principal, db: AsyncSession, tokens: int) -> date:
+    # Charged up front and refunded if the generation fails; refunds need the day it was charged to
+    day = date.today()
+    if usage_buffer is not None:
+        total = await usage_buffer.reserve(user.id, tokens, FREE_TOKEN_LIMIT)
+    else:
+        total = await crud.reserve_tokens(db, user.id, tokens, FREE_TOKEN_LIMIT)
+    if total is None:
+        metrics.quota_rejections.labels("limit").inc()
+        raise HTTPException(status_code=403, detail="Token limit reached.")
+    return day
+
+
+async def refund_quota(user: Principal, tokens: int, day: date):
+    await refund_user_tokens(user.id, tokens, day)
+
+
+async def refund_user_tokens(user_id: int, tokens: int, day: date):
+    # A negative amount charges the difference instead
+    if usage_buffer is not None:
+        await usage_buffer.refund(user_id, tokens, day)
+        return
+    # Uses its own session so it also works after the request session is gone
+    async with AsyncSessionLocal() as db:
+        await crud.refund_tokens(db, user_id, tokens, day)
+
+
+image_jobs = ImageJobWorkers(
+    refund_user_tokens,
+    workers=IMAGE_JOB_WORKERS,
+    max_running=IMAGE_JOB_MAX_RUNNING,
+    lease_seconds=IMAGE_JOB_LEASE_SECONDS,
+    max_attempts=IMAGE_JOB_MAX_ATTEMPTS,
+    poll_interval=IMAGE_JOB_POLL_SECONDS,
+)
+
+
+async def tokens_used_today(user: Principal, db: AsyncSession) -> int:
+    if usage_buffer is not None:
+        return await usage_buffer.used(user.id)
+    usage = await crud.get_token_usage(db, user.id)
+    if usage is None or usage[1] != date.today():
+        return 0
+    return usage[0] or 0
+
+
+async def plan_generation(user: Principal, db: AsyncSession, prompt_tokens: int, count: int = 1) -> tuple[int, int]:
+    """
+    Pre-flight quota check for `count` text generations; nothing is held yet.
+
+    The budget left today, minus the estimated `prompt_tokens`, is split into
+    a per-generation `max_tokens` cap. If that leaves less than
+    MIN_COMPLETION_TOKENS the request is rejected before any upstream call.
+
+    Returns (max_tokens, hold), the hold being prompt plus caps.
+    """
+    remaining = FREE_TOKEN_LIMIT - await tokens_used_today(user, db)
+    max_tokens = min(MAX_COMPLETION_TOKENS, (remaining - prompt_tokens) // count)
+    if max_tokens < MIN_COMPLETION_TOKENS:
+        metrics.quota_rejections.labels("preflight").inc()
+        raise HTTPException(status_code=403, detail="Token limit reached.")
+    return max_tokens, prompt_tokens + max_tokens * count
+
+
+async def reserve_generation(
+    user: Principal, db: AsyncSession, prompt_tokens: int, count: int = 1
+) -> tuple[int, int, date]:
+    """
+    plan_generation plus the hold; settle_quota later swaps that hold for
+    what was actually used.
+
+    Returns (max_tokens, hold, day the hold was charged to).
+    """
+    max_tokens, hold = await plan_generation(user, db, prompt_tokens, count)
+    day = await reserve_quota(user, db, hold)
+    return max_tokens, hold, day
+
+
+async def settle_quota(user: Principal, hold: int, day: date, meter: TokenMeter):
+    if meter.total != hold:
+        await refund_quota(user, hold - meter.total, day)
 
 
 @router.post("/generate-template", response_model=TemplateResponse)
 async def generate_template(
     request: TemplateRequest,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
 ):
     try:
-        token_usage = get_or_create_token_usage(current_user, db)
-
-        if token_usage.tokens_used + TOKENS_PER_OUTPUT > FREE_TOKEN_LIMIT:
-            raise HTTPException(status_code=403, detail="Token limit reached.")
-
-        if request.template_type not in ["blog_post", "email_draft"]:
+        if request.template_type not in TEXT_TEMPLATE_TYPES:
             raise HTTPException(status_code=400, detail="Unsupported template type")
 
-        generated = generate_text_template(request.template_type, request.details)
-
-        token_usage.tokens_used += TOKENS_PER_OUTPUT
-        db.commit()
+        prompt_tokens = estimate_prompt_tokens(request.template_type, request.details)
+        max_tokens, hold, day = await reserve_generation(current_user, db, prompt_tokens)
+        meter = TokenMeter()
+        try:
+            generated = await generate_text_template(
+                request.template_type,
+                request.details,
+                user_id=current_user.id,
+                use_cache=request.use_cache,
+                max_tokens=max_tokens,
+                meter=meter,
+            )
+        finally:
+            await asyncio.shield(settle_quota(current_user, hold, day, meter))
 
         return TemplateResponse(generated_template=generated)
 
@@ -54,19 +178,362 @@ async def generate_template(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating template: {str(e)}")
 
+@router.get("/cache-stats")
+def cache_stats(current_user: Principal = Depends(get_current_user)):
+    if generation_cache is None:
+        return {"enabled": False}
+    stats = {"enabled": True, **generation_cache.stats}
+    if semantic_cache is not None:
+        stats["semantic"] = {"threshold": semantic_cache.threshold, **semantic_cache.stats}
+    return stats
+
+
+def sse_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@router.post("/generate-template/stream")
+async def generate_template_stream(
+    request: TemplateRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    """
+    Server-sent events variant of /generate-template.
+
+    Emits `token` events with text as it is generated, then a single `done`
+    or `error` event. A user out of quota gets a 403 up front, but the
+    quota is only held once the stream starts, so a client that goes away
+    before that leaves no hold behind; losing the race for the last of the
+    quota then shows up as an `error` event. The hold is settled to the
+    tokens actually used when the stream ends, including when the client
+    disconnects midway.
+    """
+    if request.template_type not in TEXT_TEMPLATE_TYPES:
+        raise HTTPException(status_code=400, detail="Unsupported template type")
+
+    prompt_tokens = estimate_prompt_tokens(request.template_type, request.details)
+    max_tokens, hold = await plan_generation(current_user, db, prompt_tokens)
+
+    async def event_stream():
+        meter = TokenMeter()
+        day = None
+        try:
+            async with AsyncSessionLocal() as session:
+                day = await reserve_quota(current_user, session, hold)
+            async for text in stream_text_template(
+                request.template_type,
+                request.details,
+                user_id=current_user.id,
+                use_cache=request.use_cache,
+                max_tokens=max_tokens,
+                meter=meter,
+            ):
+                yield sse_event("token", {"text": text})
+            yield sse_event("done", {"type": request.template_type})
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail})
+        except Exception as e:
+            yield sse_event("error", {"detail": f"Error generating template: {str(e)}"})
+        finally:
+            # Shielded so a client disconnect cannot cancel the settlement halfway
+            if day is not None:
+                await asyncio.shield(settle_quota(current_user, hold, day, meter))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def generate_batch_item(
+    index: int,
+    request: TemplateRequest,
+    user_id: int,
+    semaphore: asyncio.Semaphore,
+    max_tokens: int,
+    meter: TokenMeter,
+) -> dict:
+    async with semaphore:
+        try:
+            generated = await generate_text_template(
+                request.template_type,
+                request.details,
+                user_id=user_id,
+                use_cache=request.use_cache,
+                max_tokens=max_tokens,
+                meter=meter,
+            )
+            return {"index": index, "status": "ok", "generated_template": generated}
+        except HTTPException as e:
+            return {"index": index, "status": "error", "status_code": e.status_code, "detail": e.detail}
+        except Exception as e:
+            return {"index": index, "status": "error", "status_code": 500, "detail": f"Error generating template: {str(e)}"}
+
+
+@router.post("/generate-template/batch")
+async def generate_template_batch(
+    request: BatchTemplateRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    """
+    Generates many templates in one request, streamed back as NDJSON.
+
+    Quota for all valid items is held in one charge before anything runs,
+    with the remaining budget split evenly into per-item completion caps.
+    Items are generated concurrently (at most BATCH_MAX_CONCURRENCY at a
+    time) and each result line is written as soon as it finishes, tagged
+    with the item's `index`. A failed item produces an `error` line. The
+    hold is settled once, to the tokens the whole batch actually used; the
+    last line is a `done` summary.
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="Batch is empty")
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch is limited to {BATCH_MAX_ITEMS} items")
+
+    valid = [i for i, item in enumerate(request.items) if item.template_type in TEXT_TEMPLATE_TYPES]
+    max_tokens, hold, day = 0, 0, None
+    if valid:
+        prompt_tokens = sum(
+            estimate_prompt_tokens(request.items[i].template_type, request.items[i].details) for i in valid
+        )
+        max_tokens, hold, day = await reserve_generation(current_user, db, prompt_tokens, count=len(valid))
+
+    async def results():
+        semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+        meter = TokenMeter()
+        tasks = [
+            asyncio.create_task(
+                generate_batch_item(i, request.items[i], current_user.id, semaphore, max_tokens, meter)
+            )
+            for i in valid
+        ]
+        succeeded = 0
+        try:
+            for i, item in enumerate(request.items):
+                if item.template_type not in TEXT_TEMPLATE_TYPES:
+                    yield json.dumps({"index": i, "status": "error", "status_code": 400, "detail": "Unsupported template type"}) + "\n"
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if result["status"] == "ok":
+                    succeeded += 1
+                yield json.dumps(result) + "\n"
+            yield json.dumps({"status": "done", "succeeded": succeeded, "failed": len(request.items) - succeeded}) + "\n"
+        finally:
+            # On disconnect stop the rest, then charge only what was used
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.shield(settle_quota(current_user, hold, day, meter))
+
+    return StreamingResponse(
+        results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/generate-image-template", response_model=ImageResponse)
-async def generate_image_template_route(request: ImageRequest,
-                     db: Session = Depends(get_db),current_user: User = Depends(get_current_user)):
+async def generate_image_template_route(request: ImageRequest, http_request: Request,
+                     db: AsyncSession = Depends(get_db),current_user: Principal = Depends(get_current_user)):
     
-    try :
-      token_usage= get_or_create_token_usage(current_user, db)
-      if token_usage.tokens_used + TOKENS_PER_OUTPUT > FREE_TOKEN_LIMIT:
-        raise HTTPException(status_code=403, detail="Token limit reached.")
-    except HTTPException:
-        raise
+    if request.size not in IMAGE_SIZES:
+        raise HTTPException(status_code=400, detail="Unsupported image size")
+    day = await reserve_quota(current_user, db, TOKENS_PER_IMAGE)
     try:
-        image_url= generate_image_template(request.prompt)
+        try:
+            digest = await generate_image_template(
+                request.prompt, style=request.style, size=request.size, user_id=current_user.id
+            )
+        except BaseException:
+            await asyncio.shield(refund_quota(current_user, TOKENS_PER_IMAGE, day))
+            raise
+        image_url = str(http_request.url_for("get_image", digest=digest))
         return ImageResponse(image_url=image_url)  # ✅ Correct
  # Return structured image JSON (type, data)
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating image: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error generating image: {str(e)}")
+
+
+def image_job_response(job, http_request: Request) -> ImageJobResponse:
+    return ImageJobResponse(
+        job_id=job.id,
+        status=job.status,
+        status_url=str(http_request.url_for("get_image_job", job_id=job.id)),
+        image_url=job.image_url if job.status == "succeeded" else None,
+        saved_output_id=job.saved_output_id,
+        error=job.error,
+        created_at=job.created_at,
+        finished_at=job.finished_at,
+    )
+
+
+@router.post("/image-jobs", response_model=ImageJobResponse, status_code=202)
+async def create_image_job(
+    request: ImageJobRequest,
+    http_request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    Queues an image generation and returns at once with the job's status URL.
+
+    Quota is held when the job is queued and refunded if it fails. With
+    `auto_save` the finished image is also added to the user's saved outputs.
+    """
+    if request.size not in IMAGE_SIZES:
+        raise HTTPException(status_code=400, detail="Unsupported image size")
+    if await crud.count_unfinished_image_jobs(db, current_user.id) >= IMAGE_JOB_MAX_PENDING_PER_USER:
+        raise HTTPException(status_code=429, detail="Too many image jobs in progress")
+    day = await reserve_quota(current_user, db, TOKENS_PER_IMAGE)
+    try:
+        digest = image_request_digest(request.prompt, request.style, request.size)
+        job = await crud.create_image_job(
+            db,
+            uuid.uuid4().hex,
+            current_user.id,
+            request.prompt,
+            request.style,
+            request.size,
+            str(http_request.url_for("get_image", digest=digest)),
+            request.auto_save,
+            TOKENS_PER_IMAGE,
+        )
+    except BaseException:
+        await asyncio.shield(refund_quota(current_user, TOKENS_PER_IMAGE, day))
+        raise
+    image_jobs.notify()
+    return image_job_response(job, http_request)
+
+
+@router.get("/image-jobs/{job_id}", response_model=ImageJobResponse, name="get_image_job")
+async def get_image_job(
+    job_id: str,
+    http_request: Request,
+    wait: float = Query(0, ge=0, le=IMAGE_JOB_MAX_WAIT_SECONDS),
+    current_user: Principal = Depends(get_current_user),
+):
+    """
+    Status of an image job. With `wait` the request long-polls: it returns
+    as soon as the job finishes, or after `wait` seconds at the latest.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        # A short session per check, so no connection is held while waiting
+        async with AsyncSessionLocal() as db:
+            job = await crud.get_image_job(db, current_user.id, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Image job not found")
+        remaining = deadline - loop.time()
+        if job.status in FINISHED_STATUSES or remaining <= 0:
+            return image_job_response(job, http_request)
+        # Jobs finishing in another process are only seen by polling
+        await image_jobs.wait(job.id, min(remaining, IMAGE_JOB_POLL_SECONDS))
+
+
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def parse_byte_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    Parses a single `bytes=` Range header into an inclusive (start, end) pair.
+
+    Returns None when the whole file should be sent: no header, a form we do
+    not serve such as multiple ranges, or an invalid range like "bytes=5-3",
+    which is ignored as RFC 9110 asks. Raises 416 only for a valid range
+    that cannot be satisfied: one starting past the end of the file, or an
+    empty suffix ("bytes=-0").
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            suffix = int(end_text)
+            start = size - suffix if suffix > 0 else size
+            end = size - 1
+    except ValueError:
+        return None
+    if start_text and end_text and end < start:
+        return None
+    start = max(start, 0)
+    end = min(end, size - 1)
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def iter_file(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(IMAGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_response(path: str, etag: str, range_header: str | None, if_none_match: str | None):
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL})
+    size = os.path.getsize(path)
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    byte_range = parse_byte_range(range_header, size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(iter_file(path, 0, size), media_type="image/png", headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file(path, start, end - start + 1), status_code=206, media_type="image/png", headers=headers
+    )
+
+
+# Image URLs are digests keyed with IMAGE_DIGEST_SECRET, which cannot be
+# derived from a prompt, so they are served without auth (an <img> tag
+# cannot send the bearer token)
+@router.get("/images/{digest}", name="get_image")
+def get_image(
+    digest: str,
+    range_header: str | None = Header(None, alias="Range"),
+    if_none_match: str | None = Header(None),
+):
+    if not is_digest(digest) or not image_store.exists(digest):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return file_response(image_store.path(digest), f'"{digest}"', range_header, if_none_match)
+
+
+@router.get("/images/{digest}/thumbnail")
+async def get_image_thumbnail(
+    digest: str,
+    width: int = Query(256),
+    range_header: str | None = Header(None, alias="Range"),
+    if_none_match: str | None = Header(None),
+):
+    if width not in THUMBNAIL_WIDTHS:
+        raise HTTPException(
+            status_code=400, detail=f"width must be one of {', '.join(map(str, THUMBNAIL_WIDTHS))}"
+        )
+    if not is_digest(digest) or not image_store.exists(digest):
+        raise HTTPException(status_code=404, detail="Image not found")
+    try:
+        path = await image_store.thumbnail(digest, width)
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Thumbnails require Pillow to be installed")
+    return file_response(path, f'"{digest}-w{width}"', range_header, if_none_match)
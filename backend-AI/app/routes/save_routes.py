@@ -1,57 +1,233 @@
-from fastapi import Depends, HTTPException, APIRouter
-from models import User, SavedOutput
-from sqlalchemy.orm import Session
+import base64
+import html
+import json
+from fastapi import Depends, HTTPException, APIRouter, Query, Header, Response
+from utils.principal_cache import Principal
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
-from models import UserToken
-from schemas import SavedOutputSchema, SaveOutputRequest
-from fastapi.security import OAuth2PasswordBearer
+from schemas import (
+    SavedOutputSchema,
+    SaveOutputRequest,
+    SavedOutputPage,
+    SavedOutputPreview,
+    SavedOutputDetail,
+    BulkSaveOutputRequest,
+    SavedOutputRef,
+    SavedOutputSearchHit,
+    SavedOutputSearchPage,
+)
+import crud
 import os
-from datetime import date, datetime
-from dotenv import load_dotenv
+from datetime import datetime
+import settings  # noqa: F401  (loads .env)
 from dependencies import get_current_user
+from utils.responses import data_etag, etag_matches, not_modified, set_etag
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
-load_dotenv()
+ALLOWED_TYPES = {"blog_post", "email_draft", "image"}
+BULK_SAVE_MAX_ITEMS = int(os.getenv("BULK_SAVE_MAX_ITEMS", "1000"))
 
-SECRET_KEY = os.environ.get("SECRET_KEY")
-ALGORITHM = os.environ.get("ALGORITHM")
-FREE_TOKEN_LIMIT = 100
-TOKENS_PER_OUTPUT = 1
+# Listing page sizes and how much of each output the listing shows
+OUTPUTS_PAGE_SIZE = int(os.getenv("OUTPUTS_PAGE_SIZE", "20"))
+OUTPUTS_MAX_PAGE_SIZE = int(os.getenv("OUTPUTS_MAX_PAGE_SIZE", "100"))
+OUTPUT_PREVIEW_CHARS = int(os.getenv("OUTPUT_PREVIEW_CHARS", "200"))
+
+# Search snippets: matches are marked with control characters by ts_headline
+# and turned into <mark> tags after the snippet has been HTML-escaped
+SEARCH_QUERY_MAX_CHARS = 256
+SNIPPET_START, SNIPPET_STOP = "\x02", "\x03"
+SNIPPET_OPTIONS = (
+    f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxWords=35, MinWords=15, "
+    'MaxFragments=2, FragmentDelimiter=" … "'
+)
 
 @router.post("/save-output", response_model=SavedOutputSchema)
-def save_output(
+async def save_output(
     data: SaveOutputRequest,
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        allowed_types = {"blog_post", "email_draft", "image"}
-        if data.template_type not in allowed_types:
+        if data.template_type not in ALLOWED_TYPES:
             raise HTTPException(status_code=400, detail="Unsupported template type")
 
         # --- REMOVE TOKEN LIMIT CHECKS HERE ---
         # No token usage or limit logic for saving output
 
         # Save generated content in SavedOutput table
-        new_output = SavedOutput(
-            user_id=user.id,
-            template_type=data.template_type,
-            content=data.content,
-            created_at=datetime.now()
+        [new_output] = await crud.create_outputs(
+            db, user.id, [(data.template_type, data.content)], datetime.now()
         )
-        db.add(new_output)
-        db.commit()
-        db.refresh(new_output)
 
         # Return the saved output using the new schema
         return SavedOutputSchema(
             template_type=new_output.template_type,
-            content=new_output.content,
+            content=data.content,
             created_at=new_output.created_at
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error saving output: {str(e)}")
+
+
+@router.post("/save-outputs", response_model=list[SavedOutputRef])
+async def save_outputs(
+    data: BulkSaveOutputRequest,
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Saves many outputs at once: all items are validated first, then inserted
+    in a single transaction. Either every item is saved or none is.
+    """
+    if not data.items:
+        raise HTTPException(status_code=400, detail="No outputs to save")
+    if len(data.items) > BULK_SAVE_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_SAVE_MAX_ITEMS} outputs can be saved at once")
+    invalid = [i for i, item in enumerate(data.items) if item.template_type not in ALLOWED_TYPES]
+    if invalid:
+        raise HTTPException(status_code=400, detail={"message": "Unsupported template type", "indexes": invalid})
+
+    try:
+        rows = await crud.create_outputs(
+            db, user.id, [(item.template_type, item.content) for item in data.items], datetime.now()
+        )
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error saving outputs: {str(e)}")
+    return [SavedOutputRef(id=row.id, template_type=row.template_type, created_at=row.created_at) for row in rows]
+
+
+# Opaque pagination cursor holding the (created_at, id) of a page's last row
+def pack_cursor(values: list) -> str:
+    raw = json.dumps(values).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def unpack_cursor(cursor: str) -> list:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    return json.loads(raw)
+
+
+def encode_cursor(created_at: datetime, output_id: int) -> str:
+    return pack_cursor([created_at.isoformat(), output_id])
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, output_id = unpack_cursor(cursor)
+        return datetime.fromisoformat(created_at), int(output_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def decode_search_cursor(cursor: str) -> tuple:
+    try:
+        rank, output_id = unpack_cursor(cursor)
+        return float(rank), int(output_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def render_snippet(headline: str) -> str:
+    escaped = html.escape(headline, quote=False)
+    return escaped.replace(SNIPPET_START, "<mark>").replace(SNIPPET_STOP, "</mark>")
+
+
+# Declared before /outputs/{output_id} so "search" is not taken for an id
+@router.get("/outputs/search", response_model=SavedOutputSearchPage)
+async def search_outputs(
+    q: str = Query(..., min_length=1, max_length=SEARCH_QUERY_MAX_CHARS),
+    cursor: str | None = None,
+    limit: int = Query(OUTPUTS_PAGE_SIZE, ge=1, le=OUTPUTS_MAX_PAGE_SIZE),
+    template_type: str | None = None,
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Full-text search over the user's saved outputs, best match first.
+
+    `q` takes web search syntax: "quoted phrases", OR, and -excluded words.
+    Each hit carries an HTML-escaped snippet with the matches in <mark> tags.
+    """
+    after = decode_search_cursor(cursor) if cursor else None
+    # One extra row tells us whether there is a next page
+    hits = await crud.search_outputs(
+        db, user.id, q, limit + 1, SNIPPET_OPTIONS, after=after, template_type=template_type
+    )
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        last = hits[-1][0]
+        next_cursor = pack_cursor([last.rank, last.id])
+    items = [
+        SavedOutputSearchHit(
+            id=row.id,
+            template_type=row.template_type,
+            snippet=render_snippet(headline),
+            rank=row.rank,
+            created_at=row.created_at,
+        )
+        for row, headline in hits
+    ]
+    return SavedOutputSearchPage(items=items, next_cursor=next_cursor)
+
+
+@router.get("/outputs", response_model=SavedOutputPage)
+async def list_outputs(
+    response: Response,
+    cursor: str | None = None,
+    limit: int = Query(OUTPUTS_PAGE_SIZE, ge=1, le=OUTPUTS_MAX_PAGE_SIZE),
+    template_type: str | None = None,
+    if_none_match: str | None = Header(None),
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    before = decode_cursor(cursor) if cursor else None
+    # Read before the rows, so a concurrent save can only make the ETag older than the page
+    version = await crud.get_data_version(db, user.id)
+    etag = data_etag("outputs", user.id, version, cursor, limit, template_type, OUTPUT_PREVIEW_CHARS)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    # One extra row tells us whether there is a next page
+    rows = await crud.list_output_previews(
+        db, user.id, limit + 1, OUTPUT_PREVIEW_CHARS, before=before, template_type=template_type
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    items = [
+        SavedOutputPreview(
+            id=row.id,
+            template_type=row.template_type,
+            preview=row.preview,
+            content_bytes=row.content_bytes,
+            truncated=row.content_bytes > len(row.preview.encode("utf-8")),
+            created_at=row.created_at,
+        )
+        for row in rows
+    ]
+    set_etag(response, etag)
+    return SavedOutputPage(items=items, next_cursor=next_cursor)
+
+
+@router.get("/outputs/{output_id}", response_model=SavedOutputDetail)
+async def get_output(
+    output_id: int,
+    user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    output = await crud.get_output(db, user.id, output_id)
+    if output is None:
+        raise HTTPException(status_code=404, detail="Output not found")
+    return SavedOutputDetail(
+        id=output.id,
+        template_type=output.template_type,
+        content=output.content,
+        created_at=output.created_at,
+    )
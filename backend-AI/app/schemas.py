@@ -1,6 +1,6 @@
 from pydantic import BaseModel 
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 # Create schemas for user sign in and user  sign up 
 class UserCreate(BaseModel):
@@ -26,6 +26,11 @@ class Token(BaseModel):
 class TemplateRequest(BaseModel):
     template_type: str  # e.g., "blog_post", "email_draft"
     details: str  # e.g., "Write a blog post about AI technology"
+    use_cache: bool = True  # set False to force a fresh generation
+
+
+class BatchTemplateRequest(BaseModel):
+    items: List[TemplateRequest]  # generated concurrently, results streamed as NDJSON
 
 class SavedOutputSchema(BaseModel):
     template_type: str
@@ -41,6 +46,16 @@ class SaveOutputRequest(BaseModel):
     
     class Config:
         orm_mode = True  # This allows Pydantic to read data from SQLAlchemy models
+class BulkSaveOutputRequest(BaseModel):
+    items: List[SaveOutputRequest]  # saved together in one transaction
+
+
+class SavedOutputRef(BaseModel):
+    id: int
+    template_type: str
+    created_at: datetime
+
+
 class UserProfile(BaseModel):
     id: int
     email: str
@@ -54,4 +69,55 @@ class ImageResponse(BaseModel):
     image_url: str  # URL of the generated image
     
 class ImageRequest(BaseModel):
-    prompt: str
\ No newline at end of file
+    prompt: str
+    style: str = "product"  # one of "product", "art", "fantasy"
+    size: str = "1024x1024"
+
+
+class ImageJobRequest(ImageRequest):
+    auto_save: bool = False  # add the image to saved outputs once it is ready
+
+
+class ImageJobResponse(BaseModel):
+    job_id: str
+    status: str  # "queued", "running", "succeeded" or "failed"
+    status_url: str
+    image_url: Optional[str] = None  # set once the job succeeded
+    saved_output_id: Optional[int] = None
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+
+class SavedOutputPreview(BaseModel):
+    id: int
+    template_type: str
+    preview: str  # first characters of the content
+    content_bytes: int  # size of the full content in bytes
+    truncated: bool
+    created_at: datetime
+
+
+class SavedOutputPage(BaseModel):
+    items: List[SavedOutputPreview]
+    next_cursor: Optional[str] = None  # pass back as `cursor` for the next page
+
+
+class SavedOutputSearchHit(BaseModel):
+    id: int
+    template_type: str
+    snippet: str  # HTML-escaped excerpt with matches wrapped in <mark></mark>
+    rank: float
+    created_at: datetime
+
+
+class SavedOutputSearchPage(BaseModel):
+    items: List[SavedOutputSearchHit]
+    next_cursor: Optional[str] = None  # pass back as `cursor` for the next page
+
+
+class SavedOutputDetail(BaseModel):
+    id: int
+    template_type: str
+    content: str
+    created_at: datetime
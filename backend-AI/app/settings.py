@@ -0,0 +1,29 @@
+# Application settings
+# .env is loaded here, once; modules import this before reading os.environ
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Database
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USERNAME")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+
+# JWT
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+
+# OpenAI
+OPENAI_API_KEY = os.getenv("OPEN_API_KEY")
+# Point at another OpenAI-compatible server, e.g. benchmarks/fake_openai.py
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Longest completion a text generation may ask for; also sizes its quota hold
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", "1500"))
+
+# Build LangChain/OpenAI clients in the background at startup instead of on the first request
+WARM_UP_CLIENTS = os.getenv("WARM_UP_CLIENTS", "true").lower() == "true"
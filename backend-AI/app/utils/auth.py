@@ -1,86 +1,102 @@
 import jwt 
-from datetime import datetime, timedelta 
-from fastapi import HTTPException, Depends, status 
-from sqlalchemy.orm import Session 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
 from passlib.context import CryptContext 
-import crud, models, database
+import database
 import os 
-from dotenv import load_dotenv
+import settings
 from jwt import PyJWTError
 
-load_dotenv() # Load environment variables 
-
 # Secret key for encoding and decoding JWT
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+SECRET_KEY = settings.SECRET_KEY
+ALGORITHM = settings.ALGORITHM
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.ACCESS_TOKEN_EXPIRE_MINUTES
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-# Function to hash password
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# bcrypt is CPU-bound and releases the GIL, so it runs on a small thread pool
+# instead of the event loop; 0 workers hashes inline (e.g. for scripts)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+
+class PasswordHasher:
+    """
+    Runs password hashing on a bounded worker pool.
+
+    At most `max_queue` hash/verify calls may be running or waiting at once;
+    beyond that callers get a 503 immediately instead of queueing behind a
+    login storm.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.stats = {"completed": 0, "rejected": 0}
+        self._pending = 0
+        self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def run(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        if self._pending >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication is busy, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+            self.stats["completed"] += 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.run(pwd_context.hash, password)
 
 # Dependancy to get database session 
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+get_db = database.get_db
+
 
-# Verify if password matches 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    """
+    Returns (valid, new_hash); new_hash is set when the stored hash uses
+    deprecated settings and should be replaced.
+    """
+    return await password_hasher.run(pwd_context.verify_and_update, plain_password, hashed_password)
 
 
 # Create JWT token for the authenticated user 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode=data.copy()
+    # PyJWT reads naive datetimes as UTC, so build the expiry in UTC explicitly
     if expires_delta:
-        expire = datetime.now()+ expires_delta
+        expire = datetime.now(timezone.utc)+ expires_delta
     else:
-        expire=datetime.now()+ timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire=datetime.now(timezone.utc)+ timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
     
-# Register User
-def register_user(db: Session, email: str, username: str, password: str):
-    # Check if email exists
-    db_user = crud.get_user_by_email(db, email=email)
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-
-    # Check if username exists
-    db_username = crud.get_user_by_username(db, username=username)
-    if db_username:
-        raise HTTPException(status_code=400, detail="Username already taken")
-
-    # Hash the password and create the user
-    hashed_password = get_password_hash(password)
-    user = crud.create_user(db, email=email, username=username, password=hashed_password)
-    return user
-
-# Login User
-def login_user(db: Session, password: str, username: str = None, email: str = None):
-    if email:
-        user = crud.get_user_by_email(db, email=email)
-    elif username:
-        user = crud.get_user_by_username(db, username=username)
-    else:
-        raise HTTPException(status_code=400, detail="Username or email must be provided")
-
-    if not user or not verify_password(password, user.hashed_password):
-        raise HTTPException(status_code=400, detail="Incorrect email/username or password")
-
-    # Generate a JWT token (assuming you have create_access_token method available)
-    access_token_expires = timedelta(minutes=30)
-    access_token = create_access_token(data={"sub": user.email}, expires_delta=access_token_expires)
-    return {"access_token": access_token, "token_type": "bearer"}
-                         
-                                     
-# Verify JWT token
+# Verify JWT token (get_current_user and the middlewares' bearer_subject both decode through here)
 def verify_token(token: str):
     credentials_exception = HTTPException(
         status_code=401, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"}
@@ -0,0 +1,108 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:  # optional; only gzip is offered when it is missing
+    brotli = None
+
+from utils.idempotency import STREAMING_TYPES
+
+# Content types worth compressing; images are compressed already
+COMPRESSIBLE_TYPES = (b"application/json", b"text/")
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    """
+    Best encoding we support from an Accept-Encoding header: "br", "gzip" or None.
+    """
+    weights = {}
+    for entry in accept_encoding.split(","):
+        name, _, params = entry.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        weights[name.strip().lower()] = quality
+    wildcard = weights.get("*", 0.0)
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_quality = None, 0.0
+    for encoding in offered:
+        quality = weights.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing response bodies with brotli or gzip.
+
+    Only responses sent in a single body message are compressed, which is
+    every regular JSON response; streamed responses pass through untouched,
+    so nothing is buffered. STREAMING_TYPES (server-sent events, NDJSON) are
+    not even held back for their first body message. Bodies smaller than
+    `minimum_size`, content types outside COMPRESSIBLE_TYPES and responses
+    that already carry a Content-Encoding are left alone.
+
+    Attributes:
+        minimum_size (int): Smallest body, in bytes, that is compressed.
+        gzip_level (int): gzip compression level, 1-9.
+        brotli_quality (int): brotli quality, 0-11; the top levels are far
+            too slow for per-request use.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                encoding = choose_encoding(value.decode("latin-1"))
+                break
+        start = None
+
+        async def send_wrapper(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                content_type = next((v for k, v in headers if k == b"content-type"), b"")
+                if (content_type.startswith(COMPRESSIBLE_TYPES)
+                        and not content_type.startswith(STREAMING_TYPES)
+                        and not any(k == b"content-encoding" for k, _ in headers)):
+                    # Hold the start until we know whether the body gets compressed
+                    start = message
+                    return
+            elif message["type"] == "http.response.body" and start is not None:
+                held, start = start, None
+                body = message.get("body", b"")
+                headers = [(k, v) for k, v in held.get("headers", []) if k != b"vary"]
+                vary = [v for k, v in held.get("headers", []) if k == b"vary"]
+                headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+                if encoding is not None and not message.get("more_body", False) and len(body) >= self.minimum_size:
+                    body = self._compress(encoding, body)
+                    headers = [(k, v) for k, v in headers if k != b"content-length"]
+                    headers += [
+                        (b"content-encoding", encoding.encode("ascii")),
+                        (b"content-length", str(len(body)).encode("ascii")),
+                    ]
+                    message = {**message, "body": body}
+                await send({**held, "headers": headers})
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _compress(self, encoding: str, body: bytes) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
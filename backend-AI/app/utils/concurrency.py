@@ -0,0 +1,95 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+
+async def call_backend(backend, method: str, *args):
+    """
+    Calls `backend.<method>(*args)`, in a worker thread if the backend blocks.
+
+    Shared-store backends (the SQLite stand-ins) set `blocking = True`: their
+    calls wait on file locks and disk I/O, which must not stall the event loop.
+    """
+    call = getattr(backend, method)
+    if getattr(backend, "blocking", False):
+        return await asyncio.to_thread(call, *args)
+    return call(*args)
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the number of in-flight upstream calls, globally and per user.
+
+    Callers wait for a free slot; if none frees up within `queue_timeout`
+    seconds the request is rejected with a 503 instead of piling up.
+
+    Attributes:
+        global_limit (int): Maximum concurrent calls across all users.
+        per_user_limit (int): Maximum concurrent calls for a single user.
+        queue_timeout (float): Seconds to wait for a slot before giving up.
+    """
+
+    def __init__(self, global_limit: int, per_user_limit: int, queue_timeout: float):
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self.queue_timeout = queue_timeout
+        self._global = asyncio.Semaphore(global_limit)
+        # user_id -> [semaphore, number of holders/waiters]
+        self._users: dict = {}
+
+    async def _acquire(self, semaphore: asyncio.Semaphore, wait: bool = True):
+        if not wait and semaphore.locked():
+            raise HTTPException(status_code=503, detail="Generation capacity exhausted, try again shortly")
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Generation capacity exhausted, try again shortly")
+
+    def _forget(self, user_id, entry):
+        # Drop idle per-user semaphores so the map stays bounded
+        entry[1] -= 1
+        if entry[1] == 0:
+            self._users.pop(user_id, None)
+
+    async def acquire(self, user_id=None, wait: bool = True):
+        """
+        Takes a slot and returns the function that gives it back.
+
+        With `wait=False` a 503 is raised at once when no slot is free.
+        """
+        entry = None
+        if user_id is not None:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = [asyncio.Semaphore(self.per_user_limit), 0]
+            entry[1] += 1
+        try:
+            if entry is not None:
+                await self._acquire(entry[0], wait)
+            try:
+                await self._acquire(self._global, wait)
+            except BaseException:
+                if entry is not None:
+                    entry[0].release()
+                raise
+        except BaseException:
+            if entry is not None:
+                self._forget(user_id, entry)
+            raise
+
+        def release():
+            self._global.release()
+            if entry is not None:
+                entry[0].release()
+                self._forget(user_id, entry)
+
+        return release
+
+    @asynccontextmanager
+    async def slot(self, user_id=None):
+        release = await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            release()
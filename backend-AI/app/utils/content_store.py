@@ -0,0 +1,64 @@
+import hashlib
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib is used when it is missing
+    zstandard = None
+
+# Texts shorter than this (in UTF-8 bytes) are stored as they are
+CONTENT_COMPRESS_MIN_BYTES = int(os.getenv("CONTENT_COMPRESS_MIN_BYTES", "256"))
+# 'zstd' or 'zlib'; zstd falls back to zlib when zstandard is not installed
+CONTENT_COMPRESSION = os.getenv("CONTENT_COMPRESSION", "zstd")
+CONTENT_COMPRESSION_LEVEL = int(os.getenv("CONTENT_COMPRESSION_LEVEL", "6"))
+# Leading characters kept uncompressed next to each blob, for listings
+CONTENT_PREVIEW_CHARS = int(os.getenv("CONTENT_PREVIEW_CHARS", "256"))
+
+_zstd_compressor = None
+_zstd_decompressor = None
+
+
+def _compress(raw: bytes) -> tuple:
+    global _zstd_compressor
+    if CONTENT_COMPRESSION == "zstd" and zstandard is not None:
+        if _zstd_compressor is None:
+            _zstd_compressor = zstandard.ZstdCompressor(level=CONTENT_COMPRESSION_LEVEL)
+        return "zstd", _zstd_compressor.compress(raw)
+    return "zlib", zlib.compress(raw, CONTENT_COMPRESSION_LEVEL)
+
+
+def encode(content: str) -> dict:
+    """
+    Column values of the content_blobs row for `content`.
+
+    Compressed data is only kept when it is actually smaller.
+    """
+    raw = content.encode("utf-8")
+    encoding, data = "raw", raw
+    if len(raw) >= CONTENT_COMPRESS_MIN_BYTES:
+        compressed_encoding, compressed = _compress(raw)
+        if len(compressed) < len(raw):
+            encoding, data = compressed_encoding, compressed
+    return {
+        "digest": hashlib.sha256(raw).hexdigest(),
+        "encoding": encoding,
+        "data": data,
+        "size": len(raw),
+        "preview": content[:CONTENT_PREVIEW_CHARS],
+    }
+
+
+def decode(encoding: str, data: bytes) -> str:
+    global _zstd_decompressor
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading zstd-compressed content requires zstandard to be installed")
+        if _zstd_decompressor is None:
+            _zstd_decompressor = zstandard.ZstdDecompressor()
+        raw = _zstd_decompressor.decompress(data)
+    elif encoding == "zlib":
+        raw = zlib.decompress(data)
+    else:
+        raw = data
+    return bytes(raw).decode("utf-8")
@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from utils.concurrency import call_backend
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    Normalizes user input so trivially different prompts share a cache key.
+    """
+    return " ".join(text.split()).casefold()
+
+
+def make_cache_key(model: str, template_version: str, template_type: str, details: str) -> str:
+    raw = "\x1f".join([model, template_version, template_type, normalize_prompt(details)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class InMemoryCacheBackend:
+    """
+    Per-process LRU cache with a per-entry TTL.
+
+    Attributes:
+        max_entries (int): Entries kept before the least recently used is evicted.
+    """
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteCacheBackend:
+    """
+    Shared-store stand-in backed by a SQLite file.
+
+    Every uvicorn worker on the host pointing at the same file sees the same
+    entries, which is what a Redis/Memcached backend would give across hosts.
+    Expired entries are deleted, and the least recently used trimmed down to
+    `max_entries`, every `trim_every` writes. Calls block; GenerationCache
+    runs them in a worker thread.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 100_000, trim_every: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        self.trim_every = trim_every
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS generation_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_generation_cache_last_used ON generation_cache(last_used)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value, expires_at FROM generation_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            conn.execute("DELETE FROM generation_cache WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE generation_cache SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: float):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO generation_cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, value, now + ttl, now),
+        )
+        self._writes += 1
+        if self._writes % self.trim_every == 0:
+            conn.execute("DELETE FROM generation_cache WHERE expires_at < ?", (now,))
+            conn.execute(
+                "DELETE FROM generation_cache WHERE key IN ("
+                " SELECT key FROM generation_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        self._conn().execute("DELETE FROM generation_cache")
+
+
+class GenerationCache:
+    """
+    Exact-match cache for generations with single-flight deduplication.
+
+    Concurrent misses for the same key share one upstream call: the first
+    caller starts it as a task and everyone else awaits that task. The task
+    is shielded, so a disconnecting caller does not cancel it for the others.
+    Callers only share a call when they pass the same `flight` key, so
+    requests that would run it differently (e.g. under another completion
+    cap) each get their own.
+
+    Attributes:
+        stats (dict): Hit, miss and coalesced-request counters.
+    """
+
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "bypassed": 0}
+        self._inflight: dict = {}
+
+    async def get(self, key: str) -> str | None:
+        value = await self.peek(key)
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    async def peek(self, key: str) -> str | None:
+        # Lookup that is left out of the stats
+        return await call_backend(self.backend, "get", key)
+
+    async def set(self, key: str, value: str):
+        await call_backend(self.backend, "set", key, value, self.ttl)
+
+    async def get_or_generate(self, key: str, factory, use_cache: bool = True, flight=None, fallback=None) -> str:
+        """
+        Returns the cached value for `key`, or awaits `factory()` and caches its result.
+
+        `flight` identifies the upstream call for single-flight purposes and
+        defaults to `key`. On a miss, `fallback()` (e.g. a near-duplicate
+        lookup) is awaited before generating; a value it returns is served
+        as is.
+        """
+        if not use_cache:
+            # Skip the lookup but still refresh the stored entry
+            self.stats["bypassed"] += 1
+            return await self._generate(key, factory)
+
+        value = await self.peek(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+        if fallback is not None:
+            value = await fallback()
+            if value is not None:
+                return value
+
+        flight = key if flight is None else flight
+        task = self._inflight.get(flight)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._generate(key, factory))
+            self._inflight[flight] = task
+            task.add_done_callback(lambda done: self._on_done(flight, done))
+        return await asyncio.shield(task)
+
+    def _on_done(self, flight, task: asyncio.Task):
+        self._inflight.pop(flight, None)
+        # Mark the exception as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def _generate(self, key: str, factory) -> str:
+        value = await factory()
+        await self.set(key, value)
+        return value
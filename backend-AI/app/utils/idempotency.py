@@ -0,0 +1,418 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from utils import metrics
+from utils.concurrency import call_backend
+from utils.principal_cache import bearer_subject
+
+# Longest Idempotency-Key accepted; clients normally send a UUID
+MAX_KEY_LENGTH = 255
+
+# Streamed responses are forwarded as they come and never stored
+STREAMING_TYPES = (b"text/event-stream", b"application/x-ndjson")
+
+# Outcomes of IdempotencyStore.claim
+CLAIMED = "claimed"
+DONE = "done"
+PENDING = "pending"
+MISMATCH = "mismatch"
+
+
+@dataclass
+class StoredResponse:
+    """
+    Response captured for replay.
+
+    Attributes:
+        status (int): HTTP status code.
+        headers (list): (name, value) byte pairs, as in the ASGI message.
+        body (bytes): Complete response body.
+        streamed (bool): Whether the body was streamed straight to the
+            client instead of captured.
+    """
+    status: int
+    headers: list
+    body: bytes
+    streamed: bool = False
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(name) + len(value) for name, value in self.headers)
+
+
+def scoped_key(subject: str, path: str, key: str) -> str:
+    """
+    Storage key of an Idempotency-Key, so users and endpoints never share one.
+    """
+    raw = "\x1f".join([subject, path, key])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def request_fingerprint(scope, body: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in (scope["method"].encode("ascii"), scope["path"].encode("utf-8"), scope["query_string"]):
+        digest.update(part + b"\x1f")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class InMemoryIdempotencyBackend:
+    """
+    Per-process store of idempotency records with a per-entry TTL.
+
+    A record is pending (claimed, no response yet) until it is completed or
+    released. Records are kept in least-recently-used order and evicted from
+    the cold end once the stored responses add up to more than `max_bytes`.
+
+    Attributes:
+        max_bytes (int): Approximate memory allowed for stored responses.
+    """
+
+    # Rough per-record overhead of the dict entry, key and tuple
+    ENTRY_OVERHEAD = 300
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, fingerprint, StoredResponse | None)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def claim(self, key: str, fingerprint: str, lease: float) -> tuple:
+        """
+        Claims `key` for a new request, unless a live record exists.
+
+        Returns (outcome, response): CLAIMED, DONE with the stored response,
+        PENDING while another request holds the key, or MISMATCH when the key
+        was used for a different request.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= now:
+                self._entries.move_to_end(key)
+                if entry[1] != fingerprint:
+                    return MISMATCH, None
+                return (DONE, entry[2]) if entry[2] is not None else (PENDING, None)
+            self._store(key, (now + lease, fingerprint, None))
+        return CLAIMED, None
+
+    def complete(self, key: str, fingerprint: str, response: StoredResponse, ttl: float):
+        with self._lock:
+            self._store(key, (time.monotonic() + ttl, fingerprint, response))
+
+    def release(self, key: str):
+        with self._lock:
+            self._pop(key)
+
+    def _store(self, key: str, entry: tuple):
+        self._pop(key)
+        self._entries[key] = entry
+        self._bytes += self._size(entry)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= self._size(entry)
+
+    def _size(self, entry: tuple) -> int:
+        return self.ENTRY_OVERHEAD + (entry[2].size if entry[2] is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteIdempotencyBackend:
+    """
+    Shared-store stand-in backed by a SQLite file.
+
+    Every uvicorn worker on the host pointing at the same file sees the same
+    records, which is what a Redis backend would give across hosts. Claims
+    run in a write transaction, so only one worker gets a key. Expired
+    records are deleted, and the oldest trimmed down to `max_entries`,
+    every `trim_every` stored responses. Calls block; IdempotencyStore runs
+    them in a worker thread.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int = 100_000, trim_every: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        self.trim_every = trim_every
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+            " key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, expires_at REAL NOT NULL,"
+            " status INTEGER, headers TEXT, body BLOB, created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at ON idempotency_keys(created_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def claim(self, key: str, fingerprint: str, lease: float) -> tuple:
+        # Wall clock, since the records are shared between processes
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT fingerprint, expires_at, status, headers, body FROM idempotency_keys WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] >= now:
+                conn.execute("COMMIT")
+                if row[0] != fingerprint:
+                    return MISMATCH, None
+                if row[2] is None:
+                    return PENDING, None
+                headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(row[3])]
+                return DONE, StoredResponse(row[2], headers, row[4])
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                (key, fingerprint, now + lease, now),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return CLAIMED, None
+
+    def complete(self, key: str, fingerprint: str, response: StoredResponse, ttl: float):
+        now = time.time()
+        headers = json.dumps([(name.decode("latin-1"), value.decode("latin-1")) for name, value in response.headers])
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, expires_at, status, headers, body, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, fingerprint, now + ttl, response.status, headers, response.body, now),
+        )
+        self._writes += 1
+        if self._writes % self.trim_every == 0:
+            conn.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,))
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE key IN ("
+                " SELECT key FROM idempotency_keys ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def release(self, key: str):
+        self._conn().execute("DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL", (key,))
+
+
+class IdempotencyStore:
+    """
+    Runs each idempotent request once and replays its response.
+
+    Duplicates arriving while the original is still running wait for it: in
+    the same worker they await the original's task, which is shielded so a
+    disconnecting client does not cancel it; in other workers they poll the
+    backend until the record is completed or released, and take the key over
+    once the original's lease has run out.
+
+    Attributes:
+        ttl (float): Seconds a completed response is replayed.
+        lease (float): Seconds a claim holds the key before others may take it over.
+        poll_interval (float): Seconds between checks on a key held by another worker.
+    """
+
+    def __init__(self, backend, ttl: float, lease: float, poll_interval: float = 0.1):
+        self.backend = backend
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._inflight: dict = {}
+
+    async def run(self, key: str, fingerprint: str, handler, storable) -> tuple:
+        """
+        Returns (outcome, response) for the request identified by `key`, where
+        outcome is "executed", "coalesced", "replayed" or MISMATCH.
+
+        `handler()` runs the request and returns its StoredResponse. It is only
+        called when this request claims the key; the response is stored for
+        replay if `storable(response)` is true, otherwise the key is released.
+        The response is None for MISMATCH.
+        """
+        while True:
+            task = self._inflight.get(key)
+            if task is not None:
+                response, task_fingerprint = await asyncio.shield(task)
+                if task_fingerprint != fingerprint:
+                    return MISMATCH, None
+                return "coalesced", response
+            outcome, response = await call_backend(self.backend, "claim", key, fingerprint, self.lease)
+            if outcome == PENDING:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if outcome == DONE:
+                return "replayed", response
+            if outcome == MISMATCH:
+                return MISMATCH, None
+            task = asyncio.ensure_future(self._execute(key, fingerprint, handler, storable))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._on_done(key, done))
+            response, _ = await asyncio.shield(task)
+            return "executed", response
+
+    def _on_done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        # Mark the exception as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def _execute(self, key: str, fingerprint: str, handler, storable) -> tuple:
+        try:
+            response = await handler()
+        except BaseException:
+            await call_backend(self.backend, "release", key)
+            raise
+        if storable(response):
+            await call_backend(self.backend, "complete", key, fingerprint, response, self.ttl)
+        else:
+            await call_backend(self.backend, "release", key)
+        return response, fingerprint
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware honouring the Idempotency-Key header on selected POST routes.
+
+    Keys are scoped to the subject of a valid bearer token and the path;
+    requests without a verified user or without the header pass through
+    untouched. The first response for a key is stored and replayed, marked
+    with Idempotent-Replayed, for retries with the same key. Reusing a key
+    for a different body gets a 422. Server errors, 429s and responses over
+    `max_response_bytes` are not stored, so the client can retry them.
+
+    Streaming responses (STREAMING_TYPES) should not be listed in `paths`;
+    if one is, it is passed through to the client as it is produced and
+    not stored, and duplicates that arrived meanwhile get a 409.
+
+    Attributes:
+        paths (frozenset): Exact request paths the header is honoured on.
+        max_response_bytes (int): Largest response body that is stored.
+        principal_cache (PrincipalCache | None): Where verified token
+            subjects are looked up and kept, so tokens are decoded once.
+    """
+
+    def __init__(self, app, store: IdempotencyStore, paths, max_response_bytes: int = 256 * 1024,
+                 principal_cache=None):
+        self.app = app
+        self.store = store
+        self.paths = frozenset(paths)
+        self.max_response_bytes = max_response_bytes
+        self.principal_cache = principal_cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        key = None
+        for name, value in scope["headers"]:
+            if name == b"idempotency-key":
+                key = value.decode("latin-1").strip()
+                break
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            await self._error(send, 400, f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+            return
+        subject = bearer_subject(scope, self.principal_cache)
+        if subject is None:
+            # Let the route reject it as unauthenticated
+            await self.app(scope, receive, send)
+            return
+
+        body = await self._read_body(receive)
+        if body is None:
+            return
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        async def handler() -> StoredResponse:
+            response = StoredResponse(500, [], b"")
+            chunks = []
+
+            async def capture(message):
+                if message["type"] == "http.response.start":
+                    response.status = message["status"]
+                    response.headers = list(message.get("headers", []))
+                    content_type = next((v for k, v in response.headers if k == b"content-type"), b"")
+                    response.streamed = content_type.startswith(STREAMING_TYPES)
+                    if response.streamed:
+                        await send(message)
+                elif message["type"] == "http.response.body":
+                    if response.streamed:
+                        await send(message)
+                    else:
+                        chunks.append(message.get("body", b""))
+
+            await self.app(scope, replay_receive, capture)
+            response.body = b"".join(chunks)
+            return response
+
+        outcome, response = await self.store.run(
+            scoped_key(subject, scope["path"], key), request_fingerprint(scope, body), handler, self._storable
+        )
+        metrics.idempotent_requests.labels(outcome).inc()
+        if outcome == MISMATCH:
+            await self._error(send, 422, "Idempotency-Key was already used for a different request")
+            return
+        if response.streamed:
+            if outcome != "executed":
+                await self._error(send, 409, "The original request was streamed and cannot be replayed")
+            return
+        headers = response.headers
+        if outcome != "executed":
+            headers = headers + [(b"idempotent-replayed", b"true")]
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        await send({"type": "http.response.body", "body": response.body})
+
+    def _storable(self, response: StoredResponse) -> bool:
+        return (not response.streamed and response.status < 500 and response.status != 429
+                and len(response.body) <= self.max_response_bytes)
+
+    @staticmethod
+    async def _read_body(receive) -> bytes | None:
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _error(send, status: int, detail: str):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
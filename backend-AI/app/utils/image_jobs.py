@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import weakref
+
+from fastapi import HTTPException
+
+import crud
+from database import AsyncSessionLocal
+from utils import metrics
+from utils.openai_api import generate_image_template
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = ("succeeded", "failed")
+REFUND_ATTEMPTS = 3
+
+
+class ImageJobWorkers:
+    """
+    Background workers that run queued image generations.
+
+    The image_jobs table is the queue. Workers claim the oldest job in
+    Postgres, so every app process can run workers against the same queue.
+    A job left running by a process that died is claimed again once its
+    lease expires, and `max_running` caps running jobs across all processes.
+    Workers are woken by notify() when a job is submitted here. They also
+    poll every `poll_interval` seconds, which picks up jobs submitted to
+    other processes.
+
+    A job that fails gets its quota hold refunded through `refund(user_id, tokens, day)`.
+    One that is interrupted more than `max_attempts` times is failed. A worker
+    only finishes the attempt it claimed, so a job reclaimed after its lease
+    ran out is saved or refunded once.
+
+    Attributes:
+        workers (int): Worker tasks in this process.
+        max_running (int): Running jobs allowed across all processes.
+        lease_seconds (float): How long a claim is valid without the job finishing.
+        max_attempts (int): Claims per job before it is given up on.
+        poll_interval (float): Seconds between queue polls when idle.
+    """
+
+    def __init__(self, refund, workers: int, max_running: int, lease_seconds: float, max_attempts: int,
+                 poll_interval: float):
+        self.refund = refund
+        self.workers = workers
+        self.max_running = max_running
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._tasks: list = []
+        # job id -> event set when the job finishes in this process
+        self._finished: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def wait(self, job_id: str, timeout: float):
+        """
+        Waits up to `timeout` seconds for `job_id` to finish in this process.
+        """
+        event = self._finished.get(job_id)
+        if event is None:
+            event = self._finished[job_id] = asyncio.Event()
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _announce(self, job_id: str):
+        event = self._finished.get(job_id)
+        if event is not None:
+            event.set()
+
+    async def _claim(self):
+        async with AsyncSessionLocal() as db:
+            return await crud.claim_image_job(db, self.max_running, self.lease_seconds)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await self._claim()
+            except Exception:
+                logger.exception("Claiming an image job failed")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Another job may be waiting; let the next idle worker look too
+            self._wakeup.set()
+            await self._process(job)
+
+    async def _process(self, job):
+        if job.attempts > self.max_attempts:
+            await self._fail(job, "Image generation was interrupted too many times")
+            return
+        try:
+            await generate_image_template(job.prompt, style=job.style, size=job.size, user_id=job.user_id)
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back so the next start picks it up at once
+            await asyncio.shield(self._requeue(job.id))
+            raise
+        except HTTPException as e:
+            await self._fail(job, str(e.detail))
+            return
+        except Exception as e:
+            await self._fail(job, f"Image generation error: {str(e)}")
+            return
+        try:
+            async with AsyncSessionLocal() as db:
+                finished = await crud.complete_image_job(db, job)
+        except Exception:
+            # The image is stored; the job is retried once its lease runs out
+            logger.exception("Could not mark image job %s as succeeded", job.id)
+            return
+        if not finished:
+            logger.warning("Image job %s attempt %s was reclaimed before it finished", job.id, job.attempts)
+            return
+        metrics.image_jobs_finished.labels("succeeded").inc()
+        self._announce(job.id)
+
+    async def _fail(self, job, error: str):
+        try:
+            async with AsyncSessionLocal() as db:
+                finished = await crud.fail_image_job(db, job, error)
+        except Exception:
+            logger.exception("Could not mark image job %s as failed", job.id)
+            return
+        if not finished:
+            logger.warning("Image job %s attempt %s was reclaimed before it failed", job.id, job.attempts)
+            return
+        metrics.image_jobs_finished.labels("failed").inc()
+        self._announce(job.id)
+        await self._refund(job)
+
+    async def _refund(self, job):
+        # The job is already failed and will not be claimed again, so this is
+        # the only chance to hand its hold back
+        for attempt in range(1, REFUND_ATTEMPTS + 1):
+            try:
+                # The hold was charged when the job was queued
+                await self.refund(job.user_id, job.tokens, job.created_at.date())
+                return
+            except Exception:
+                if attempt == REFUND_ATTEMPTS:
+                    logger.exception("Could not refund %s tokens to user %s for failed image job %s",
+                                     job.tokens, job.user_id, job.id)
+                    return
+                await asyncio.sleep(0.5 * attempt)
+
+    async def _requeue(self, job_id: str):
+        try:
+            async with AsyncSessionLocal() as db:
+                await crud.requeue_image_job(db, job_id)
+        except Exception:
+            logger.exception("Could not requeue image job %s", job_id)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def close(self):
+        """
+        Stops the workers. Jobs they were running go back to the queue.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import hmac
+import io
+import os
+import tempfile
+
+# Thumbnail widths that are rendered; a fixed set keeps the files per image bounded
+THUMBNAIL_WIDTHS = (128, 256, 512)
+
+
+def image_digest(model: str, enhanced_prompt: str, style: str, size: str, secret: str) -> str:
+    """
+    Address of a generated image: an HMAC-SHA256 of the request keyed with
+    `secret`, so nobody can work out an image's URL from its prompt.
+    """
+    raw = "\x1f".join([model, style, size, enhanced_prompt])
+    return hmac.new(secret.encode("utf-8"), raw.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def is_digest(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+class ImageStore:
+    """
+    Content-addressed blob store for generated images on local disk.
+
+    Blobs live at <root>/<digest[:2]>/<digest>.png and are written atomically,
+    so a reader never sees a partial file. Directories are created on the
+    first write. Concurrent requests for the same digest share one
+    `produce()` call.
+
+    Attributes:
+        root (str): Directory the blobs are stored under.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._inflight: dict = {}
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}.png")
+
+    def thumbnail_path(self, digest: str, width: int) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}.w{width}.png")
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def _write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    async def get_or_produce(self, digest: str, produce) -> bool:
+        """
+        Ensures the blob for `digest` exists, awaiting `produce()` for its bytes if not.
+
+        Returns True when the blob was already stored.
+        """
+        if self.exists(digest):
+            return True
+        task = self._inflight.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self._produce(digest, produce))
+            self._inflight[digest] = task
+            task.add_done_callback(lambda done: self._on_done(digest, done))
+        await asyncio.shield(task)
+        return False
+
+    def _on_done(self, digest: str, task: asyncio.Task):
+        self._inflight.pop(digest, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def _produce(self, digest: str, produce):
+        data = await produce()
+        await asyncio.to_thread(self._write, self.path(digest), data)
+
+    async def thumbnail(self, digest: str, width: int) -> str:
+        """
+        Returns the path of a `width`-pixel-wide thumbnail, rendering it on first use.
+        """
+        path = self.thumbnail_path(digest, width)
+        if not os.path.exists(path):
+            await asyncio.to_thread(self._render_thumbnail, digest, width, path)
+        return path
+
+    def _render_thumbnail(self, digest: str, width: int, path: str):
+        from PIL import Image
+
+        with Image.open(self.path(digest)) as image:
+            height = max(1, round(image.height * width / image.width))
+            thumb = image.resize((width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            thumb.save(buffer, format="PNG", optimize=True)
+        self._write(path, buffer.getvalue())
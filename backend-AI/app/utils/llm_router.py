@@ -0,0 +1,266 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+
+from utils import metrics
+
+
+class LatencyTracker:
+    """
+    Rolling window of recent successful call latencies for one model.
+
+    Attributes:
+        window (int): Number of most recent samples kept.
+        min_samples (int): Samples needed before quantile() returns a value.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: deque = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class CircuitBreaker:
+    """
+    Stops sending traffic to a model that keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens for
+    `reset_timeout` seconds. Then a single trial call is let through
+    (half-open). If it succeeds the circuit closes; if it fails the circuit
+    opens again.
+
+    Attributes:
+        failure_threshold (int): Consecutive failures that open the circuit.
+        reset_timeout (float): Seconds the circuit stays open before a trial call.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        # A call let through by allow() ended without a verdict (e.g. it was cancelled)
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+    True for errors that say something about the provider's health:
+    timeouts, connection errors, 408/409/429 and 5xx. Other 4xx responses
+    are the request's fault; they are neither retried nor counted.
+    """
+    if isinstance(error, HTTPException):
+        # Raised by our own code; only an upstream timeout is the provider's doing
+        return error.status_code == 504
+    status = getattr(error, "status_code", None)
+    if status is None:
+        return True
+    return status in (408, 409, 429) or status >= 500
+
+
+class HedgedRouter:
+    """
+    Runs a call against an ordered list of models, with hedging, failover and
+    circuit breaking.
+
+    The first healthy model gets the call. If it has not answered within the
+    hedge delay, a second attempt starts on the next healthy model (or the
+    same model when there is no fallback). The first success wins and the
+    other attempts are cancelled. An attempt that fails with an upstream
+    error starts the next attempt right away.
+
+    The hedge delay is the `hedge_quantile` of the model's recent latencies
+    (`default_hedge_delay` until enough samples exist). It is never later
+    than half the template's latency SLO, so the hedge has time to finish.
+
+    Each attempt holds its own concurrency slot. A hedge is only started
+    when a slot is free right away; a failover waits for one.
+
+    Attributes:
+        models (list): Model names, primary first.
+        max_attempts (int): Upper bound on attempts per call, hedges included.
+        attempt_timeout (float): Seconds before a single attempt is abandoned.
+        hedge_quantile (float): Latency quantile used as the hedge delay.
+        default_hedge_delay (float): Hedge delay before enough latencies are known.
+        min_hedge_delay (float): Lower bound on the hedge delay.
+    """
+
+    def __init__(
+        self,
+        models: list,
+        max_attempts: int = 2,
+        attempt_timeout: float = 60.0,
+        hedge_quantile: float = 0.9,
+        default_hedge_delay: float = 10.0,
+        min_hedge_delay: float = 0.5,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.models = list(models)
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+        self.hedge_quantile = hedge_quantile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.latency = {model: LatencyTracker() for model in self.models}
+        self.breakers = {model: CircuitBreaker(failure_threshold, reset_timeout) for model in self.models}
+
+    def hedge_delay(self, model: str, slo: float | None = None) -> float:
+        delay = self.latency[model].quantile(self.hedge_quantile)
+        if delay is None:
+            delay = self.default_hedge_delay
+        if slo is not None:
+            delay = min(delay, slo / 2)
+        return max(self.min_hedge_delay, delay)
+
+    def pick(self, exclude: tuple = ()) -> str | None:
+        """
+        Next model whose circuit lets a call through, preferring ones not yet tried.
+        """
+        for model in [m for m in self.models if m not in exclude] + list(exclude):
+            if self.breakers[model].allow():
+                metrics.llm_circuit_open.labels(model).set(0)
+                return model
+            metrics.llm_circuit_open.labels(model).set(1)
+        return None
+
+    @contextmanager
+    def track(self, model: str, observe_latency: bool = True):
+        """
+        Records the outcome of one call to `model` on its circuit breaker.
+        """
+        breaker = self.breakers[model]
+        start = time.perf_counter()
+        try:
+            yield
+        except (asyncio.CancelledError, GeneratorExit):
+            breaker.release()
+            raise
+        except Exception as e:
+            if is_upstream_failure(e):
+                breaker.record_failure()
+                if breaker.state != "closed":
+                    metrics.llm_circuit_open.labels(model).set(1)
+            else:
+                breaker.release()
+            raise
+        breaker.record_success()
+        if observe_latency:
+            self.latency[model].observe(time.perf_counter() - start)
+
+    async def _attempt(self, model: str, call):
+        with self.track(model):
+            return await asyncio.wait_for(call(model), timeout=self.attempt_timeout)
+
+    async def run(self, call, slo: float | None = None, acquire=None):
+        """
+        Awaits `call(model)` under the routing policy and returns (model, result).
+
+        `acquire(wait)` takes a concurrency slot for one attempt and returns
+        the function that releases it; without it attempts are not limited.
+
+        Raises 503 when every circuit is open. Otherwise re-raises the last
+        error once all attempts have failed. Errors that are not upstream
+        failures are raised at once.
+        """
+        acquire = acquire or _unlimited
+        release = await acquire(True)
+        model = self.pick()
+        if model is None:
+            release()
+            raise HTTPException(status_code=503, detail="Text generation is temporarily unavailable")
+        tried = [model]
+        # task -> (model, attempt number, slot release)
+        pending = {asyncio.ensure_future(self._attempt(model, call)): (model, 0, release)}
+        last_error = None
+        try:
+            while pending:
+                timeout = None
+                if len(tried) < self.max_attempts:
+                    timeout = self.hedge_delay(tried[-1], slo)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    winner, attempt, release = pending.pop(task)
+                    release()
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        if not is_upstream_failure(e):
+                            raise
+                        last_error = e
+                        continue
+                    if len(tried) > 1:
+                        metrics.llm_hedge_wins.labels("hedge" if attempt else "primary").inc()
+                    return winner, result
+                if len(tried) >= self.max_attempts:
+                    continue
+                # Nothing came back in time, or an attempt failed: start the next one
+                reason = "failover" if done else "delay"
+                try:
+                    release = await acquire(not pending)
+                except HTTPException:
+                    if pending:
+                        # No free slot for a hedge; try again after another delay
+                        continue
+                    raise
+                model = self.pick(exclude=tuple(tried))
+                if model is None:
+                    release()
+                    continue
+                metrics.llm_hedges.labels(reason).inc()
+                tried.append(model)
+                pending[asyncio.ensure_future(self._attempt(model, call))] = (model, len(tried) - 1, release)
+        finally:
+            for task, (_, _, release) in pending.items():
+                task.cancel()
+                release()
+        if last_error is None:
+            raise HTTPException(status_code=503, detail="Text generation is temporarily unavailable")
+        raise last_error
+
+
+async def _unlimited(wait: bool):
+    return lambda: None
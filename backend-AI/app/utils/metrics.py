@@ -0,0 +1,219 @@
+import asyncio
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# With several uvicorn workers each process writes its samples to files in
+# this directory and /metrics aggregates them. It must be set (and emptied)
+# before the workers start.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+UPSTREAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, until the response body is sent.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+upstream_duration = Histogram(
+    "upstream_request_duration_seconds",
+    "Duration of calls to OpenAI, including time queued for a concurrency slot.",
+    ["kind", "outcome"],
+    buckets=UPSTREAM_BUCKETS,
+)
+upstream_tokens = Counter(
+    "upstream_tokens_total",
+    "Tokens billed by the LLM.",
+    ["kind", "direction"],
+)
+db_query_duration = Histogram(
+    "db_query_duration_seconds",
+    "Duration of individual SQL statements.",
+    buckets=DB_BUCKETS,
+)
+db_queries_per_request = Histogram(
+    "db_queries_per_request",
+    "SQL statements executed while serving one request.",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50),
+)
+db_pool_checked_out = Gauge(
+    "db_pool_checked_out_connections",
+    "Connections currently checked out of the pool.",
+    multiprocess_mode="livesum",
+)
+db_pool_checkout_wait = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection.",
+    buckets=DB_BUCKETS,
+)
+db_pool_checkout_timeouts = Counter(
+    "db_pool_checkout_timeouts_total",
+    "Checkouts that gave up after DB_POOL_TIMEOUT.",
+)
+quota_rejections = Counter(
+    "quota_rejections_total",
+    "Generation requests rejected for lack of quota.",
+    ["reason"],
+)
+llm_hedges = Counter(
+    "llm_hedges_total",
+    "Extra text generation attempts, started after the hedge delay or a failed attempt.",
+    ["reason"],
+)
+llm_hedge_wins = Counter(
+    "llm_hedge_wins_total",
+    "Winning attempt of text generations that were hedged.",
+    ["attempt"],
+)
+llm_circuit_open = Gauge(
+    "llm_circuit_open",
+    "1 while the circuit breaker of a text model is open.",
+    ["model"],
+    multiprocess_mode="max",
+)
+image_jobs_finished = Counter(
+    "image_jobs_finished_total",
+    "Image jobs that reached a final status.",
+    ["status"],
+)
+rate_limited = Counter(
+    "rate_limited_total",
+    "Requests rejected with 429 by the rate limiter, per route group.",
+    ["group"],
+)
+envelope_parses = Counter(
+    "llm_envelope_parses_total",
+    "Text generations by how their JSON envelope was decoded: valid, repaired locally, re-asked or failed.",
+    ["outcome"],
+)
+idempotent_requests = Counter(
+    "idempotent_requests_total",
+    "Requests with an Idempotency-Key, by whether they ran, waited for or replayed the original.",
+    ["outcome"],
+)
+
+# Mutable per-request query counter; the SQLAlchemy hooks run in greenlets
+# that share the request's context, so they can update it in place
+_request_queries: contextvars.ContextVar = contextvars.ContextVar("request_queries", default=None)
+
+
+def observe_query(seconds: float):
+    db_query_duration.observe(seconds)
+    counter = _request_queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def observe_pool_checkout(waited: float, timed_out: bool = False):
+    if timed_out:
+        db_pool_checkout_timeouts.inc()
+    else:
+        db_pool_checkout_wait.observe(waited)
+
+
+@contextmanager
+def upstream_call(kind: str):
+    """
+    Times one upstream call and labels it ok, timeout, cancelled or error.
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except TimeoutError:
+        outcome = "timeout"
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        upstream_duration.labels(kind, outcome).observe(time.perf_counter() - start)
+
+
+def count_tokens(kind: str, usage_metadata: dict | None):
+    if usage_metadata:
+        upstream_tokens.labels(kind, "input").inc(usage_metadata.get("input_tokens", 0))
+        upstream_tokens.labels(kind, "output").inc(usage_metadata.get("output_tokens", 0))
+
+
+def route_label(scope) -> str:
+    """
+    Route template of the matched route, e.g. /save/outputs/{output_id}.
+    """
+    template = getattr(scope.get("route"), "path", None)
+    if template is None:
+        return "unmatched"
+    # Newer FastAPI versions report the path relative to an included router;
+    # the router prefix is static, so take it from the request path
+    extra = scope["path"].count("/") - template.count("/")
+    if extra > 0:
+        template = "/".join(scope["path"].split("/")[: extra + 1]) + template
+    return template
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency and SQL statement count per route.
+
+    Requests are labelled with the route template (e.g. /save/outputs/{output_id}),
+    never the raw path, so label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+        queries = [0]
+        token = _request_queries.set(queries)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_queries.reset(token)
+            path = route_label(scope)
+            http_request_duration.labels(scope["method"], path, str(status[0])).observe(time.perf_counter() - start)
+            db_queries_per_request.labels(path).observe(queries[0])
+
+
+def render() -> tuple[bytes, str]:
+    """
+    Returns the exposition body and content type, merged across workers in multiprocess mode.
+    """
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead():
+    # Drops this worker's live gauges (pool connections) from the aggregate
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
@@ -1,54 +1,493 @@
 # Import necessary modules
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from openai import OpenAI
-from langchain_openai import ChatOpenAI
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain.prompts import PromptTemplate
-from dotenv import load_dotenv
+# LangChain and the OpenAI SDK are slow to import, so they are only loaded
+# when the first generation needs them (or by warm_up() in the background)
+from fastapi import HTTPException
+import settings
+from utils.concurrency import ConcurrencyLimiter
+from utils.stream_parser import EnvelopeStreamParser
+from utils.structured_output import REPAIRED, VALID, parse_envelope, response_format
+from utils.generation_cache import (
+    GenerationCache,
+    InMemoryCacheBackend,
+    SqliteCacheBackend,
+    make_cache_key,
+)
+from utils.image_store import ImageStore, image_digest
+from utils.tokens import TokenMeter, estimate_tokens, MESSAGE_OVERHEAD_TOKENS
+from utils.llm_router import HedgedRouter
+from utils import metrics
+import asyncio
+import base64
 import os
+import threading
+
+# Per-call upstream timeouts (seconds)
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+IMAGE_TIMEOUT_SECONDS = float(os.getenv("IMAGE_TIMEOUT_SECONDS", "120"))
+
+# Concurrency caps towards OpenAI
+GENERATION_MAX_CONCURRENCY = int(os.getenv("GENERATION_MAX_CONCURRENCY", "32"))
+GENERATION_MAX_CONCURRENCY_PER_USER = int(os.getenv("GENERATION_MAX_CONCURRENCY_PER_USER", "2"))
+GENERATION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("GENERATION_QUEUE_TIMEOUT_SECONDS", "30"))
 
-# Load .env
-load_dotenv()
-
-client= OpenAI(api_key=os.getenv("OPEN_API_KEY"))
-
-# Init LangChain LLM
-llm = ChatOpenAI(model="gpt-3.5-turbo", api_key=os.getenv("OPEN_API_KEY"))
-
-# Define the Expected Output Structure (for LangChain)
-response_schemas = [
-    ResponseSchema(name="type", description="Type of content e.g. blog_post, email_draft"),
-    ResponseSchema(name="data", description="The generated content itself as text"),
-]
-
-parser = StructuredOutputParser.from_response_schemas(response_schemas)
-format_instructions = parser.get_format_instructions()
-
-# Create PromptTemplate with format instructions
-prompt_template = PromptTemplate(
-    template=(
-        "You are a professional AI content writer.\n"
-        "Generate a {template_type} based on the following details:\n"
-        "{details}\n\n"
-        "{format_instructions}"
-    ),
-    input_variables=["template_type", "details"],
-    partial_variables={"format_instructions": format_instructions}
+limiter = ConcurrencyLimiter(
+    GENERATION_MAX_CONCURRENCY,
+    GENERATION_MAX_CONCURRENCY_PER_USER,
+    GENERATION_QUEUE_TIMEOUT_SECONDS,
 )
 
+# Exact-match generation cache ("memory", "sqlite" or "off")
+GENERATION_CACHE_BACKEND = os.getenv("GENERATION_CACHE_BACKEND", "memory")
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "10000"))
+GENERATION_CACHE_TTL_SECONDS = float(os.getenv("GENERATION_CACHE_TTL_SECONDS", "86400"))
+GENERATION_CACHE_PATH = os.getenv("GENERATION_CACHE_PATH", "generation_cache.sqlite3")
 
-# Generate Text Template using LangChain LLM
-def generate_text_template(template_type: str, details: str) -> str:
+# Bump whenever the prompt template changes so stale generations are not served
+TEMPLATE_VERSION = "1"
+
+if GENERATION_CACHE_BACKEND == "sqlite":
+    generation_cache = GenerationCache(
+        SqliteCacheBackend(GENERATION_CACHE_PATH, GENERATION_CACHE_MAX_ENTRIES),
+        GENERATION_CACHE_TTL_SECONDS,
+    )
+elif GENERATION_CACHE_BACKEND == "off":
+    generation_cache = None
+else:
+    generation_cache = GenerationCache(
+        InMemoryCacheBackend(GENERATION_CACHE_MAX_ENTRIES),
+        GENERATION_CACHE_TTL_SECONDS,
+    )
+
+# Opt-in near-duplicate lookup in front of the exact cache
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.88"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "500000"))
+# Share of content words two prompts must have in common to count as a match
+SEMANTIC_CACHE_MIN_OVERLAP = float(os.getenv("SEMANTIC_CACHE_MIN_OVERLAP", "0.75"))
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED and generation_cache is not None:
+    from utils.semantic_cache import SemanticCache  # pulls in numpy
+
+    semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_MIN_OVERLAP)
+
+# Generated images are kept locally instead of linking to expiring OpenAI URLs
+IMAGE_MODEL = "dall-e-3"
+IMAGE_SIZES = {"1024x1024", "1792x1024", "1024x1792"}
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+# Keys the image digests, which double as the unauthenticated image URLs
+IMAGE_DIGEST_SECRET = os.getenv("IMAGE_DIGEST_SECRET") or settings.SECRET_KEY
+
+image_store = ImageStore(IMAGE_STORE_DIR)
+
+TEXT_MODEL = "gpt-3.5-turbo"
+
+# Text models tried after TEXT_MODEL, comma separated. An entry may name
+# another OpenAI-compatible server as model@base_url.
+LLM_FALLBACK_MODELS = [m.strip() for m in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if m.strip()]
+# Attempts per text generation, hedges included; 1 turns hedging off
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "2"))
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.9"))
+LLM_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_SECONDS", "10"))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv("LLM_CIRCUIT_RESET_SECONDS", "30"))
+
+# Latency SLO per template type, e.g. "email_draft=8,blog_post=20"; the
+# hedge fires no later than half of it
+LLM_LATENCY_SLO_SECONDS = float(os.getenv("LLM_LATENCY_SLO_SECONDS", "20"))
+LLM_LATENCY_SLOS = {
+    name.strip(): float(seconds)
+    for name, _, seconds in (
+        entry.partition("=") for entry in os.getenv("LLM_LATENCY_SLOS", "").split(",") if entry.strip()
+    )
+}
+
+router = HedgedRouter(
+    [TEXT_MODEL, *LLM_FALLBACK_MODELS],
+    max_attempts=LLM_MAX_ATTEMPTS,
+    attempt_timeout=LLM_TIMEOUT_SECONDS,
+    hedge_quantile=LLM_HEDGE_QUANTILE,
+    default_hedge_delay=LLM_HEDGE_DEFAULT_DELAY_SECONDS,
+    min_hedge_delay=LLM_HEDGE_MIN_DELAY_SECONDS,
+    failure_threshold=LLM_CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=LLM_CIRCUIT_RESET_SECONDS,
+)
+
+PROMPT_TEMPLATE = (
+    "You are a professional AI content writer.\n"
+    "Generate a {template_type} based on the following details:\n"
+    "{details}\n\n"
+    "{format_instructions}"
+)
+
+# Sent with only the broken output, when it cannot be repaired locally
+FORMAT_REPAIR_PROMPT = (
+    "The text below was meant to be a JSON object with the string fields \"type\" and \"data\", "
+    "but it is not valid JSON. Reply with only the corrected JSON object. Keep the content "
+    "exactly as it is and fix nothing but the formatting.\n\n"
+    "{output}"
+)
+
+# JSON mode requested from the model: "json_schema" (strict structured
+# outputs; the model must support them), "json_object" or "off"
+LLM_RESPONSE_FORMAT = os.getenv("LLM_RESPONSE_FORMAT", "json_object")
+# Re-ask the model to fix output that cannot be repaired locally
+LLM_FORMAT_REASK = os.getenv("LLM_FORMAT_REASK", "true").lower() == "true"
+
+# Created on first use by the getters below; tests may assign stand-ins
+client = None
+llm = None
+fallback_llms: dict = {}
+parser = None
+prompt_template = None
+_init_lock = threading.Lock()
+
+
+def get_image_client():
+    global client
+    if client is None:
+        with _init_lock:
+            if client is None:
+                from openai import AsyncOpenAI
+
+                client = AsyncOpenAI(
+                    api_key=settings.OPENAI_API_KEY,
+                    base_url=settings.OPENAI_BASE_URL,
+                    timeout=IMAGE_TIMEOUT_SECONDS,
+                )
+    return client
+
+
+def build_llm(model: str):
+    from langchain_openai import ChatOpenAI
+
+    name, _, base_url = model.partition("@")
+    # stream_usage makes streamed responses report token usage like ainvoke does
+    return ChatOpenAI(
+        model=name,
+        api_key=settings.OPENAI_API_KEY,
+        base_url=base_url or settings.OPENAI_BASE_URL,
+        timeout=LLM_TIMEOUT_SECONDS,
+        stream_usage=True,
+    )
+
+
+def get_llm(model: str = TEXT_MODEL):
+    global llm
+    if model != TEXT_MODEL:
+        if model not in fallback_llms:
+            with _init_lock:
+                if model not in fallback_llms:
+                    fallback_llms[model] = build_llm(model)
+        return fallback_llms[model]
+    if llm is None:
+        with _init_lock:
+            if llm is None:
+                llm = build_llm(TEXT_MODEL)
+    return llm
+
+
+def get_prompt():
+    """
+    Returns (parser, prompt_template) for the JSON envelope the LLM must answer in.
+    """
+    global parser, prompt_template
+    if prompt_template is None:
+        with _init_lock:
+            if prompt_template is None:
+                from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+                from langchain.prompts import PromptTemplate
+
+                # Define the Expected Output Structure (for LangChain)
+                response_schemas = [
+                    ResponseSchema(name="type", description="Type of content e.g. blog_post, email_draft"),
+                    ResponseSchema(name="data", description="The generated content itself as text"),
+                ]
+                parser = StructuredOutputParser.from_response_schemas(response_schemas)
+                prompt_template = PromptTemplate(
+                    template=PROMPT_TEMPLATE,
+                    input_variables=["template_type", "details"],
+                    partial_variables={"format_instructions": parser.get_format_instructions()},
+                )
+    return parser, prompt_template
+
+
+def warm_up():
+    """
+    Imports and builds everything a first generation needs. Blocking; run it in a thread.
+    """
+    get_prompt()
+    for model in router.models:
+        get_llm(model)
+    get_image_client()
+    prompt_overhead_tokens()
+
+
+_prompt_overhead_tokens = None
+
+
+def prompt_overhead_tokens() -> int:
+    # Tokens of the fixed part of the prompt, so per-request estimates only scan the user input
+    global _prompt_overhead_tokens
+    if _prompt_overhead_tokens is None:
+        _, template = get_prompt()
+        fixed = template.format(template_type="", details="")
+        _prompt_overhead_tokens = estimate_tokens(fixed) + MESSAGE_OVERHEAD_TOKENS
+    return _prompt_overhead_tokens
+
+
+def estimate_prompt_tokens(template_type: str, details: str) -> int:
+    """
+    Offline estimate of the prompt tokens a text generation will be billed for.
+    """
+    return prompt_overhead_tokens() + estimate_tokens(template_type) + estimate_tokens(details)
+
+
+def call_options(max_tokens: int | None) -> dict:
+    options = {"max_tokens": max_tokens} if max_tokens else {}
+    output_format = response_format(LLM_RESPONSE_FORMAT)
+    if output_format is not None:
+        options["response_format"] = output_format
+    return options
+
+
+def truncated_error() -> HTTPException:
+    return HTTPException(status_code=403, detail="Token limit reached before the generation finished")
+
+
+def text_cache_key(template_type: str, details: str) -> str:
+    return make_cache_key(TEXT_MODEL, TEMPLATE_VERSION, template_type, details)
+
+
+def semantic_partition(template_type: str) -> tuple:
+    return (TEXT_MODEL, TEMPLATE_VERSION, template_type)
+
+
+async def lookup_similar(template_type: str, details: str) -> str | None:
+    if semantic_cache is None:
+        return None
+    return await semantic_cache.lookup(semantic_partition(template_type), details, generation_cache.peek)
+
+
+def remember_similar(template_type: str, details: str, cache_key: str):
+    if semantic_cache is not None:
+        semantic_cache.add(semantic_partition(template_type), details, cache_key)
+
+
+async def decode_envelope(
+    content: str,
+    user_id: int | None = None,
+    max_tokens: int | None = None,
+    meter: TokenMeter | None = None,
+    slo: float | None = None,
+) -> dict:
+    """
+    Fields of the envelope in the raw model output `content`.
+
+    Near-valid output is repaired locally. Only output that cannot be is
+    sent back to the model, on its own without the original prompt, to have
+    its formatting fixed; that call is metered like the generation. Raises
+    ValueError if the envelope still cannot be decoded.
+    """
+    try:
+        fields, outcome = parse_envelope(content)
+    except ValueError:
+        if not LLM_FORMAT_REASK:
+            metrics.envelope_parses.labels("failed").inc()
+            raise
+    else:
+        metrics.envelope_parses.labels(outcome).inc()
+        return fields
+
+    prompt = FORMAT_REPAIR_PROMPT.format(output=content)
+    with metrics.upstream_call("repair"):
+        _, response = await router.run(
+            lambda model: get_llm(model).ainvoke(prompt, **call_options(max_tokens)),
+            slo,
+            acquire=lambda wait: limiter.acquire(user_id, wait),
+        )
+    metrics.count_tokens("repair", response.usage_metadata)
+    if meter is not None:
+        meter.record(response.usage_metadata, prompt, response.content)
+    if response.response_metadata.get("finish_reason") == "length":
+        if meter is not None:
+            meter.truncated = True
+        raise truncated_error()
     try:
+        fields, _ = parse_envelope(response.content)
+    except ValueError:
+        metrics.envelope_parses.labels("failed").inc()
+        raise
+    metrics.envelope_parses.labels("reasked").inc()
+    return fields
+
+
+# Generate Text Template using LangChain LLM
+async def generate_text_template(
+    template_type: str,
+    details: str,
+    user_id: int | None = None,
+    use_cache: bool = True,
+    max_tokens: int | None = None,
+    meter: TokenMeter | None = None,
+) -> str:
+    """
+    Generates the `data` field of the envelope for one template.
+
+    `max_tokens` caps the completion; a completion cut off by it raises 403
+    and is not cached. Concurrent identical requests share one upstream
+    call only if their caps are equal. The call is metered on its own and
+    its usage is added to the `meter` of the request that started it, once
+    that call is over; cache hits and requests coalesced onto another
+    request's call add nothing.
+
+    The call goes through `router`: it may be hedged or fail over to a
+    fallback model. Only the winning attempt's usage is metered; a
+    cancelled hedge reports none.
+    """
+    call_meter = TokenMeter()
+    started = False
+
+    async def invoke() -> str:
+        nonlocal started
+        started = True
+        _, prompt_template = get_prompt()
         prompt = prompt_template.format(template_type=template_type, details=details)
-        response = llm.invoke(prompt)
-        parsed = parser.parse(response.content)
+        options = call_options(max_tokens)
+        slo = LLM_LATENCY_SLOS.get(template_type, LLM_LATENCY_SLO_SECONDS)
+        with metrics.upstream_call("text"):
+            _, response = await router.run(
+                lambda model: get_llm(model).ainvoke(prompt, **options),
+                slo,
+                acquire=lambda wait: limiter.acquire(user_id, wait),
+            )
+        metrics.count_tokens("text", response.usage_metadata)
+        call_meter.record(response.usage_metadata, prompt, response.content)
+        if response.response_metadata.get("finish_reason") == "length":
+            call_meter.truncated = True
+            raise truncated_error()
+        parsed = await decode_envelope(response.content, user_id, max_tokens, call_meter, slo)
+        remember_similar(template_type, details, cache_key)
 
         return parsed['data'].strip()  # Safe fallback to string
+
+    cache_key = text_cache_key(template_type, details)
+    try:
+        if generation_cache is None:
+            return await invoke()
+        return await generation_cache.get_or_generate(
+            cache_key,
+            invoke,
+            use_cache=use_cache,
+            flight=(cache_key, max_tokens),
+            fallback=lambda: lookup_similar(template_type, details),
+        )
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="LangChain error: upstream timed out")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LangChain error: {str(e)}")
+    finally:
+        if started and meter is not None:
+            meter.merge(call_meter)
+
+
+
+# Stream the `data` field of the envelope as the LLM produces it
+async def stream_text_template(
+    template_type: str,
+    details: str,
+    user_id: int | None = None,
+    use_cache: bool = True,
+    max_tokens: int | None = None,
+    meter: TokenMeter | None = None,
+):
+    """
+    Yields chunks of the generated text as tokens arrive.
+
+    A cache hit is yielded as a single chunk. The whole stream must finish
+    within LLM_TIMEOUT_SECONDS. Closing the generator early (e.g. on client
+    disconnect) closes the upstream stream too. Usage is added to `meter`
+    as for generate_text_template, including for streams cut short.
 
+    Streams are not hedged, since chunks already sent cannot be taken back.
+    They do skip models whose circuit is open, and their outcome counts
+    towards it.
+    """
+    cache_key = text_cache_key(template_type, details)
+    if generation_cache is not None and use_cache:
+        cached = await generation_cache.get(cache_key) or await lookup_similar(template_type, details)
+        if cached is not None:
+            yield cached
+            return
+
+    _, prompt_template = get_prompt()
+    prompt = prompt_template.format(template_type=template_type, details=details)
+    envelope = EnvelopeStreamParser()
+    options = call_options(max_tokens)
+    received = []
+    streamed = False
+    usage = None
+    finish_reason = None
+    model = router.pick()
+    if model is None:
+        raise HTTPException(status_code=503, detail="Text generation is temporarily unavailable")
+    with metrics.upstream_call("stream"), router.track(model, observe_latency=False):
+        async with limiter.slot(user_id):
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + LLM_TIMEOUT_SECONDS
+            upstream = get_llm(model).astream(prompt, **options)
+            try:
+                while True:
+                    # Bound each wait, so an upstream that stalls mid-stream still times out
+                    try:
+                        chunk = await asyncio.wait_for(upstream.__anext__(), deadline - loop.time())
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise HTTPException(status_code=504, detail="LangChain error: upstream timed out")
+                    # Keep reading past the envelope: usage arrives in the last chunk
+                    received.append(chunk.content)
+                    usage = chunk.usage_metadata or usage
+                    finish_reason = chunk.response_metadata.get("finish_reason") or finish_reason
+                    if envelope.done:
+                        continue
+                    text = envelope.feed(chunk.content)
+                    if text:
+                        streamed = True
+                        yield text
+            finally:
+                await upstream.aclose()
+                if meter is not None and (received or usage):
+                    meter.record(usage, prompt, "".join(received))
+    if finish_reason == "length":
+        if meter is not None:
+            meter.truncated = True
+        raise truncated_error()
+    if isinstance(envelope.fields.get("data"), str):
+        # Whatever else is wrong with the envelope, the text is out already
+        metrics.envelope_parses.labels(VALID if envelope.done and not envelope.stray else REPAIRED).inc()
+        fields = envelope.fields
+    elif streamed:
+        metrics.envelope_parses.labels("failed").inc()
+        raise HTTPException(status_code=500, detail="LangChain error: Incomplete envelope: missing 'data' field")
+    else:
+        # Nothing was sent yet, so the output can still be repaired or re-asked
+        slo = LLM_LATENCY_SLOS.get(template_type, LLM_LATENCY_SLO_SECONDS)
+        try:
+            fields = await decode_envelope("".join(received), user_id, max_tokens, meter, slo)
+        except HTTPException:
+            raise
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="LangChain error: upstream timed out")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"LangChain error: {str(e)}")
+        yield fields["data"]
+    if generation_cache is not None:
+        await generation_cache.set(cache_key, fields["data"].strip())
+        remember_similar(template_type, details, cache_key)
 
 
 prompt_styles= {
@@ -56,11 +495,54 @@ prompt_styles= {
     "art": "Surreal artistic illustration of {item}, soft brush strokes, pastel colors.",
     "fantasy": "Epic cinematic scene of {item}, fantasy environment, 8K, volumetric lighting.",
 }
-def generate_image_template(prompt: str, style: str="product") -> str:
+
+
+def enhance_image_prompt(prompt: str, style: str) -> str:
+    template = prompt_styles.get(style, prompt_styles["product"])
+    return template.format(item=prompt)
+
+
+def image_request_digest(prompt: str, style: str, size: str) -> str:
+    # Known before generating, so a queued job can be given its image URL up front
+    return image_digest(IMAGE_MODEL, enhance_image_prompt(prompt, style), style, size, IMAGE_DIGEST_SECRET)
+
+
+async def generate_image_template(
+    prompt: str,
+    style: str="product",
+    size: str="1024x1024",
+    user_id: int | None = None,
+) -> str:
+    """
+    Generates an image into the local image store and returns its digest.
+
+    The digest covers model, style, size and the enhanced prompt, so a repeat
+    request is served from disk without calling DALL-E again.
+    """
     try:
-        template= prompt_styles.get(style, prompt_styles["product"])
-        enhanced_prompt=template.format(item=prompt)
-        response = client.images.generate(model="dall-e-3", prompt=enhanced_prompt, n=1, size="1024x1024")
-        return  response.data[0].url
+        enhanced_prompt = enhance_image_prompt(prompt, style)
+        digest = image_digest(IMAGE_MODEL, enhanced_prompt, style, size, IMAGE_DIGEST_SECRET)
+
+        async def produce() -> bytes:
+            with metrics.upstream_call("image"):
+                async with limiter.slot(user_id):
+                    response = await asyncio.wait_for(
+                        get_image_client().images.generate(
+                            model=IMAGE_MODEL,
+                            prompt=enhanced_prompt,
+                            n=1,
+                            size=size,
+                            response_format="b64_json",
+                        ),
+                        timeout=IMAGE_TIMEOUT_SECONDS,
+                    )
+            return base64.b64decode(response.data[0].b64_json)
+
+        await image_store.get_or_produce(digest, produce)
+        return digest
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Image generation error: upstream timed out")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image generation error: {str(e)}")
@@ -0,0 +1,169 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+from sqlalchemy import event
+
+from models import User
+from utils.auth import verify_token
+
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    Lightweight, session-independent view of an authenticated user.
+
+    Attributes:
+        id (int): User primary key.
+        email (str): Email address (the JWT subject).
+        username (str): Unique username.
+        is_active (bool): Whether the user may use the API.
+    """
+    id: int
+    email: str
+    username: str
+    is_active: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        return cls(id=user.id, email=user.email, username=user.username, is_active=bool(user.is_active))
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def bearer_subject(scope, cache: "PrincipalCache | None" = None) -> str | None:
+    """
+    Subject of the request's bearer token, for ASGI middleware that runs
+    before authentication. None when there is no token or it does not verify.
+
+    With `cache`, a token already verified (by a middleware or by
+    get_current_user) is not decoded again.
+    """
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer" or not token:
+                return None
+            digest = token_digest(token) if cache is not None else None
+            if cache is not None:
+                subject = cache.get_subject(digest)
+                if subject is not None:
+                    return subject
+            try:
+                payload = verify_token(token)
+            except HTTPException:
+                return None
+            subject = payload.get("sub")
+            if cache is not None and subject is not None:
+                cache.set_subject(digest, subject, payload.get("exp"))
+            return subject
+    return None
+
+
+class PrincipalCache:
+    """
+    Bounded LRU cache from verified access tokens to principals.
+
+    Entries are keyed by the SHA-256 of the token (the raw token is never
+    stored) and expire after `ttl` seconds or when the token itself expires,
+    whichever comes first. All entries of a user can be dropped at once.
+
+    The subjects of tokens that middleware verified before authentication
+    are kept alongside, under the same bounds, so each token is decoded
+    once; they hold no user data and are not invalidated with the user.
+
+    Attributes:
+        ttl (float): Maximum seconds a principal is served from the cache.
+        max_entries (int): Entries kept before the least recently used is evicted.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+        self._entries: OrderedDict = OrderedDict()  # digest -> (expires_at, principal)
+        self._by_user: dict = {}  # user_id -> set of digests
+        self._subjects: OrderedDict = OrderedDict()  # digest -> (expires_at, subject)
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> Principal | None:
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(digest)
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def set(self, digest: str, principal: Principal, token_exp: float | None = None):
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        with self._lock:
+            self._remove(digest)
+            self._entries[digest] = (expires_at, principal)
+            self._by_user.setdefault(principal.id, set()).add(digest)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def get_subject(self, digest: str) -> str | None:
+        # Not counted in the stats, which are about principals
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest) or self._subjects.get(digest)
+            if entry is None or entry[0] < now:
+                return None
+            return entry[1].email if isinstance(entry[1], Principal) else entry[1]
+
+    def set_subject(self, digest: str, subject: str, token_exp: float | None = None):
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        with self._lock:
+            self._subjects[digest] = (expires_at, subject)
+            self._subjects.move_to_end(digest)
+            while len(self._subjects) > self.max_entries:
+                self._subjects.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            digests = self._by_user.pop(user_id, ())
+            for digest in digests:
+                self._entries.pop(digest, None)
+            if digests:
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self._subjects.clear()
+
+    def _remove(self, digest: str):
+        entry = self._entries.pop(digest, None)
+        if entry is not None:
+            digests = self._by_user.get(entry[1].id)
+            if digests is not None:
+                digests.discard(digest)
+                if not digests:
+                    del self._by_user[entry[1].id]
+
+    def watch_user_changes(self):
+        """
+        Drops a user's cached principals whenever their row is updated or
+        deleted through the ORM in this process. Other workers converge
+        within `ttl`.
+        """
+        def invalidate(mapper, connection, target):
+            self.invalidate_user(target.id)
+
+        event.listen(User, "after_update", invalidate)
+        event.listen(User, "after_delete", invalidate)
@@ -0,0 +1,239 @@
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from utils import metrics
+from utils.concurrency import call_backend
+from utils.principal_cache import bearer_subject
+
+
+@dataclass(frozen=True)
+class Rule:
+    """
+    Token bucket of `burst` requests that refills at `burst / period` per second.
+
+    Attributes:
+        burst (int): Requests allowed at once from a full bucket.
+        period (float): Seconds an empty bucket takes to fill up again.
+    """
+    burst: int
+    period: float
+
+    @property
+    def interval(self) -> float:
+        # Seconds per token
+        return self.period / self.burst
+
+
+def parse_rules(spec: str) -> dict:
+    """
+    Parses "user=30/60,ip=120/60" into {"user": Rule(30, 60), "ip": Rule(120, 60)}.
+    """
+    rules = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        kind, _, limit = entry.partition("=")
+        burst, _, period = limit.partition("/")
+        if int(burst) > 0:
+            rules[kind.strip()] = Rule(int(burst), float(period))
+    return rules
+
+
+def acquire_buckets(full_at: dict, limits: list, now: float) -> tuple:
+    """
+    Takes one token from every bucket in `limits`, or from none of them.
+
+    Each bucket is stored as the time at which it will be full again, so
+    `full_at` maps keys to a single float and a key that is missing, or full
+    by `now`, is a full bucket. `limits` holds (key, Rule) pairs. Returns
+    (retry_after, updates): seconds until every bucket has a token (0 when
+    the request is allowed) and the new `full_at` values to store.
+    """
+    retry_after = 0.0
+    updates = {}
+    for key, rule in limits:
+        start = max(full_at.get(key) or now, now)
+        # Room for one more token means the bucket stays within `period` of full
+        wait = start + rule.interval - now - rule.period
+        if wait > 0:
+            retry_after = max(retry_after, wait)
+        updates[key] = start + rule.interval
+    return retry_after, ({} if retry_after > 0 else updates)
+
+
+class InMemoryRateLimitBackend:
+    """
+    Per-process token buckets, bounded in memory.
+
+    Keys are kept in least-recently-used order. Every call drops a few keys
+    from the cold end whose buckets are full again, since a full bucket is
+    the same as no entry; past `max_keys` the coldest key is dropped even if
+    its bucket is not full.
+
+    Attributes:
+        max_keys (int): Buckets kept before the least recently used is dropped.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._full_at: OrderedDict = OrderedDict()  # key -> time.monotonic() the bucket is full
+        self._lock = threading.Lock()
+
+    def acquire(self, limits: list) -> float:
+        now = time.monotonic()
+        with self._lock:
+            retry_after, updates = acquire_buckets(self._full_at, limits, now)
+            for key, full_at in updates.items():
+                self._full_at[key] = full_at
+                self._full_at.move_to_end(key)
+            self._evict(now)
+        return retry_after
+
+    def _evict(self, now: float):
+        for _ in range(2):
+            if not self._full_at:
+                return
+            key, full_at = next(iter(self._full_at.items()))
+            if full_at > now:
+                break
+            del self._full_at[key]
+        while len(self._full_at) > self.max_keys:
+            self._full_at.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._full_at)
+
+
+class SqliteRateLimitBackend:
+    """
+    Shared-store stand-in backed by a SQLite file.
+
+    Every uvicorn worker on the host pointing at the same file shares the
+    buckets, which is what a Redis backend would give across hosts. Buckets
+    are read and updated in one write transaction. Full buckets are deleted
+    every `sweep_every` calls. Calls block; the middleware runs them in a
+    worker thread.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, sweep_every: int = 1000):
+        self.path = path
+        self.sweep_every = sweep_every
+        self._calls = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, full_at REAL NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, limits: list) -> float:
+        # Wall clock, since the buckets are shared between processes
+        now = time.time()
+        keys = [key for key, _ in limits]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT key, full_at FROM rate_limits WHERE key IN ({', '.join('?' * len(keys))})", keys
+            ).fetchall()
+            retry_after, updates = acquire_buckets(dict(rows), limits, now)
+            conn.executemany("INSERT OR REPLACE INTO rate_limits (key, full_at) VALUES (?, ?)", updates.items())
+            self._calls += 1
+            if self._calls % self.sweep_every == 0:
+                conn.execute("DELETE FROM rate_limits WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return retry_after
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware applying token-bucket limits per route group.
+
+    `groups` maps a path prefix (e.g. "/generate") to {"user": Rule, "ip": Rule}.
+    The user is the subject of a valid bearer token; requests without one
+    are only limited per IP. A request is let through only if every bucket
+    it falls in has a token; otherwise it gets a 429 with Retry-After and
+    no bucket is charged. Paths under `exempt` are never limited.
+
+    Attributes:
+        groups (dict): Path prefix -> rules by key kind ('user', 'ip').
+        exempt (tuple): Path prefixes that are not limited.
+        trust_forwarded_for (bool): Take the client IP from X-Forwarded-For,
+            as appended by the reverse proxy in front of the app.
+        principal_cache (PrincipalCache | None): Where verified token
+            subjects are looked up and kept, so tokens are decoded once.
+    """
+
+    def __init__(self, app, backend, groups: dict, exempt: tuple = (),
+                 trust_forwarded_for: bool = False, principal_cache=None):
+        self.app = app
+        self.backend = backend
+        self.groups = {prefix: rules for prefix, rules in groups.items() if rules}
+        self.exempt = exempt
+        self.trust_forwarded_for = trust_forwarded_for
+        self.principal_cache = principal_cache
+
+    def _group(self, path: str) -> str | None:
+        for prefix in self.groups:
+            if path == prefix or path.startswith(prefix + "/"):
+                return prefix
+        return None
+
+    def _client_ip(self, scope) -> str:
+        if self.trust_forwarded_for:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").rsplit(",", 1)[-1].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        group = self._group(path)
+        if group is None or path.startswith(self.exempt):
+            await self.app(scope, receive, send)
+            return
+        rules = self.groups[group]
+        limits = []
+        if "user" in rules:
+            # Verified, so nobody can spend another user's bucket
+            subject = bearer_subject(scope, self.principal_cache)
+            if subject is not None:
+                limits.append((f"{group}:user:{subject}", rules["user"]))
+        if "ip" in rules:
+            limits.append((f"{group}:ip:{self._client_ip(scope)}", rules["ip"]))
+        retry_after = await call_backend(self.backend, "acquire", limits) if limits else 0
+        if retry_after <= 0:
+            await self.app(scope, receive, send)
+            return
+        metrics.rate_limited.labels(group).inc()
+        body = json.dumps({"detail": "Too many requests, slow down"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", str(math.ceil(retry_after)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
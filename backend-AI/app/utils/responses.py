@@ -0,0 +1,57 @@
+import hashlib
+
+from fastapi.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # optional; the standard json module is used when it is missing
+    orjson = None
+
+# Per-user responses: browsers may keep them but must revalidate every time
+PRIVATE_REVALIDATE = "private, no-cache"
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson when it is installed.
+
+    FastAPI has already turned the content into plain JSON types, so both
+    renderers produce the same compact output.
+    """
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def data_etag(kind: str, user_id: int, version: int, *variant) -> str:
+    """
+    Weak ETag of a per-user response built from the user's data version.
+
+    `variant` holds whatever else selects the response, such as query
+    parameters. Weak, since the same ETag is sent whatever the encoding.
+    """
+    tag = f"{kind}.{user_id}.{version}"
+    if variant:
+        tag += "." + hashlib.sha256(repr(variant).encode("utf-8")).hexdigest()[:16]
+    return f'W/"{tag}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # Weak comparison, as If-None-Match requires
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": PRIVATE_REVALIDATE})
+
+
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = PRIVATE_REVALIDATE
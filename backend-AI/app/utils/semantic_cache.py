@@ -0,0 +1,213 @@
+import hashlib
+import re
+from itertools import combinations
+
+import numpy as np
+
+SIGNATURE_BITS = 64
+BANDS = 4
+BAND_BITS = SIGNATURE_BITS // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+# Filler and instruction words that do not change what the user is asking for
+STOPWORDS = frozenset(
+    "a an the of in on for to about and or with write writing create generate make "
+    "please draft me my our your some i we is are be that this it as by at from post".split()
+)
+
+# Unicode word characters, so prompts in any script get features
+_TOKEN_RE = re.compile(r"\w+")
+_SUFFIXES = ("ing", "ed", "ly", "es", "s")
+_BIT_SHIFTS = np.arange(SIGNATURE_BITS, dtype=np.uint64)
+
+
+def _stem(token: str) -> str:
+    # Crude suffix stripping so "announcing"/"announce" and "remote"/"remotely" meet
+    if len(token) > 4:
+        for suffix in _SUFFIXES:
+            if token.endswith(suffix):
+                token = token[:-len(suffix)]
+                break
+        if token.endswith("e"):
+            token = token[:-1]
+    return token
+
+
+def _features(text: str) -> dict:
+    """
+    Bag of stemmed content words, weighted by count.
+    """
+    features: dict = {}
+    for token in _TOKEN_RE.findall(text.casefold()):
+        if token in STOPWORDS:
+            continue
+        token = _stem(token)
+        features[token] = features.get(token, 0) + 1
+    return features
+
+
+def simhash(text: str, features: dict | None = None) -> int:
+    """
+    64-bit SimHash of `text`; similar prompts differ in few bits.
+
+    A text without content words hashes to 0. Pass `features` when they
+    have been computed already.
+    """
+    if features is None:
+        features = _features(text)
+    if not features:
+        return 0
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little") for f in features),
+        dtype=np.uint64,
+        count=len(features),
+    )
+    weights = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+    bits = ((hashes[:, None] >> _BIT_SHIFTS) & np.uint64(1)).astype(np.float32)
+    votes = weights @ (2 * bits - 1)
+    return int(np.packbits(votes > 0, bitorder="little").view(np.uint64)[0])
+
+
+class SimHashIndex:
+    """
+    Near-duplicate index over 64-bit SimHash signatures.
+
+    Uses multi-index hashing: the signature is split into BANDS bands, and
+    any signature within `max_distance` bits of the query has at least one
+    band within `max_distance // BANDS` bits of the query's band. Only the
+    rows in those buckets are compared, with a vectorized XOR/popcount.
+
+    Attributes:
+        max_distance (int): Largest Hamming distance still counted as a match.
+        max_entries (int): Rows kept before the oldest half is dropped.
+    """
+
+    def __init__(self, max_distance: int, max_entries: int):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._signatures = np.empty(1024, dtype=np.uint64)
+        self._values: list = []
+        self._buckets = [dict() for _ in range(BANDS)]
+        self._probes = self._probe_masks(max_distance // BANDS)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    @staticmethod
+    def _probe_masks(radius: int) -> list:
+        masks = [0]
+        for r in range(1, radius + 1):
+            for bits in combinations(range(BAND_BITS), r):
+                masks.append(sum(1 << b for b in bits))
+        return masks
+
+    def add(self, signature: int, value):
+        if len(self._values) >= self.max_entries:
+            self._compact()
+        row = len(self._values)
+        if row == len(self._signatures):
+            self._signatures = np.resize(self._signatures, row * 2)
+        self._signatures[row] = signature
+        self._values.append(value)
+        for band, buckets in enumerate(self._buckets):
+            key = (signature >> (band * BAND_BITS)) & BAND_MASK
+            buckets.setdefault(key, []).append(row)
+
+    def query(self, signature: int, accept=None):
+        """
+        Returns (value, distance) of the closest row within `max_distance`, or None.
+
+        With `accept`, rows are tried closest first and the first whose
+        value `accept(value)` is true is returned.
+        """
+        candidates = []
+        for band, buckets in enumerate(self._buckets):
+            key = (signature >> (band * BAND_BITS)) & BAND_MASK
+            for mask in self._probes:
+                rows = buckets.get(key ^ mask)
+                if rows:
+                    candidates.extend(rows)
+        if not candidates:
+            return None
+        rows = np.fromiter(candidates, dtype=np.intp, count=len(candidates))
+        distances = np.bitwise_count(self._signatures[rows] ^ np.uint64(signature))
+        if accept is None:
+            best = int(distances.argmin())
+            if distances[best] > self.max_distance:
+                return None
+            return self._values[rows[best]], int(distances[best])
+        for i in np.argsort(distances, kind="stable"):
+            if distances[i] > self.max_distance:
+                break
+            value = self._values[rows[i]]
+            if accept(value):
+                return value, int(distances[i])
+        return None
+
+    def _compact(self):
+        # Keep the newest half and rebuild the buckets
+        keep = len(self._values) // 2
+        signatures = self._signatures[len(self._values) - keep:len(self._values)].copy()
+        values = self._values[len(self._values) - keep:]
+        self._signatures = np.empty(max(1024, keep * 2), dtype=np.uint64)
+        self._values = []
+        self._buckets = [dict() for _ in range(BANDS)]
+        for signature, value in zip(signatures.tolist(), values):
+            self.add(signature, value)
+
+
+class SemanticCache:
+    """
+    Maps near-duplicate prompts onto keys of the exact-match generation cache.
+
+    One SimHashIndex is kept per partition (model, template version and
+    template type), so prompts are only matched against the same kind of
+    request. The index stores cache keys and the prompts' content words,
+    not content; the exact cache stays responsible for TTL and eviction.
+
+    A SimHash match is only a candidate: it is served when the two prompts
+    also share at least `min_overlap` of their content words (Jaccard), which
+    rules out unrelated prompts whose signatures collide. Prompts without
+    content words (only stopwords) are neither indexed nor matched.
+
+    Attributes:
+        threshold (float): Minimum similarity (1 - distance / 64) for a candidate.
+        min_overlap (float): Minimum Jaccard similarity of the content words for a match.
+        stats (dict): Hit and miss counters.
+    """
+
+    def __init__(self, threshold: float, max_entries: int, min_overlap: float = 0.75):
+        self.threshold = threshold
+        self.min_overlap = min_overlap
+        self.max_entries = max_entries
+        self.max_distance = int(SIGNATURE_BITS * (1 - threshold))
+        self.stats = {"hits": 0, "misses": 0}
+        self._indexes: dict = {}
+
+    async def lookup(self, partition: tuple, details: str, resolve):
+        """
+        Returns `await resolve(cache_key)` for the closest indexed prompt, or None.
+
+        A match whose exact-cache entry has since expired counts as a miss.
+        """
+        features = _features(details)
+        index = self._indexes.get(partition)
+        match = None
+        if features and index is not None:
+            words = frozenset(features)
+            match = index.query(simhash(details, features), lambda value: self._overlaps(words, value[1]))
+        value = await resolve(match[0][0]) if match is not None else None
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    def add(self, partition: tuple, details: str, cache_key: str):
+        features = _features(details)
+        if not features:
+            return
+        index = self._indexes.get(partition)
+        if index is None:
+            index = self._indexes[partition] = SimHashIndex(self.max_distance, self.max_entries)
+        index.add(simhash(details, features), (cache_key, frozenset(features)))
+
+    def _overlaps(self, words: frozenset, other: frozenset) -> bool:
+        return len(words & other) >= self.min_overlap * len(words | other)
@@ -0,0 +1,196 @@
+import json
+
+# JSON escape sequences other than \uXXXX
+_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+# Parser states
+_SEEK_OBJECT = 0
+_EXPECT_KEY = 1
+_KEY = 2
+_EXPECT_COLON = 3
+_EXPECT_VALUE = 4
+_STRING_VALUE = 5
+_OTHER_VALUE = 6
+_DONE = 7
+
+
+class EnvelopeStreamParser:
+    """
+    Incremental parser for the {"type": ..., "data": ...} envelope the LLM is
+    asked to produce.
+
+    Chunks of raw model output are fed in as they arrive; `feed` returns the
+    decoded text of the `data` string that became available in that chunk.
+    Anything around the JSON object (e.g. the ```json code fence) is ignored.
+
+    Attributes:
+        fields (dict): Fully decoded top-level string fields seen so far.
+        done (bool): Whether the closing brace of the envelope was reached.
+        stray (int): Characters inside the envelope that cannot appear there
+            in valid JSON and were skipped. Missing or trailing commas are
+            not counted.
+    """
+
+    def __init__(self, stream_key: str = "data"):
+        self.stream_key = stream_key
+        self.fields: dict = {}
+        self.done = False
+        self.stray = 0
+        self._state = _SEEK_OBJECT
+        self._key: list = []
+        self._current_key = None
+        self._value: list = []
+        self._escape = False
+        self._unicode: str | None = None
+        self._high_surrogate: str | None = None
+        self._depth = 0
+        self._in_nested_string = False
+
+    def feed(self, chunk: str) -> str:
+        out = []
+        for ch in chunk:
+            if self._state == _DONE:
+                break
+            self._step(ch, out)
+        return "".join(out)
+
+    @property
+    def between_fields(self) -> bool:
+        """
+        Whether every value seen so far is complete, i.e. at most the closing brace is missing.
+        """
+        return self._state in (_EXPECT_KEY, _DONE)
+
+    def close(self) -> dict:
+        """
+        Returns the decoded fields, raising ValueError if the envelope is incomplete.
+        """
+        if not self.done or self.stream_key not in self.fields:
+            raise ValueError(f"Incomplete envelope: missing '{self.stream_key}' field")
+        return self.fields
+
+    def _step(self, ch: str, out: list):
+        state = self._state
+        if state == _SEEK_OBJECT:
+            if ch == "{":
+                self._state = _EXPECT_KEY
+        elif state == _EXPECT_KEY:
+            if ch == '"':
+                self._key = []
+                self._state = _KEY
+            elif ch == "}":
+                self.done = True
+                self._state = _DONE
+            elif ch != "," and not ch.isspace():
+                self.stray += 1
+        elif state == _KEY:
+            decoded = self._decode_string_char(ch)
+            if decoded is None:
+                self._current_key = "".join(self._key)
+                self._state = _EXPECT_COLON
+            else:
+                self._key.append(decoded)
+        elif state == _EXPECT_COLON:
+            if ch == ":":
+                self._state = _EXPECT_VALUE
+            elif not ch.isspace():
+                self.stray += 1
+        elif state == _EXPECT_VALUE:
+            if ch == '"':
+                self._value = []
+                self._state = _STRING_VALUE
+            elif not ch.isspace():
+                self._value = [ch]
+                self._depth = 1 if ch in "[{" else 0
+                self._state = _OTHER_VALUE
+        elif state == _STRING_VALUE:
+            decoded = self._decode_string_char(ch)
+            if decoded is None:
+                self.fields[self._current_key] = "".join(self._value)
+                self._state = _EXPECT_KEY
+            else:
+                self._value.append(decoded)
+                if self._current_key == self.stream_key:
+                    out.append(decoded)
+        elif state == _OTHER_VALUE:
+            self._step_other_value(ch)
+
+    def _step_other_value(self, ch: str):
+        # Numbers, literals and nested containers are not streamed, only kept
+        if self._in_nested_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_nested_string = False
+            self._value.append(ch)
+            return
+        if ch == '"':
+            self._in_nested_string = True
+        elif ch in "[{":
+            self._depth += 1
+        elif ch in "]}":
+            if self._depth == 0:
+                # End of a scalar value that was directly followed by the closing brace
+                self._finish_other_value()
+                if ch == "}":
+                    self.done = True
+                    self._state = _DONE
+                return
+            self._depth -= 1
+        elif ch == "," and self._depth == 0:
+            self._finish_other_value()
+            return
+        self._value.append(ch)
+
+    def _finish_other_value(self):
+        raw = "".join(self._value).strip()
+        try:
+            self.fields[self._current_key] = json.loads(raw)
+        except ValueError:
+            self.fields[self._current_key] = raw
+        self._state = _EXPECT_KEY
+
+    def _decode_string_char(self, ch: str) -> str | None:
+        """
+        Decodes one character of a JSON string body.
+
+        Returns None at the closing quote, "" while inside an escape sequence,
+        or the decoded text otherwise.
+        """
+        if self._unicode is not None:
+            self._unicode += ch
+            if len(self._unicode) < 4:
+                return ""
+            code = int(self._unicode, 16)
+            self._unicode = None
+            if 0xD800 <= code <= 0xDBFF:
+                self._high_surrogate = chr(code)
+                return ""
+            if 0xDC00 <= code <= 0xDFFF and self._high_surrogate:
+                pair = self._high_surrogate + chr(code)
+                self._high_surrogate = None
+                return pair.encode("utf-16", "surrogatepass").decode("utf-16")
+            return chr(code)
+        if self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode = ""
+                return ""
+            return _ESCAPES.get(ch, ch)
+        if ch == "\\":
+            self._escape = True
+            return ""
+        if ch == '"':
+            return None
+        return ch
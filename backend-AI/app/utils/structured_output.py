@@ -0,0 +1,75 @@
+import json
+
+from utils.stream_parser import EnvelopeStreamParser
+
+# How parse_envelope got the fields
+VALID = "valid"
+REPAIRED = "repaired"
+
+# JSON schema of the envelope, for models that support structured outputs
+ENVELOPE_SCHEMA = {
+    "name": "template_envelope",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "description": "Type of content e.g. blog_post, email_draft"},
+            "data": {"type": "string", "description": "The generated content itself as text"},
+        },
+        "required": ["type", "data"],
+        "additionalProperties": False,
+    },
+}
+
+
+def response_format(mode: str) -> dict | None:
+    """
+    OpenAI `response_format` for "json_schema" or "json_object"; None for anything else.
+    """
+    if mode == "json_schema":
+        return {"type": "json_schema", "json_schema": ENVELOPE_SCHEMA}
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+def _load_envelope(text: str, key: str, strict: bool) -> dict | None:
+    try:
+        fields = json.loads(text, strict=strict)
+    except ValueError:
+        return None
+    return fields if isinstance(fields, dict) and isinstance(fields.get(key), str) else None
+
+
+def parse_envelope(text: str, key: str = "data") -> tuple:
+    """
+    Decodes the {"type": ..., "data": ...} envelope from raw model output.
+
+    Returns (fields, how). Well-formed JSON, bare or in a code fence, is
+    VALID. Otherwise the span from the first "{" to the last "}" is tried
+    with raw control characters allowed, which covers prose around the
+    object and unescaped newlines. What is left goes through
+    EnvelopeStreamParser, which also gets past missing or trailing commas
+    and a missing closing brace. Both are REPAIRED. The parser's result is
+    refused if it had to skip anything else inside the object (an
+    unescaped quote in the text, single-quoted keys), since the fields
+    could then be silently cut short. Raises ValueError when the envelope
+    cannot be recovered.
+    """
+    stripped = text.strip()
+    if stripped.startswith("```") and stripped.endswith("```"):
+        # Code fence as the format instructions ask for; drop the ```json line
+        stripped = stripped[stripped.find("\n") + 1:-3]
+    fields = _load_envelope(stripped, key, strict=True)
+    if fields is not None:
+        return fields, VALID
+    start, end = text.find("{"), text.rfind("}")
+    if 0 <= start < end:
+        fields = _load_envelope(text[start:end + 1], key, strict=False)
+        if fields is not None:
+            return fields, REPAIRED
+    parser = EnvelopeStreamParser(key)
+    parser.feed(text)
+    if not isinstance(parser.fields.get(key), str) or parser.stray or not parser.between_fields:
+        raise ValueError(f"Could not parse the model output: no well-formed '{key}' field")
+    return parser.fields, REPAIRED
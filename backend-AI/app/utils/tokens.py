@@ -0,0 +1,62 @@
+import math
+import re
+
+# Rough equivalent of the OpenAI BPE pre-tokenizer: contractions, runs of
+# letters, 1-3 digits, punctuation runs and whitespace
+_PIECE_RE = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+
+# Tokens the chat format adds around a single user message
+MESSAGE_OVERHEAD_TOKENS = 7
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Offline estimate of how many tokens `text` encodes to.
+
+    Counts pre-tokenizer pieces (most English words are one token each) and
+    never goes below one token per four UTF-8 bytes, which covers long or
+    non-English words. Tends to overestimate slightly, which is the safe side
+    for a quota check; the actual usage reported by the model is what gets
+    charged.
+    """
+    if not text:
+        return 0
+    return max(len(_PIECE_RE.findall(text)), math.ceil(len(text.encode("utf-8")) / 4))
+
+
+class TokenMeter:
+    """
+    Collects the tokens one request actually consumed upstream.
+
+    Calls served from a cache never touch the meter, so they cost nothing.
+
+    Attributes:
+        input_tokens (int): Prompt tokens billed by the model.
+        output_tokens (int): Completion tokens billed by the model.
+        truncated (bool): Whether a completion was cut off by `max_tokens`.
+    """
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.truncated = False
+
+    @property
+    def total(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def merge(self, other: "TokenMeter"):
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.truncated = self.truncated or other.truncated
+
+    def record(self, usage_metadata: dict | None, prompt: str, completion: str):
+        """
+        Adds one call's usage, estimating it from the texts if the model did not report any.
+        """
+        if usage_metadata:
+            self.input_tokens += usage_metadata.get("input_tokens", 0)
+            self.output_tokens += usage_metadata.get("output_tokens", 0)
+        else:
+            self.input_tokens += estimate_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS
+            self.output_tokens += estimate_tokens(completion)
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import date
+
+import crud
+from settings import MAX_COMPLETION_TOKENS
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+USAGE_BUFFER_ENABLED = os.getenv("USAGE_BUFFER_ENABLED", "false").lower() == "true"
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "1.0"))
+USAGE_FLUSH_MAX_USERS = int(os.getenv("USAGE_FLUSH_MAX_USERS", "500"))
+# Most tokens one worker may charge a user before it must sync with Postgres.
+# Counted in model tokens like the holds it buffers: a text generation holds
+# its prompt plus up to MAX_COMPLETION_TOKENS, so the default leaves room for
+# about two of them between flushes
+USAGE_MAX_PENDING_TOKENS = int(os.getenv("USAGE_MAX_PENDING_TOKENS", str(2 * MAX_COMPLETION_TOKENS)))
+USAGE_IDLE_SECONDS = float(os.getenv("USAGE_IDLE_SECONDS", "600"))
+
+
+class _UserUsage:
+    __slots__ = ("day", "base", "pending", "touched")
+
+    def __init__(self, day: date, base: int):
+        self.day = day
+        self.base = base  # tokens_used in Postgres as of the last sync
+        self.pending = 0  # charged here but not flushed yet
+        self.touched = time.monotonic()
+
+
+class UsageBuffer:
+    """
+    Write-behind accumulator in front of the user_tokens table.
+
+    Quota checks run against an in-memory view (last synced total plus
+    unflushed local charges) and deltas are flushed in one multi-row UPSERT
+    every `flush_interval` seconds, or sooner once `flush_max_users` users
+    have pending deltas. Each flush also pulls back the authoritative totals,
+    so charges from other workers are picked up.
+
+    The quota can be overshot by at most `max_pending` tokens per user per
+    worker: a user whose unflushed charges would exceed it forces a flush
+    before the next charge is accepted, and a single charge larger than
+    `max_pending` is not buffered at all but checked and charged in
+    Postgres directly.
+    """
+
+    def __init__(self, flush_interval: float, flush_max_users: int, max_pending: int, idle_seconds: float):
+        self.flush_interval = flush_interval
+        self.flush_max_users = flush_max_users
+        self.max_pending = max_pending
+        self.idle_seconds = idle_seconds
+        self.stats = {
+            "reserved": 0, "rejected": 0, "flushes": 0, "forced_flushes": 0, "direct": 0,
+            "flushed_rows": 0, "flush_errors": 0,
+        }
+        self._users: dict = {}
+        self._dirty: set = set()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def _entry(self, user_id: int) -> _UserUsage:
+        today = date.today()
+        entry = self._users.get(user_id)
+        if entry is not None and entry.day != today:
+            # Settle yesterday's charges before starting a fresh day
+            await self.flush()
+            if self._users.get(user_id) is entry:
+                del self._users[user_id]
+            entry = None
+        if entry is None:
+            async with AsyncSessionLocal() as db:
+                usage = await crud.get_token_usage(db, user_id)
+            base = (usage[0] or 0) if usage is not None and usage[1] == today else 0
+            entry = self._users.setdefault(user_id, _UserUsage(today, base))
+        entry.touched = time.monotonic()
+        return entry
+
+    async def reserve(self, user_id: int, tokens: int, limit: int) -> int | None:
+        """
+        Charges `tokens` locally; returns the new daily total or None if over `limit`.
+        """
+        entry = await self._entry(user_id)
+        if tokens > self.max_pending:
+            return await self._reserve_direct(user_id, entry, tokens, limit)
+        if entry.pending + tokens > self.max_pending:
+            self.stats["forced_flushes"] += 1
+            await self.flush()
+            if entry.pending + tokens > self.max_pending:
+                # Charged again by concurrent requests while flushing
+                return await self._reserve_direct(user_id, entry, tokens, limit)
+        if entry.base + entry.pending + tokens > limit:
+            self.stats["rejected"] += 1
+            return None
+        entry.pending += tokens
+        self.stats["reserved"] += 1
+        self._mark_dirty(user_id)
+        return entry.base + entry.pending
+
+    async def _reserve_direct(self, user_id: int, entry: _UserUsage, tokens: int, limit: int) -> int | None:
+        # Atomic check in Postgres, leaving room for what is still unflushed here
+        async with AsyncSessionLocal() as db:
+            total = await crud.reserve_tokens(db, user_id, tokens, limit - entry.pending)
+        self.stats["direct"] += 1
+        if total is None:
+            self.stats["rejected"] += 1
+            return None
+        self.stats["reserved"] += 1
+        if entry.day == date.today():
+            # A flush that finished meanwhile may already have synced a newer total
+            entry.base = max(entry.base, total)
+        return total + entry.pending
+
+    async def used(self, user_id: int) -> int:
+        """
+        Today's total as this worker sees it: last synced total plus unflushed charges.
+        """
+        entry = await self._entry(user_id)
+        return entry.base + entry.pending
+
+    async def refund(self, user_id: int, tokens: int, day: date):
+        """
+        Gives `tokens` charged on `day` back to the user (a negative amount
+        charges them).
+
+        Buffered like a charge when this worker holds the user's entry for
+        that day; otherwise (entry evicted or already on the next day, hold
+        taken by another worker or before a restart) written straight to
+        Postgres as a delta against `day`.
+        """
+        entry = self._users.get(user_id)
+        if entry is not None and entry.day == day:
+            entry.pending -= tokens
+            self._mark_dirty(user_id)
+            return
+        async with AsyncSessionLocal() as db:
+            await crud.apply_token_deltas(db, [(user_id, day, -tokens)])
+
+    def _mark_dirty(self, user_id: int):
+        self._dirty.add(user_id)
+        if len(self._dirty) >= self.flush_max_users:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            batch = []
+            for user_id in sorted(dirty):
+                entry = self._users[user_id]
+                if entry.pending:
+                    batch.append((user_id, entry.day, entry.pending))
+                    entry.pending = 0
+            try:
+                async with AsyncSessionLocal() as db:
+                    totals = await crud.apply_token_deltas(db, batch)
+            except BaseException:
+                # Put the deltas back so the next flush retries them
+                for user_id, day, delta in batch:
+                    entry = self._users[user_id]
+                    if entry.day == day:
+                        entry.pending += delta
+                    self._dirty.add(user_id)
+                self.stats["flush_errors"] += 1
+                raise
+            for user_id, day, delta in batch:
+                entry = self._users[user_id]
+                if user_id in totals and entry.day == day:
+                    entry.base = totals[user_id]
+            self.stats["flushes"] += 1
+            self.stats["flushed_rows"] += len(batch)
+            self._evict_idle()
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        idle = [
+            user_id for user_id, entry in self._users.items()
+            if entry.touched < cutoff and not entry.pending and user_id not in self._dirty
+        ]
+        for user_id in idle:
+            del self._users[user_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Usage flush failed; deltas kept for the next attempt")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        Stops the background flusher and writes out everything still pending.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+usage_buffer = None
+if USAGE_BUFFER_ENABLED:
+    usage_buffer = UsageBuffer(
+        USAGE_FLUSH_INTERVAL_SECONDS,
+        USAGE_FLUSH_MAX_USERS,
+        USAGE_MAX_PENDING_TOKENS,
+        USAGE_IDLE_SECONDS,
+    )
@@ -0,0 +1,67 @@
+"""
+Per-request cost of get_current_user with and without the principal cache.
+
+Needs the app's DB_* variables plus SECRET_KEY/ALGORITHM; a benchmark user
+is created on first run.
+
+Usage:
+    python benchmarks/bench_auth.py --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import crud  # noqa: E402
+import dependencies  # noqa: E402
+from database import AsyncSessionLocal, engine, init_db  # noqa: E402
+from utils.auth import create_access_token  # noqa: E402
+from utils.principal_cache import PrincipalCache  # noqa: E402
+
+BENCH_EMAIL = "auth-bench@example.com"
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def measure(token: str, requests: int) -> dict:
+    timings = []
+    for _ in range(requests):
+        # A fresh session per call, like the per-request get_db dependency
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            await dependencies.get_current_user(token, db)
+            timings.append((time.perf_counter() - start) * 1e6)
+    return {
+        "mean_us": round(sum(timings) / len(timings), 1),
+        "p50_us": round(percentile(timings, 0.50), 1),
+        "p99_us": round(percentile(timings, 0.99), 1),
+    }
+
+
+async def run(requests: int) -> dict:
+    await init_db()
+    async with AsyncSessionLocal() as db:
+        if await crud.get_user_by_email(db, BENCH_EMAIL) is None:
+            await crud.create_user(db, email=BENCH_EMAIL, username="auth-bench", password="!")
+    token = create_access_token({"sub": BENCH_EMAIL})
+
+    dependencies.principal_cache = None
+    uncached = await measure(token, requests)
+    dependencies.principal_cache = PrincipalCache(ttl=60, max_entries=10_000)
+    cached = await measure(token, requests)
+    await engine.dispose()
+    return {"requests": requests, "uncached": uncached, "cached": cached}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.requests)), indent=2))
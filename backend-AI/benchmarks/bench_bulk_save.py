@@ -0,0 +1,75 @@
+"""
+Saving N outputs one request at a time through /save/save-output versus
+one request to /save/save-outputs.
+
+Runs the app in-process over httpx's ASGI transport. Needs the app's DB_*
+variables plus SECRET_KEY/ALGORITHM; a benchmark user is created on first run.
+
+Usage:
+    python benchmarks/bench_bulk_save.py --outputs 1000 --content-bytes 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import crud  # noqa: E402
+from database import AsyncSessionLocal, engine, init_db  # noqa: E402
+from main import app  # noqa: E402
+from utils.auth import create_access_token  # noqa: E402
+
+BENCH_EMAIL = "save-bench@example.com"
+
+
+async def run(outputs: int, content_bytes: int) -> dict:
+    await init_db()
+    async with AsyncSessionLocal() as db:
+        if await crud.get_user_by_email(db, BENCH_EMAIL) is None:
+            await crud.create_user(db, email=BENCH_EMAIL, username="save-bench", password="!")
+    headers = {"Authorization": "Bearer " + create_access_token({"sub": BENCH_EMAIL})}
+    items = [
+        {"template_type": "blog_post", "content": (f"post {i} " + "x" * content_bytes)[:content_bytes]}
+        for i in range(outputs)
+    ]
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        for item in items:
+            response = await client.post("/save/save-output", json=item, headers=headers)
+            response.raise_for_status()
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = await client.post("/save/save-outputs", json={"items": items}, headers=headers)
+        response.raise_for_status()
+        bulk = time.perf_counter() - start
+        assert len(response.json()) == outputs
+    await engine.dispose()
+    return {
+        "outputs": outputs,
+        "content_bytes": content_bytes,
+        "single_seconds": round(single, 3),
+        "single_per_output_ms": round(single / outputs * 1e3, 3),
+        "bulk_seconds": round(bulk, 3),
+        "bulk_per_output_ms": round(bulk / outputs * 1e3, 3),
+        "speedup": round(single / bulk, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--outputs", type=int, default=1000)
+    parser.add_argument("--content-bytes", type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.outputs, args.content_bytes)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
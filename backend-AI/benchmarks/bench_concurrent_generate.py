@@ -0,0 +1,76 @@
+"""
+Shows that concurrent text generations overlap instead of queueing behind
+each other on the event loop.
+
+A stub LLM that sleeps for `--latency` seconds stands in for OpenAI. With the
+async pipeline, N concurrent calls should finish in roughly one latency,
+not N times that. Exits non-zero when they take 2x the wall time of a single
+call or more, so it can gate CI. Keep --calls within
+GENERATION_MAX_CONCURRENCY, since calls past it queue by design.
+
+Usage:
+    python benchmarks/bench_concurrent_generate.py --calls 20 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("OPEN_API_KEY", "sk-benchmark")
+
+from utils import openai_api  # noqa: E402
+
+
+class StubMessage:
+    def __init__(self, content: str):
+        self.content = content
+        self.usage_metadata = None
+        self.response_metadata = {"finish_reason": "stop"}
+
+
+class StubLLM:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def ainvoke(self, prompt, **kwargs):
+        await asyncio.sleep(self.latency)
+        return StubMessage(
+            '```json\n{"type": "blog_post", "data": "stub content"}\n```'
+        )
+
+
+async def run(calls: int, latency: float) -> dict:
+    openai_api.llm = StubLLM(latency)
+    # Warm-up, so imports and prompt setup are not in the single-call time
+    await openai_api.generate_text_template("blog_post", "warm-up topic", user_id=calls)
+    start = time.perf_counter()
+    await openai_api.generate_text_template("blog_post", "single topic", user_id=calls)
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        openai_api.generate_text_template("blog_post", f"topic {i}", user_id=i)
+        for i in range(calls)
+    ))
+    elapsed = time.perf_counter() - start
+    return {
+        "calls": calls,
+        "stub_latency_s": latency,
+        "single_call_s": round(single, 4),
+        "elapsed_s": round(elapsed, 4),
+        "serial_equivalent_s": round(calls * latency, 4),
+        "speedup": round(calls * latency / elapsed, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+    report = asyncio.run(run(args.calls, args.latency))
+    print(json.dumps(report, indent=2))
+    assert report["elapsed_s"] < 2 * report["single_call_s"], "concurrent calls did not overlap"
@@ -0,0 +1,294 @@
+"""
+Storage size and read/write latency of saved output content: stored inline
+in saved_outputs (the old layout) versus compressed and deduplicated in
+content_blobs.
+
+The corpus is English prose, namely the docstrings of the Python standard
+library. They are assembled into blog posts (--blog-words) and email
+drafts, and --duplicate-rate of the saves repeat an earlier text of the
+same user. Both layouts get the same saves, in a scratch schema that is
+dropped afterwards. The new layout goes through the app's own crud
+functions, and the old one is queried the way crud used to. Both keep the
+search_vector, so its share is reported separately.
+
+Needs the app's DB_* variables. CONTENT_COMPRESSION=zlib compares the
+zlib fallback.
+
+Usage:
+    python benchmarks/bench_content_store.py --outputs 20000 --users 200 --duplicate-rate 0.2
+"""
+import argparse
+import ast
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import sysconfig
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, Computed, DateTime, Index, Integer, String, Text, event, func, select, text
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import declarative_base, deferred
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import crud  # noqa: E402
+from database import AsyncSessionLocal, engine  # noqa: E402
+from models import Base, User  # noqa: E402
+from utils import content_store  # noqa: E402
+
+SCHEMA = "bench_content"
+
+InlineBase = declarative_base()
+
+
+class InlineOutput(InlineBase):
+    # saved_outputs as it was before content_blobs, queried the way crud did
+    __tablename__ = "inline_outputs"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    template_type = Column(String(50), nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    search_vector = deferred(Column(TSVECTOR, Computed("to_tsvector('english', content)", persisted=True)))
+
+    __table_args__ = (
+        Index("ix_inline_outputs_user_created", "user_id", "created_at", "id"),
+        Index("ix_inline_outputs_search", "search_vector", postgresql_using="gin"),
+    )
+
+
+@event.listens_for(engine.sync_engine, "connect", insert=True)
+def _use_scratch_schema(dbapi_connection, connection_record):
+    # Point the app's unqualified table names at the scratch schema. Outside
+    # a transaction, so that the first rollback does not undo it.
+    autocommit = dbapi_connection.autocommit
+    dbapi_connection.autocommit = True
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET SESSION search_path TO {SCHEMA}")
+    cursor.close()
+    dbapi_connection.autocommit = autocommit
+
+
+def stdlib_paragraphs() -> list:
+    paragraphs = []
+    root = sysconfig.get_paths()["stdlib"]
+    for name in sorted(os.listdir(root)):
+        if not name.endswith(".py"):
+            continue
+        try:
+            with open(os.path.join(root, name), encoding="utf-8") as f:
+                tree = ast.parse(f.read())
+        except (SyntaxError, UnicodeDecodeError):
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                doc = ast.get_docstring(node)
+                if doc:
+                    paragraphs.extend(" ".join(p.split()) for p in doc.split("\n\n") if len(p.split()) >= 12)
+    return paragraphs
+
+
+def build_corpus(args, rng: random.Random) -> list:
+    """
+    (user index, template_type, content) per save, in save order.
+    """
+    paragraphs = stdlib_paragraphs()
+    saves, history = [], {}
+    for _ in range(args.outputs):
+        user = rng.randrange(args.users)
+        earlier = history.get(user)
+        if earlier and rng.random() < args.duplicate_rate:
+            saves.append((user, *rng.choice(earlier)))
+            continue
+        if rng.random() < 0.6:
+            words, body = 0, [rng.choice(paragraphs).split(".")[0].title()]
+            while words < args.blog_words:
+                body.append(rng.choice(paragraphs))
+                words += len(body[-1].split())
+            item = ("blog_post", "\n\n".join(body))
+        else:
+            body = ["Hi team,"] + rng.sample(paragraphs, rng.randint(1, 3)) + ["Best regards,\nAlex"]
+            item = ("email_draft", "\n\n".join(body))
+        history.setdefault(user, []).append(item)
+        saves.append((user, *item))
+    return saves
+
+
+def summary(timings: list) -> dict:
+    timings = sorted(timings)
+    return {
+        "mean_ms": round(statistics.mean(timings) * 1e3, 3),
+        "p50_ms": round(timings[len(timings) // 2] * 1e3, 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95)] * 1e3, 3),
+    }
+
+
+async def table_sizes(conn, table: str) -> dict:
+    row = (await conn.execute(text(
+        "SELECT pg_relation_size(c.oid) AS heap, coalesce(pg_total_relation_size(nullif(c.reltoastrelid, 0)), 0) AS toast, "
+        "pg_indexes_size(c.oid) AS indexes FROM pg_class c WHERE c.oid = CAST(:t AS regclass)"
+    ), {"t": f"{SCHEMA}.{table}"})).one()
+    return {"heap_mb": round(row.heap / 2**20, 2), "toast_mb": round(row.toast / 2**20, 2),
+            "indexes_mb": round(row.indexes / 2**20, 2), "total_mb": round((row.heap + row.toast + row.indexes) / 2**20, 2)}
+
+
+async def setup(user_count: int) -> list:
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(InlineBase.metadata.create_all)
+        await conn.execute(
+            User.__table__.insert(),
+            [{"username": f"bench{i}", "email": f"bench{i}@example.com", "hashed_password": "!"} for i in range(user_count)],
+        )
+        return list((await conn.scalars(text("SELECT id FROM users ORDER BY id"))).all())
+
+
+async def write(saves: list, user_ids: list) -> tuple:
+    inline_times, blob_times = [], []
+    inline_ids, blob_ids = [], []
+    insert_inline = insert(InlineOutput).returning(InlineOutput.id, InlineOutput.template_type, InlineOutput.created_at)
+    for user, template_type, content in saves:
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            row = (await db.execute(insert_inline, [{
+                "user_id": user_ids[user], "template_type": template_type, "content": content, "created_at": datetime.now(),
+            }])).one()
+            await db.commit()
+            inline_ids.append((user_ids[user], row.id))
+            inline_times.append(time.perf_counter() - start)
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            [row] = await crud.create_outputs(db, user_ids[user], [(template_type, content)], datetime.now())
+            blob_times.append(time.perf_counter() - start)
+            blob_ids.append((user_ids[user], row.id))
+    return {"inline": summary(inline_times), "blobs": summary(blob_times)}, inline_ids, blob_ids
+
+
+async def read(args, rng: random.Random, user_ids: list, inline_ids: list, blob_ids: list) -> dict:
+    results = {"get_output": {}, "list_page": {}}
+    sample = rng.sample(range(len(inline_ids)), min(args.reads, len(inline_ids)))
+
+    times = []
+    for i in sample:
+        user_id, output_id = inline_ids[i]
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            output = await db.scalar(
+                select(InlineOutput).where(InlineOutput.id == output_id, InlineOutput.user_id == user_id)
+            )
+            output.content
+            times.append(time.perf_counter() - start)
+    results["get_output"]["inline"] = summary(times)
+    times = []
+    for i in sample:
+        user_id, output_id = blob_ids[i]
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            output = await crud.get_output(db, user_id, output_id)
+            output.content
+            times.append(time.perf_counter() - start)
+    results["get_output"]["blobs"] = summary(times)
+
+    list_inline = (
+        select(
+            InlineOutput.id,
+            InlineOutput.template_type,
+            func.substr(InlineOutput.content, 1, 200).label("preview"),
+            func.octet_length(InlineOutput.content).label("content_bytes"),
+            InlineOutput.created_at,
+        )
+        .order_by(InlineOutput.created_at.desc(), InlineOutput.id.desc())
+        .limit(21)
+    )
+    users = [rng.choice(user_ids) for _ in range(args.reads)]
+    times = []
+    for user_id in users:
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            (await db.execute(list_inline.where(InlineOutput.user_id == user_id))).all()
+            times.append(time.perf_counter() - start)
+    results["list_page"]["inline"] = summary(times)
+    times = []
+    for user_id in users:
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            await crud.list_output_previews(db, user_id, 21, 200)
+            times.append(time.perf_counter() - start)
+    results["list_page"]["blobs"] = summary(times)
+    return results
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    saves = build_corpus(args, rng)
+    raw_bytes = sum(len(content.encode("utf-8")) for _, _, content in saves)
+    distinct = {content for _, _, content in saves}
+    user_ids = await setup(args.users)
+    try:
+        latency, inline_ids, blob_ids = await write(saves, user_ids)
+        async with engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text(f"VACUUM ANALYZE {SCHEMA}.inline_outputs, {SCHEMA}.saved_outputs, {SCHEMA}.content_blobs"))
+            storage = {
+                "inline": {"inline_outputs": await table_sizes(conn, "inline_outputs")},
+                "blobs": {
+                    "saved_outputs": await table_sizes(conn, "saved_outputs"),
+                    "content_blobs": await table_sizes(conn, "content_blobs"),
+                },
+            }
+            storage["inline"]["total_mb"] = storage["inline"]["inline_outputs"]["total_mb"]
+            storage["blobs"]["total_mb"] = round(
+                storage["blobs"]["saved_outputs"]["total_mb"] + storage["blobs"]["content_blobs"]["total_mb"], 2
+            )
+            columns = (await conn.execute(text(
+                "SELECT (SELECT sum(pg_column_size(content)) FROM inline_outputs) AS inline_content, "
+                "(SELECT sum(pg_column_size(data)) FROM content_blobs) AS blob_data, "
+                "(SELECT sum(pg_column_size(search_vector)) FROM saved_outputs) AS search_vector, "
+                "(SELECT json_object_agg(encoding, n) FROM (SELECT encoding, count(*) AS n FROM content_blobs GROUP BY encoding) e) AS encodings"
+            ))).one()
+        latency_reads = await read(args, rng, user_ids, inline_ids, blob_ids)
+    finally:
+        if not args.keep:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await engine.dispose()
+    return {
+        "compression": content_store.CONTENT_COMPRESSION if content_store.zstandard else "zlib",
+        "outputs": len(saves),
+        "distinct_texts": len(distinct),
+        "raw_mb": round(raw_bytes / 2**20, 2),
+        "avg_bytes": round(raw_bytes / len(saves)),
+        "stored_mb": {
+            "inline_content_pglz": round(columns.inline_content / 2**20, 2),
+            "blob_data": round(columns.blob_data / 2**20, 2),
+            "search_vector": round(columns.search_vector / 2**20, 2),
+        },
+        "blob_encodings": columns.encodings,
+        "storage": storage,
+        "write_latency": latency,
+        "read_latency": latency_reads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--outputs", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--duplicate-rate", type=float, default=0.2)
+    parser.add_argument("--blog-words", type=int, default=600)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch schema for inspection")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Tail latency of text generation with and without hedged requests, against
+local fake providers (benchmarks/fake_openai.py).
+
+The primary provider sends --tail-rate of its calls into a --tail-latency
+slow tail. With --fallback a second, healthy provider is started and
+configured as LLM_FALLBACK_MODELS, so hedges and failovers go there;
+without it hedges go back to the primary. --primary-error-rate makes the
+primary fail outright, to watch failover and the circuit breaker.
+
+The same calls run once with hedging off (LLM_MAX_ATTEMPTS=1) and once on.
+The hedge delay adapts from the latencies seen in the first run.
+
+Usage:
+    python benchmarks/bench_hedging.py --calls 300 --concurrency 10 --tail-rate 0.05 --tail-latency 5
+    python benchmarks/bench_hedging.py --fallback --primary-error-rate 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+from load_test import free_port, percentile, wait_ready
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "app"))
+
+
+def start_fake(port: int, *options) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, os.path.join(HERE, "fake_openai.py"), "--port", str(port), *options])
+
+
+async def run_calls(openai_api, calls: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+    errors = {}
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await openai_api.generate_text_template("blog_post", uuid.uuid4().hex, use_cache=False)
+            except Exception as e:
+                key = str(getattr(e, "status_code", type(e).__name__))
+                errors[key] = errors.get(key, 0) + 1
+                return
+            timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(calls)))
+    elapsed = time.perf_counter() - start
+    result = {"ok": len(timings), "errors": errors, "elapsed_s": round(elapsed, 3)}
+    if timings:
+        for name, q in (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            result[name] = round(percentile(timings, q) * 1e3, 1)
+        result["max_ms"] = round(max(timings) * 1e3, 1)
+    return result
+
+
+def upstream_calls(ports: dict) -> dict:
+    return {name: httpx.get(f"http://127.0.0.1:{port}/stats").json() for name, port in ports.items()}
+
+
+async def run(args) -> dict:
+    from utils import metrics, openai_api
+
+    router = openai_api.router
+    results = {"models": router.models}
+    for name, attempts in (("hedging_off", 1), ("hedging_on", args.max_attempts)):
+        router.max_attempts = attempts
+        hedges_before = {r: metrics.llm_hedges.labels(r)._value.get() for r in ("delay", "failover")}
+        results[name] = await run_calls(openai_api, args.calls, args.concurrency)
+        results[name]["hedges"] = {
+            r: int(metrics.llm_hedges.labels(r)._value.get() - before) for r, before in hedges_before.items()
+        }
+        results[name]["hedge_delay_s"] = round(router.hedge_delay(router.models[0], openai_api.LLM_LATENCY_SLO_SECONDS), 3)
+        results[name]["circuits"] = {model: breaker.state for model, breaker in router.breakers.items()}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--tail-latency", type=float, default=5.0)
+    parser.add_argument("--primary-error-rate", type=float, default=0.0)
+    parser.add_argument("--fallback", action="store_true", help="start a healthy fallback provider")
+    parser.add_argument("--max-attempts", type=int, default=2)
+    args = parser.parse_args()
+
+    ports = {"primary": free_port()}
+    processes = [start_fake(
+        ports["primary"],
+        "--latency", str(args.latency),
+        "--tail-rate", str(args.tail_rate),
+        "--tail-latency", str(args.tail_latency),
+        "--error-rate", str(args.primary_error_rate),
+    )]
+    if args.fallback:
+        ports["fallback"] = free_port()
+        processes.append(start_fake(ports["fallback"], "--latency", str(args.latency)))
+        os.environ["LLM_FALLBACK_MODELS"] = f"gpt-4o-mini@http://127.0.0.1:{ports['fallback']}/v1"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{ports['primary']}/v1"
+    os.environ.setdefault("OPEN_API_KEY", "sk-benchmark")
+    os.environ["GENERATION_MAX_CONCURRENCY"] = str(args.concurrency * args.max_attempts)
+    try:
+        for port in ports.values():
+            wait_ready(f"http://127.0.0.1:{port}/stats")
+        results = asyncio.run(run(args))
+        results["upstream_calls"] = upstream_calls(ports)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Login throughput, and latency of a cheap endpoint while logins are running,
+with bcrypt inline on the event loop versus on the password-hash pool.
+
+Runs the app in-process over httpx's ASGI transport. Needs the app's DB_*
+variables plus SECRET_KEY/ALGORITHM; a benchmark user is created on first run.
+
+Usage:
+    python benchmarks/bench_login_storm.py --logins 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import crud  # noqa: E402
+from database import AsyncSessionLocal, engine, init_db  # noqa: E402
+from main import app  # noqa: E402
+from utils import auth  # noqa: E402
+
+BENCH_EMAIL = "login-bench@example.com"
+BENCH_PASSWORD = "login-bench-password"
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def storm(client: httpx.AsyncClient, logins: int, concurrency: int) -> dict:
+    remaining = logins
+    statuses: dict = {}
+    ping_timings = []
+    done = asyncio.Event()
+
+    async def login_worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            response = await client.post("/auth/login", json={"email": BENCH_EMAIL, "password": BENCH_PASSWORD})
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async def pinger():
+        # A cheap route that only needs the event loop to be free
+        while not done.is_set():
+            start = time.perf_counter()
+            await client.get("/protected", headers={"Authorization": "Bearer x"})
+            ping_timings.append((time.perf_counter() - start) * 1e3)
+            await asyncio.sleep(0.005)
+
+    ping_task = asyncio.create_task(pinger())
+    start = time.perf_counter()
+    await asyncio.gather(*(login_worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ping_task
+    return {
+        "logins_per_second": round(logins / elapsed, 1),
+        "statuses": statuses,
+        "ping_p50_ms": round(percentile(ping_timings, 0.50), 2),
+        "ping_p99_ms": round(percentile(ping_timings, 0.99), 2),
+        "pings": len(ping_timings),
+    }
+
+
+async def run(logins: int, concurrency: int, workers: int, max_queue: int) -> dict:
+    await init_db()
+    async with AsyncSessionLocal() as db:
+        if await crud.get_user_by_email(db, BENCH_EMAIL) is None:
+            await crud.create_user(
+                db, email=BENCH_EMAIL, username="login-bench", password=await auth.hash_password(BENCH_PASSWORD)
+            )
+
+    results = {"logins": logins, "concurrency": concurrency}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name, pool_workers in (("inline", 0), ("pool", workers)):
+            auth.password_hasher = auth.PasswordHasher(pool_workers, max_queue)
+            results[name] = await storm(client, logins, concurrency)
+            auth.password_hasher.shutdown()
+    await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=auth.PASSWORD_HASH_WORKERS)
+    parser.add_argument("--max-queue", type=int, default=auth.PASSWORD_HASH_MAX_QUEUE)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.logins, args.concurrency, args.workers, args.max_queue)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
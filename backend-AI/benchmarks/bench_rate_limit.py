@@ -0,0 +1,70 @@
+"""
+Cost of the rate limiter's bucket stores: time per acquire() and memory
+per tracked key.
+
+Each call charges a user bucket and an IP bucket, as the middleware does
+for an authenticated request, cycling over --keys distinct users. The
+rules refill slowly, so no bucket is full again (and evicted as idle)
+during the run. The in-memory store runs once with room for every key
+and once capped at --max-keys, to show the cap holding memory flat. The
+SQLite stand-in runs in a temporary file. Memory is measured in a second
+pass, since tracing allocations slows the calls down.
+
+Usage:
+    python benchmarks/bench_rate_limit.py --keys 200000 --max-keys 50000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from utils.rate_limit import InMemoryRateLimitBackend, Rule, SqliteRateLimitBackend  # noqa: E402
+
+USER_RULE = Rule(30, 3600)
+IP_RULE = Rule(10_000, 3600)
+
+
+def calls(backend, keys: int, count: int):
+    for i in range(count):
+        user = i % keys
+        backend.acquire([(f"/generate:user:{user}@example.com", USER_RULE), (f"/generate:ip:10.0.{user % 256}.1", IP_RULE)])
+
+
+def run(make_backend, keys: int, count: int) -> dict:
+    backend = make_backend()
+    start = time.perf_counter()
+    calls(backend, keys, count)
+    elapsed = time.perf_counter() - start
+    result = {"calls": count, "us_per_acquire": round(elapsed / count * 1e6, 2)}
+    if isinstance(backend, InMemoryRateLimitBackend):
+        result["keys_held"] = len(backend)
+        tracemalloc.start()
+        calls(make_backend(), keys, count)
+        result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=200_000)
+    parser.add_argument("--max-keys", type=int, default=50_000)
+    parser.add_argument("--sqlite-calls", type=int, default=20_000)
+    args = parser.parse_args()
+    results = {
+        "memory": run(lambda: InMemoryRateLimitBackend(max_keys=args.keys * 2), args.keys, args.keys),
+        "memory_capped": run(lambda: InMemoryRateLimitBackend(max_keys=args.max_keys), args.keys, args.keys),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rate_limits.sqlite3")
+        results["sqlite"] = run(lambda: SqliteRateLimitBackend(path), args.keys, args.sqlite_calls)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
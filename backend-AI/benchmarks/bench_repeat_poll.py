@@ -0,0 +1,136 @@
+"""
+Bytes on the wire and latency of a client polling /auth/profile and
+/save/outputs when nothing has changed.
+
+Each endpoint is polled three ways: a plain request (identity encoding,
+no validator, as the frontend polled before), a compressed request
+(Accept-Encoding: br, gzip) and a revalidation with If-None-Match, which
+gets a 304. Wire bytes are the status line, headers and body as sent by
+the app. The app runs in-process over httpx's ASGI transport, so the
+latencies exclude the network; rate limiting is turned off. Also compares
+rendering one listing page with the standard json module and orjson.
+
+Needs the app's DB_* variables plus SECRET_KEY/ALGORITHM; a benchmark user
+with --outputs outputs is created on first run.
+
+Usage:
+    python benchmarks/bench_repeat_poll.py --outputs 200 --polls 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import crud  # noqa: E402
+from database import AsyncSessionLocal, engine, init_db  # noqa: E402
+from main import app  # noqa: E402
+from utils.auth import create_access_token  # noqa: E402
+from utils.responses import orjson  # noqa: E402
+
+BENCH_EMAIL = "poll-bench@example.com"
+ENDPOINTS = {
+    "profile": "/auth/profile",
+    "outputs_20": "/save/outputs?limit=20",
+    "outputs_100": "/save/outputs?limit=100",
+}
+
+
+def sample_texts(count: int, words: int) -> list:
+    # Prose-like text from the words of a few stdlib docstrings
+    vocabulary = " ".join(module.__doc__ or "" for module in (json, random, asyncio, httpx)).split()
+    rng = random.Random(0)
+    return [" ".join(rng.choices(vocabulary, k=words)) for _ in range(count)]
+
+
+async def seed(outputs: int) -> dict:
+    async with AsyncSessionLocal() as db:
+        user = await crud.get_user_by_email(db, BENCH_EMAIL)
+        if user is None:
+            user = await crud.create_user(db, email=BENCH_EMAIL, username="poll-bench", password="!")
+        have = sum((await crud.count_outputs_by_type(db, user.id)).values())
+        if have < outputs:
+            texts = sample_texts(outputs - have, 300)
+            await crud.create_outputs(db, user.id, [("blog_post", text) for text in texts], datetime.now())
+    return {"Authorization": "Bearer " + create_access_token({"sub": BENCH_EMAIL})}
+
+
+def wire_bytes(response: httpx.Response) -> int:
+    status_line = len(f"HTTP/1.1 {response.status_code} {response.reason_phrase}\r\n")
+    headers = sum(len(name) + len(value) + 4 for name, value in response.headers.raw)
+    return status_line + headers + 2 + response.num_bytes_downloaded
+
+
+async def poll(client, path: str, headers: dict, polls: int) -> dict:
+    timings = []
+    for _ in range(polls):
+        start = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        await response.aread()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "status": response.status_code,
+        "wire_bytes": wire_bytes(response),
+        "encoding": response.headers.get("content-encoding", "identity"),
+        "p50_ms": round(timings[len(timings) // 2] * 1e3, 2),
+        "p95_ms": round(timings[int(len(timings) * 0.95)] * 1e3, 2),
+    }
+
+
+def render_times(page: dict, calls: int) -> dict:
+    results = {}
+    start = time.perf_counter()
+    for _ in range(calls):
+        json.dumps(page, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    results["json_us"] = round((time.perf_counter() - start) / calls * 1e6, 1)
+    if orjson is not None:
+        start = time.perf_counter()
+        for _ in range(calls):
+            orjson.dumps(page)
+        results["orjson_us"] = round((time.perf_counter() - start) / calls * 1e6, 1)
+    return results
+
+
+async def run(args) -> dict:
+    await init_db()
+    auth = await seed(args.outputs)
+    results = {"outputs": args.outputs, "polls": args.polls, "endpoints": {}}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name, path in ENDPOINTS.items():
+            plain = {**auth, "Accept-Encoding": "identity"}
+            first = await client.get(path, headers=plain)
+            first.raise_for_status()
+            results["endpoints"][name] = {
+                "plain": await poll(client, path, plain, args.polls),
+                "compressed": await poll(client, path, {**auth, "Accept-Encoding": "br, gzip"}, args.polls),
+                "revalidated": await poll(
+                    client, path, {**auth, "Accept-Encoding": "br, gzip", "If-None-Match": first.headers["etag"]},
+                    args.polls,
+                ),
+            }
+            if name == "outputs_100":
+                results["render_outputs_100"] = render_times(first.json(), args.polls)
+    await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--outputs", type=int, default=200)
+    parser.add_argument("--polls", type=int, default=300)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
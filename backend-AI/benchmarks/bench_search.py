@@ -0,0 +1,152 @@
+"""
+Latency of full-text search over saved outputs at scale.
+
+Seeds --users users with --outputs-per-user outputs each. The data is
+generated inside Postgres and reused by later runs of the same size. Each
+output is --words words drawn from a skewed vocabulary (term0 is the most
+common word, term1999 the rarest). The benchmark then times
+crud.search_outputs for random users with common, mid-frequency and rare
+terms, a two-word query and a phrase. Snippet generation is included.
+
+Needs the app's DB_* variables. Seeding 1M rows takes a few minutes.
+
+Usage:
+    python benchmarks/bench_search.py --users 1000 --outputs-per-user 1000 --queries 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import crud  # noqa: E402
+from database import AsyncSessionLocal, engine, init_db  # noqa: E402
+from routes.save_routes import SNIPPET_OPTIONS  # noqa: E402
+from utils.content_store import CONTENT_PREVIEW_CHARS  # noqa: E402
+
+PREFIX = "search-bench-"
+VOCABULARY = 2000
+QUERIES = {
+    "common": "term0",
+    "mid": "term150",
+    "rare": "term1500",
+    "two_words": "term3 term40",
+    "phrase": '"term1 term2"',
+}
+
+
+async def seed(users: int, per_user: int, words: int):
+    async with engine.begin() as conn:
+        have = await conn.scalar(text(
+            "SELECT count(*) FROM saved_outputs o JOIN users u ON u.id = o.user_id WHERE u.username LIKE :p"
+        ), {"p": PREFIX + "%"})
+        if have == users * per_user:
+            return False
+        await conn.execute(text("DELETE FROM users WHERE username LIKE :p"), {"p": PREFIX + "%"})
+        await conn.execute(text(
+            "INSERT INTO users (username, email, hashed_password, is_active) "
+            "SELECT :p || g, :p || g || '@example.com', '!', true FROM generate_series(1, :n) g"
+        ), {"p": PREFIX, "n": users})
+        # power(random(), 3) skews the draw towards low term numbers. Blobs are
+        # written uncompressed ('raw'), which the app reads like any other.
+        await conn.execute(text(
+            "CREATE TEMP TABLE search_bench_texts ON COMMIT DROP AS "
+            "SELECT u.id AS user_id, g, "
+            "  (SELECT string_agg('term' || floor(power(random(), 3) * :vocab)::int, ' ') "
+            "   FROM generate_series(1, :words) WHERE g > 0) AS content "
+            "FROM users u CROSS JOIN generate_series(1, :per_user) g WHERE u.username LIKE :p"
+        ), {"p": PREFIX + "%", "per_user": per_user, "words": words, "vocab": VOCABULARY})
+        await conn.execute(text(
+            "INSERT INTO content_blobs (digest, encoding, data, size, preview) "
+            "SELECT DISTINCT ON (digest) digest, 'raw', data, octet_length(data), left(content, :preview) "
+            "FROM (SELECT content, convert_to(content, 'UTF8') AS data, "
+            "      encode(sha256(convert_to(content, 'UTF8')), 'hex') AS digest FROM search_bench_texts) t "
+            "ON CONFLICT DO NOTHING"
+        ), {"preview": CONTENT_PREVIEW_CHARS})
+        await conn.execute(text(
+            "INSERT INTO saved_outputs (user_id, template_type, content_digest, search_vector, created_at) "
+            "SELECT user_id, CASE WHEN g % 2 = 0 THEN 'blog_post' ELSE 'email_draft' END, "
+            "  encode(sha256(convert_to(content, 'UTF8')), 'hex'), to_tsvector('english', content), "
+            "  now() - random() * interval '365 days' "
+            "FROM search_bench_texts"
+        ))
+        await conn.execute(text("ANALYZE saved_outputs"))
+    return True
+
+
+async def user_ids() -> list:
+    async with engine.connect() as conn:
+        rows = await conn.execute(text("SELECT id FROM users WHERE username LIKE :p"), {"p": PREFIX + "%"})
+        return [row.id for row in rows]
+
+
+async def explain(user_id: int, query: str) -> list:
+    # Plan node names of the page query, to confirm the GIN index is used
+    async with engine.connect() as conn:
+        plan = await conn.scalar(text(
+            "EXPLAIN (ANALYZE, FORMAT JSON) SELECT id FROM saved_outputs "
+            "WHERE user_id = :u AND search_vector @@ websearch_to_tsquery('english', :q) "
+            "ORDER BY ts_rank_cd(search_vector, websearch_to_tsquery('english', :q)) DESC, id DESC LIMIT 21"
+        ), {"u": user_id, "q": query})
+    nodes = []
+
+    def walk(node):
+        nodes.append(node["Node Type"] + (f" ({node['Index Name']})" if "Index Name" in node else ""))
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan[0]["Plan"])
+    return nodes
+
+
+async def run(args) -> dict:
+    await init_db()
+    start = time.perf_counter()
+    seeded = await seed(args.users, args.outputs_per_user, args.words)
+    seed_seconds = time.perf_counter() - start
+    ids = await user_ids()
+    results = {
+        "rows": args.users * args.outputs_per_user,
+        "seeded_now": seeded,
+        "seed_seconds": round(seed_seconds, 1),
+        "queries": {},
+    }
+    for name, query in QUERIES.items():
+        timings, hits = [], 0
+        for _ in range(args.queries):
+            async with AsyncSessionLocal() as db:
+                begin = time.perf_counter()
+                rows = await crud.search_outputs(db, random.choice(ids), query, args.limit + 1, SNIPPET_OPTIONS)
+                timings.append(time.perf_counter() - begin)
+            hits += len(rows)
+        timings.sort()
+        results["queries"][name] = {
+            "q": query,
+            "avg_hits": round(hits / args.queries, 1),
+            "p50_ms": round(timings[len(timings) // 2] * 1e3, 2),
+            "p95_ms": round(timings[int(len(timings) * 0.95)] * 1e3, 2),
+            "plan": await explain(ids[0], query),
+        }
+    await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--outputs-per-user", type=int, default=1000)
+    parser.add_argument("--words", type=int, default=150)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
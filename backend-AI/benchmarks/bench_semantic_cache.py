@@ -0,0 +1,119 @@
+"""
+Lookup latency of the near-duplicate prompt index at realistic sizes.
+
+Builds a SemanticCache over synthetic prompts (a few content words from a
+shared vocabulary in one of a handful of phrasings), then times lookups for
+reworded versions of indexed prompts, for unrelated prompts and for
+unrelated prompts in Cyrillic and Japanese script. Any hit on an unrelated
+prompt is a false hit; "candidate_rate" is how often SimHash alone would
+have matched, before the content-word overlap check.
+
+Usage:
+    python benchmarks/bench_semantic_cache.py --entries 300000 --queries 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from utils.semantic_cache import SemanticCache, _features, simhash  # noqa: E402
+
+FORMATS = ["blog post about {}", "write a blog on {}", "email announcing {}", "newsletter covering {}"]
+
+
+PARTITION = ("model", "1", "blog_post")
+CYRILLIC = "абвгдежзийклмнопрстуфхцчшщыэюя"
+KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめも"
+
+
+def make_vocabulary(rng: random.Random, size: int = 20_000, letters: str = "abcdefghijklmnopqrstuvwxyz") -> list:
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(4, 10))) for _ in range(size)]
+
+
+def make_prompt(rng: random.Random, vocabulary: list) -> str:
+    words = rng.sample(vocabulary, rng.randint(3, 6))
+    return rng.choice(FORMATS).format(" and ".join(words))
+
+
+def reword(prompt: str, rng: random.Random) -> str:
+    words = prompt.split()
+    rng.shuffle(words)
+    return "please write " + " ".join(words)
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def time_lookups(cache: SemanticCache, probes: list) -> tuple:
+    async def resolve(key):
+        return key
+
+    timings, hits = [], 0
+    for details in probes:
+        t = time.perf_counter()
+        hits += await cache.lookup(PARTITION, details, resolve) is not None
+        timings.append((time.perf_counter() - t) * 1e6)
+    return timings, hits
+
+
+def run(entries: int, queries: int, threshold: float, min_overlap: float) -> dict:
+    rng = random.Random(42)
+    vocabulary = make_vocabulary(rng)
+    prompts = [make_prompt(rng, vocabulary) for _ in range(entries)]
+    # Some indexed prompts in other scripts, which used to all hash to 0
+    foreign = [make_vocabulary(rng, 2_000, CYRILLIC), make_vocabulary(rng, 2_000, KANA)]
+    prompts += [" ".join(rng.sample(words, 4)) for words in foreign for _ in range(entries // 100)]
+    cache = SemanticCache(threshold, len(prompts) + 1, min_overlap)
+    start = time.perf_counter()
+    for i, prompt in enumerate(prompts):
+        cache.add(PARTITION, prompt, i)
+    build_s = time.perf_counter() - start
+
+    results = {}
+    for name, probe in (
+        ("reworded", lambda: reword(rng.choice(prompts[:entries]), rng)),
+        ("unrelated", lambda: make_prompt(rng, vocabulary)),
+        ("unrelated_cyrillic", lambda: " ".join(rng.sample(foreign[0], 4))),
+        ("unrelated_japanese", lambda: " ".join(rng.sample(foreign[1], 4))),
+    ):
+        probes = [probe() for _ in range(queries)]
+        index = cache._indexes[PARTITION]
+        candidates = sum(index.query(simhash(p)) is not None for p in probes if _features(p))
+        timings, hits = asyncio.run(time_lookups(cache, probes))
+        results[name] = {
+            "hit_rate": round(hits / queries, 4),
+            "candidate_rate": round(candidates / queries, 4),
+            "p50_us": round(percentile(timings, 0.50), 1),
+            "p99_us": round(percentile(timings, 0.99), 1),
+        }
+
+    t = time.perf_counter()
+    for _ in range(queries):
+        simhash(make_prompt(rng, vocabulary))
+    signature_us = (time.perf_counter() - t) / queries * 1e6
+
+    return {
+        "entries": len(prompts),
+        "threshold": threshold,
+        "min_overlap": min_overlap,
+        "build_s": round(build_s, 2),
+        "signature_us": round(signature_us, 1),
+        "query": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=300_000)
+    parser.add_argument("--queries", type=int, default=2_000)
+    parser.add_argument("--threshold", type=float, default=0.88)
+    parser.add_argument("--min-overlap", type=float, default=0.75)
+    args = parser.parse_args()
+    print(json.dumps(run(args.entries, args.queries, args.threshold, args.min_overlap), indent=2))
@@ -0,0 +1,80 @@
+"""
+Import time of the app (`import main`), measured with `python -X importtime`
+in a fresh interpreter, against a budget.
+
+Exits non-zero when the median import takes longer than --budget-ms or when
+one of the lazily loaded heavy packages (LangChain, the OpenAI SDK, numpy)
+gets imported eagerly, so it can gate CI.
+
+Only the app's environment variables are needed; no database is contacted.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 5 --budget-ms 1500
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+LAZY_PACKAGES = ("langchain", "langchain_openai", "openai", "numpy")
+
+PROBE = (
+    "import sys, json, main; "
+    "print(json.dumps(sorted({m.split('.')[0] for m in sys.modules} & set(%r))))" % (LAZY_PACKAGES,)
+)
+
+
+def measure() -> tuple[float, dict, list]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=APP_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Children are listed before their parent, indented two spaces per level
+    children = {}
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative_us, name = line.split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative_us)
+        elif depth == 0:
+            if name.strip() == "main":
+                total_us = int(cumulative_us)
+                break
+            children = {}
+    return total_us / 1000, children, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=1500)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    totals = sorted(total for total, _, _ in runs)
+    median = totals[len(totals) // 2]
+    _, children, eager = runs[-1]
+    heaviest = sorted(children.items(), key=lambda item: item[1], reverse=True)[: args.top]
+    report = {
+        "runs": args.runs,
+        "import_main_ms": {"median": round(median, 1), "min": round(totals[0], 1), "max": round(totals[-1], 1)},
+        "budget_ms": args.budget_ms,
+        "heaviest_imports_of_main_ms": {name: round(us / 1000, 1) for name, us in heaviest},
+        "eagerly_imported_lazy_packages": eager,
+        "ok": median <= args.budget_ms and not eager,
+    }
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
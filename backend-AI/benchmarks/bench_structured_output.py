@@ -0,0 +1,82 @@
+"""
+How many malformed model outputs are recovered locally, and at what cost.
+
+Builds an envelope around a generated text of --words words and applies
+the defects seen from chat models: no code fence, prose around the
+object, trailing comma, raw newlines in the string, missing closing
+brace, single quotes and an unescaped quote inside the text. Each variant
+is decoded by the LangChain StructuredOutputParser (the previous
+behaviour, where any failure threw the completion away) and by
+parse_envelope. Outputs parse_envelope refuses would be re-asked.
+
+Usage:
+    OPEN_API_KEY=x python benchmarks/bench_structured_output.py --words 400 --calls 2000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from utils.openai_api import get_prompt  # noqa: E402
+from utils.structured_output import parse_envelope  # noqa: E402
+
+WORDS = "the quick brown fox jumps over a lazy dog while our team ships the new release".split()
+
+
+def variants(text: str) -> dict:
+    envelope = json.dumps({"type": "blog_post", "data": text})
+    raw_newlines = '{"type": "blog_post", "data": "%s"}' % text.replace('"', '\\"')
+    return {
+        "fenced": f"```json\n{envelope}\n```",
+        "bare": envelope,
+        "prose_around": f"Here is your post:\n```json\n{envelope}\n```\nLet me know if you want changes.",
+        "trailing_comma": envelope[:-1] + ",}",
+        "raw_newlines": raw_newlines,
+        "missing_brace": envelope[:-1],
+        "single_quotes": "{'type': 'blog_post', 'data': '%s'}" % text.replace("\n", "\\n"),
+        "unescaped_quote": raw_newlines.replace("release", '"release"', 1),
+    }
+
+
+def timed(decode, output: str, calls: int) -> tuple:
+    try:
+        decode(output)
+    except Exception:
+        return False, None
+    start = time.perf_counter()
+    for _ in range(calls):
+        decode(output)
+    return True, round((time.perf_counter() - start) / calls * 1e6, 1)
+
+
+def run(args) -> dict:
+    random.seed(0)
+    paragraphs = [" ".join(random.choices(WORDS, k=args.words // 4)) for _ in range(4)]
+    text = "\n\n".join(paragraphs) + " release"
+    parser, _ = get_prompt()
+    results = {"text_chars": len(text), "variants": {}}
+    for name, output in variants(text).items():
+        langchain_ok, langchain_us = timed(parser.parse, output, args.calls)
+        local_ok, local_us = timed(parse_envelope, output, args.calls)
+        outcome = parse_envelope(output)[1] if local_ok else "reask"
+        results["variants"][name] = {
+            "langchain": {"ok": langchain_ok, "per_call_us": langchain_us},
+            "parse_envelope": {"ok": local_ok, "outcome": outcome, "per_call_us": local_us},
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--words", type=int, default=400)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
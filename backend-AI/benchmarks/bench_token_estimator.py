@@ -0,0 +1,67 @@
+"""
+Cost of the offline pre-flight prompt token estimate, per request.
+
+If tiktoken can load its encoding (it downloads it on first use), the
+estimate is also compared against the exact token count.
+
+Usage:
+    OPEN_API_KEY=x python benchmarks/bench_token_estimator.py --calls 20000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from utils.openai_api import estimate_prompt_tokens, get_prompt  # noqa: E402
+from utils.tokens import MESSAGE_OVERHEAD_TOKENS  # noqa: E402
+
+SAMPLE = (
+    "Announce our new remote-first hiring policy to the engineering team. Mention the "
+    "home-office stipend of $1,200, the quarterly on-site weeks in Lisbon and that "
+    "interviews now run fully asynchronously. Keep it upbeat, around 300 words. "
+)
+
+
+def exact_counter():
+    try:
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    except Exception:
+        return None
+    return lambda text: len(encoding.encode(text)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def run(calls: int) -> dict:
+    exact = exact_counter()
+    results = {"calls": calls, "sizes": []}
+    # The prompt template is built on first use; keep that out of the timings
+    estimate_prompt_tokens("blog_post", "")
+    for chars in (100, 1_000, 10_000):
+        details = (SAMPLE * (chars // len(SAMPLE) + 1))[:chars]
+        start = time.perf_counter()
+        for _ in range(calls):
+            estimate = estimate_prompt_tokens("blog_post", details)
+        elapsed = time.perf_counter() - start
+        row = {"details_chars": chars, "estimate": estimate, "per_call_us": round(elapsed / calls * 1e6, 2)}
+        if exact is not None:
+            _, prompt_template = get_prompt()
+            actual = exact(prompt_template.format(template_type="blog_post", details=details))
+            row["exact"] = actual
+            row["error_pct"] = round((estimate - actual) / actual * 100, 1)
+        results["sizes"].append(row)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.calls), indent=2))
+
+
+if __name__ == "__main__":
+    main()
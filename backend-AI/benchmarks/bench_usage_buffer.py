@@ -0,0 +1,127 @@
+"""
+Quota-charge throughput: per-request UPSERT+commit vs the write-behind
+usage buffer.
+
+Both modes run `--charges` generations spread over `--users` hot users
+from `--concurrency` concurrent coroutines. Each one charges a hold the
+size a text generation takes (prompt plus MAX_COMPLETION_TOKENS) and then
+refunds what the completion did not use, as settle_quota does. The buffer
+runs with the app's USAGE_MAX_PENDING_TOKENS, so forced and direct
+charges show up in the flush counts. Needs the app's DB_* environment
+variables; test users are created on first run.
+
+Usage:
+    python benchmarks/bench_usage_buffer.py --charges 5000 --users 20 --concurrency 50 --used 450
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from sqlalchemy import delete  # noqa: E402
+
+import crud  # noqa: E402
+from database import AsyncSessionLocal, engine, init_db  # noqa: E402
+from models import UserToken  # noqa: E402
+from settings import MAX_COMPLETION_TOKENS  # noqa: E402
+from utils.usage_buffer import USAGE_MAX_PENDING_TOKENS, UsageBuffer  # noqa: E402
+
+LIMIT = 2**31 - 1
+
+
+async def ensure_users(count: int) -> list:
+    ids = []
+    async with AsyncSessionLocal() as db:
+        for i in range(count):
+            email = f"usage-bench-{i}@example.com"
+            user = await crud.get_user_by_email(db, email)
+            if user is None:
+                user = await crud.create_user(db, email=email, username=f"usage-bench-{i}", password="!")
+            ids.append(user.id)
+        await db.execute(delete(UserToken).where(UserToken.user_id.in_(ids)))
+        await db.commit()
+    return ids
+
+
+async def drive(charges: int, concurrency: int, user_ids: list, reserve) -> float:
+    queue = asyncio.Queue()
+    for i in range(charges):
+        queue.put_nowait(user_ids[i % len(user_ids)])
+
+    async def worker():
+        while not queue.empty():
+            await reserve(queue.get_nowait())
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+async def total_used(user_ids: list) -> int:
+    async with AsyncSessionLocal() as db:
+        return sum([(await crud.get_token_usage(db, uid) or (0,))[0] for uid in user_ids])
+
+
+async def run(args) -> dict:
+    await init_db()
+    today = date.today()
+    hold = args.prompt_tokens + MAX_COMPLETION_TOKENS
+    unused = hold - args.prompt_tokens - args.used
+    user_ids = await ensure_users(args.users)
+
+    async def direct(user_id):
+        async with AsyncSessionLocal() as db:
+            await crud.reserve_tokens(db, user_id, hold, LIMIT)
+        async with AsyncSessionLocal() as db:
+            await crud.refund_tokens(db, user_id, unused, today)
+
+    direct_s = await drive(args.charges, args.concurrency, user_ids, direct)
+    direct_total = await total_used(user_ids)
+
+    user_ids = await ensure_users(args.users)
+    buffer = UsageBuffer(
+        flush_interval=0.5, flush_max_users=500, max_pending=USAGE_MAX_PENDING_TOKENS, idle_seconds=600,
+    )
+
+    async def buffered(user_id):
+        await buffer.reserve(user_id, hold, LIMIT)
+        await buffer.refund(user_id, unused, today)
+
+    buffer.start()
+    buffered_s = await drive(args.charges, args.concurrency, user_ids, buffered)
+    await buffer.close()
+    buffered_total = await total_used(user_ids)
+    await engine.dispose()
+
+    return {
+        "charges": args.charges,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "hold_tokens": hold,
+        "max_pending": USAGE_MAX_PENDING_TOKENS,
+        "per_request_commit": {"seconds": round(direct_s, 3), "charges_per_s": round(args.charges / direct_s)},
+        "write_behind": {
+            "seconds": round(buffered_s, 3),
+            "charges_per_s": round(args.charges / buffered_s),
+            "flushes": buffer.stats["flushes"],
+            "forced_flushes": buffer.stats["forced_flushes"],
+            "direct_charges": buffer.stats["direct"],
+        },
+        "totals_match": direct_total == buffered_total == args.charges * (args.prompt_tokens + args.used),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--charges", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--prompt-tokens", type=int, default=150)
+    parser.add_argument("--used", type=int, default=450, help="completion tokens each generation really uses")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
@@ -0,0 +1,203 @@
+"""
+Local stand-in for the OpenAI endpoints the app uses, for load tests that
+must not spend real credits.
+
+Implements POST /v1/chat/completions (plain and streamed, with usage) and
+POST /v1/images/generations (b64_json). Replies are shaped like the real
+API, so ChatOpenAI and AsyncOpenAI work against it unchanged when the app
+runs with OPENAI_BASE_URL=http://<host>:<port>/v1.
+
+Latency, streaming speed and errors are configurable. --tail-rate sends a
+fraction of calls into a slow tail, e.g. to exercise hedged requests.
+Injected 429/500s are retried by the OpenAI SDK (twice by default) before
+the app sees them.
+
+Usage:
+    python benchmarks/fake_openai.py --port 9100 --latency 0.5 --jitter 0.2 \\
+        --error-rate 0.01 --completion-words 200
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# A valid 8x8 grey PNG, big enough for the thumbnail endpoint to resize
+PNG_8X8 = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAgAAAAICAAAAADhZOFXAAAAEUlEQVR4nGNoaGhgwA+GrAQAq2YQAfD8d9kAAAAASUVORK5CYII="
+)
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt".split()
+
+
+class FakeConfig:
+    latency = 0.5
+    jitter = 0.0
+    chunk_delay = 0.01
+    error_rate = 0.0
+    rate_limit_rate = 0.0
+    completion_words = 200
+    image_latency = 2.0
+    tail_rate = 0.0
+    tail_latency = 10.0
+
+
+config = FakeConfig()
+stats = {"chat": 0, "chat_stream": 0, "images": 0, "errors": 0, "tail": 0}
+app = FastAPI()
+
+
+def injected_error():
+    roll = random.random()
+    if roll < config.rate_limit_rate:
+        stats["errors"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (injected)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+        )
+    if roll < config.rate_limit_rate + config.error_rate:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"message": "Injected failure", "type": "server_error"}}, status_code=500)
+    return None
+
+
+async def think(base: float):
+    if random.random() < config.tail_rate:
+        stats["tail"] += 1
+        base = config.tail_latency
+    await asyncio.sleep(max(0.0, base + random.uniform(-config.jitter, config.jitter)))
+
+
+def completion_words(max_tokens: int | None) -> tuple[list, str]:
+    words = [random.choice(WORDS) for _ in range(config.completion_words)]
+    # Roughly one token per word plus the envelope around it
+    if max_tokens is not None and max_tokens < len(words) + 20:
+        return words[: max(0, max_tokens - 20)], "length"
+    return words, "stop"
+
+
+def envelope(words: list, truncated: bool) -> str:
+    text = json.dumps({"type": "blog_post", "data": " ".join(words)})
+    if truncated:
+        text = text[:-2]
+    return f"```json\n{text}\n```"
+
+
+def prompt_tokens(body: dict) -> int:
+    return sum(len(str(m.get("content", "")).split()) for m in body.get("messages", [])) + 7
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    error = injected_error()
+    if error is not None:
+        return error
+    words, finish_reason = completion_words(body.get("max_tokens") or body.get("max_completion_tokens"))
+    content = envelope(words, finish_reason == "length")
+    usage = {
+        "prompt_tokens": prompt_tokens(body),
+        "completion_tokens": len(words) + 20,
+        "total_tokens": prompt_tokens(body) + len(words) + 20,
+    }
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = body.get("model", "gpt-3.5-turbo")
+
+    if not body.get("stream"):
+        stats["chat"] += 1
+        await think(config.latency)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}
+            ],
+            "usage": usage,
+        }
+
+    stats["chat_stream"] += 1
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    def chunk(delta: dict, finish: str | None = None, **extra) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            **extra,
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    async def events():
+        # Time to first token, then a steady trickle of small chunks
+        await think(config.latency)
+        yield chunk({"role": "assistant", "content": ""})
+        for i in range(0, len(content), 16):
+            yield chunk({"content": content[i:i + 16]})
+            if config.chunk_delay:
+                await asyncio.sleep(config.chunk_delay)
+        yield chunk({}, finish_reason)
+        if include_usage:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            yield f"data: {json.dumps(payload)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/images/generations")
+async def images_generations(request: Request):
+    await request.json()
+    error = injected_error()
+    if error is not None:
+        return error
+    stats["images"] += 1
+    await think(config.image_latency)
+    return {"created": int(time.time()), "data": [{"b64_json": base64.b64encode(PNG_8X8).decode("ascii")}]}
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=FakeConfig.latency, help="seconds to (first) token")
+    parser.add_argument("--jitter", type=float, default=FakeConfig.jitter, help="+/- seconds added to latencies")
+    parser.add_argument("--chunk-delay", type=float, default=FakeConfig.chunk_delay, help="seconds between stream chunks")
+    parser.add_argument("--error-rate", type=float, default=FakeConfig.error_rate, help="fraction of 500 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=FakeConfig.rate_limit_rate, help="fraction of 429s")
+    parser.add_argument("--completion-words", type=int, default=FakeConfig.completion_words)
+    parser.add_argument("--image-latency", type=float, default=FakeConfig.image_latency)
+    parser.add_argument("--tail-rate", type=float, default=FakeConfig.tail_rate, help="fraction of slow calls")
+    parser.add_argument("--tail-latency", type=float, default=FakeConfig.tail_latency, help="latency of slow calls")
+    args = parser.parse_args()
+    for name in ("latency", "jitter", "chunk_delay", "error_rate", "rate_limit_rate", "completion_words", "image_latency",
+                 "tail_rate", "tail_latency"):
+        setattr(config, name, getattr(args, name))
+
+    import uvicorn
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
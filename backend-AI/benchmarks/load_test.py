@@ -0,0 +1,323 @@
+"""
+HTTP load test of the main user flows, reporting RPS and latency
+percentiles per operation as JSON.
+
+Phases:
+1. Register and log in --users users (measured as `register` and `login`).
+2. Run --requests operations from --concurrency workers. Each worker picks
+   an operation by the --mix weights: generate (generate-template), stream
+   (generate-template/stream), image (generate-image-template), image_job
+   (POST image-jobs, then long-poll until the job finishes), save
+   (save-output) and profile.
+
+Target either an app that is already running (--base-url), or pass --spawn
+to start benchmarks/fake_openai.py and the app with uvicorn on free ports.
+Spawning points the app at the fake server and raises FREE_TOKEN_LIMIT so
+quota does not cap the run. Spawning needs the app's DB_* variables.
+Prompts are unique per request unless --repeat-ratio is set, so the
+generation cache only helps where asked to.
+
+The JSON result includes the git commit and the arguments, so runs can be
+diffed across commits.
+
+Usage:
+    python benchmarks/load_test.py --spawn --users 20 --requests 2000 --concurrency 50 \\
+        --fake-latency 0.5 --output results.json
+    python benchmarks/load_test.py --base-url http://127.0.0.1:8000 --mix generate=1,profile=1
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, "..", "app")
+OPERATIONS = ("generate", "stream", "image", "image_job", "save", "profile")
+DEFAULT_MIX = "generate=4,stream=2,image=1,save=3,profile=2"
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+class Recorder:
+    def __init__(self):
+        self.timings: dict = {}
+        self.statuses: dict = {}
+
+    def record(self, operation: str, seconds: float, status: int):
+        self.timings.setdefault(operation, []).append(seconds)
+        counts = self.statuses.setdefault(operation, {})
+        counts[status] = counts.get(status, 0) + 1
+
+    def summary(self, elapsed: float) -> dict:
+        report = {}
+        for operation, timings in self.timings.items():
+            statuses = self.statuses[operation]
+            report[operation] = {
+                "count": len(timings),
+                "ok": sum(n for status, n in statuses.items() if 200 <= status < 300),
+                "statuses": {str(status): n for status, n in sorted(statuses.items())},
+                "rps": round(len(timings) / elapsed, 2),
+                "mean_ms": round(sum(timings) / len(timings) * 1e3, 2),
+                "p50_ms": round(percentile(timings, 0.50) * 1e3, 2),
+                "p95_ms": round(percentile(timings, 0.95) * 1e3, 2),
+                "p99_ms": round(percentile(timings, 0.99) * 1e3, 2),
+            }
+        return report
+
+
+async def timed(recorder: Recorder, operation: str, request) -> httpx.Response | None:
+    start = time.perf_counter()
+    try:
+        response = await request
+        status = response.status_code
+    except httpx.HTTPError:
+        response, status = None, 0  # connection errors and timeouts
+    recorder.record(operation, time.perf_counter() - start, status)
+    return response
+
+
+async def stream_request(client: httpx.AsyncClient, headers: dict, body: dict) -> httpx.Response:
+    # Measures until the whole event stream has been read
+    async with client.stream("POST", "/generate/generate-template/stream", json=body, headers=headers) as response:
+        async for _ in response.aiter_raw():
+            pass
+    return response
+
+
+async def image_job_request(client: httpx.AsyncClient, headers: dict, body: dict) -> httpx.Response:
+    # Measures from submission until the job has finished
+    response = await client.post("/generate/image-jobs", json=body, headers=headers)
+    while response.status_code in (200, 202) and response.json()["status"] not in ("succeeded", "failed"):
+        response = await client.get(response.json()["status_url"], params={"wait": 30}, headers=headers)
+    if response.status_code == 200 and response.json()["status"] == "failed":
+        response.status_code = 502  # reported as a failed operation
+    return response
+
+
+async def setup_users(client: httpx.AsyncClient, recorder: Recorder, users: int, concurrency: int) -> list:
+    run_id = uuid.uuid4().hex[:8]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        credentials = {"email": f"load-{run_id}-{i}@example.com", "username": f"load-{run_id}-{i}", "password": "load-test"}
+        async with semaphore:
+            await timed(recorder, "register", client.post("/auth/register", json=credentials))
+            response = await timed(
+                recorder,
+                "login",
+                client.post("/auth/login", json={"email": credentials["email"], "password": credentials["password"]}),
+            )
+        if response is None or response.status_code != 200:
+            return None
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    headers = await asyncio.gather(*(one(i) for i in range(users)))
+    return [h for h in headers if h is not None]
+
+
+def prompt(repeat_ratio: float) -> str:
+    if random.random() < repeat_ratio:
+        return f"A short post about topic {random.randint(0, 9)}"
+    return f"A short post about {uuid.uuid4().hex}"
+
+
+async def run_mix(client, recorder, users: list, requests: int, concurrency: int, mix: dict, repeat_ratio: float):
+    operations, weights = zip(*mix.items())
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            operation = random.choices(operations, weights)[0]
+            headers = random.choice(users)
+            if operation == "generate":
+                body = {"template_type": "blog_post", "details": prompt(repeat_ratio)}
+                await timed(recorder, operation, client.post("/generate/generate-template", json=body, headers=headers))
+            elif operation == "stream":
+                body = {"template_type": "email_draft", "details": prompt(repeat_ratio)}
+                await timed(recorder, operation, stream_request(client, headers, body))
+            elif operation == "image":
+                body = {"prompt": prompt(repeat_ratio), "style": "art"}
+                await timed(recorder, operation, client.post("/generate/generate-image-template", json=body, headers=headers))
+            elif operation == "image_job":
+                body = {"prompt": prompt(repeat_ratio), "style": "art"}
+                await timed(recorder, operation, image_job_request(client, headers, body))
+            elif operation == "save":
+                body = {"template_type": "blog_post", "content": "Saved by the load test. " * 40}
+                await timed(recorder, operation, client.post("/save/save-output", json=body, headers=headers))
+            else:
+                await timed(recorder, operation, client.get("/auth/profile", headers=headers))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+@contextmanager
+def spawned(args):
+    fake_port, app_port = free_port(), free_port()
+    image_dir = tempfile.TemporaryDirectory(prefix="load-test-images-")
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(HERE, "fake_openai.py"),
+        "--port", str(fake_port),
+        "--latency", str(args.fake_latency),
+        "--jitter", str(args.fake_jitter),
+        "--chunk-delay", str(args.fake_chunk_delay),
+        "--error-rate", str(args.fake_error_rate),
+        "--image-latency", str(args.fake_image_latency),
+    ])
+    env = {
+        **os.environ,
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "OPEN_API_KEY": os.environ.get("OPEN_API_KEY", "sk-fake"),
+        "FREE_TOKEN_LIMIT": os.environ.get("FREE_TOKEN_LIMIT", "2000000000"),
+        # Every simulated user comes from 127.0.0.1
+        "RATE_LIMIT_ENABLED": os.environ.get("RATE_LIMIT_ENABLED", "false"),
+        "IMAGE_STORE_DIR": image_dir.name,
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=APP_DIR,
+        env=env,
+    )
+    try:
+        wait_ready(f"http://127.0.0.1:{fake_port}/stats")
+        wait_ready(f"http://127.0.0.1:{app_port}/openapi.json")
+        yield f"http://127.0.0.1:{app_port}"
+    finally:
+        for process in (server, fake):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        image_dir.cleanup()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(base_url: str, args) -> dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        users = await setup_users(client, recorder, args.users, args.concurrency)
+        setup_elapsed = time.perf_counter() - start
+        if not users:
+            raise RuntimeError("no user could log in; is the app reachable and the database up?")
+        setup = recorder.summary(setup_elapsed)
+
+        recorder = Recorder()
+        start = time.perf_counter()
+        await run_mix(client, recorder, users, args.requests, args.concurrency, args.mix, args.repeat_ratio)
+        elapsed = time.perf_counter() - start
+    results = recorder.summary(elapsed)
+    all_timings = [t for timings in recorder.timings.values() for t in timings]
+    return {
+        "meta": {
+            "git_commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "base_url": base_url,
+            "args": {k: v for k, v in vars(args).items() if k != "output"},
+        },
+        "setup": setup,
+        "results": results,
+        "total": {
+            "requests": len(all_timings),
+            "elapsed_s": round(elapsed, 3),
+            "rps": round(len(all_timings) / elapsed, 2),
+            "p50_ms": round(percentile(all_timings, 0.50) * 1e3, 2),
+            "p95_ms": round(percentile(all_timings, 0.95) * 1e3, 2),
+            "p99_ms": round(percentile(all_timings, 0.99) * 1e3, 2),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--base-url", help="URL of an already running app")
+    target.add_argument("--spawn", action="store_true", help="start the fake OpenAI server and the app")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"default {DEFAULT_MIX}")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="fraction of prompts drawn from 10 repeats")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers with --spawn")
+    parser.add_argument("--fake-latency", type=float, default=0.5)
+    parser.add_argument("--fake-jitter", type=float, default=0.1)
+    parser.add_argument("--fake-chunk-delay", type=float, default=0.01)
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--fake-image-latency", type=float, default=2.0)
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.spawn:
+        with spawned(args) as base_url:
+            result = asyncio.run(run(base_url, args))
+    else:
+        result = asyncio.run(run(args.base_url, args))
+
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
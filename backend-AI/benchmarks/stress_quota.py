@@ -0,0 +1,148 @@
+"""
+Fires concurrent text generations for one user through the generate route
+and checks the daily limit is never overshot.
+
+`--requests` POST /generate/generate-template calls go out at once, first
+with quota charged straight in Postgres and then through the write-behind
+UsageBuffer. A stub LLM stands in for OpenAI: it bills the estimated prompt
+plus `--completion-tokens` (cut off at the request's max_tokens), so the
+user's final daily total must equal what the stub billed and stay within
+FREE_TOKEN_LIMIT. The app runs in-process over httpx's ASGI transport with
+rate limiting and the generation cache turned off.
+
+Needs the same DB_* environment variables as the app plus
+SECRET_KEY/ALGORITHM, and creates the tables if missing. The test user's
+quota row is reset before each mode.
+
+Usage:
+    python benchmarks/stress_quota.py --requests 100 --completion-tokens 400 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from collections import Counter
+
+import httpx
+
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("GENERATION_CACHE_BACKEND", "off")
+os.environ.setdefault("OPEN_API_KEY", "sk-benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from sqlalchemy import delete  # noqa: E402
+
+import crud  # noqa: E402
+from database import AsyncSessionLocal, engine, init_db  # noqa: E402
+from main import app  # noqa: E402
+from models import UserToken  # noqa: E402
+from routes import generate_routes  # noqa: E402
+from utils import openai_api  # noqa: E402
+from utils.auth import create_access_token  # noqa: E402
+from utils.tokens import MESSAGE_OVERHEAD_TOKENS, estimate_tokens  # noqa: E402
+from utils.usage_buffer import (  # noqa: E402
+    USAGE_FLUSH_INTERVAL_SECONDS,
+    USAGE_FLUSH_MAX_USERS,
+    USAGE_IDLE_SECONDS,
+    USAGE_MAX_PENDING_TOKENS,
+    UsageBuffer,
+)
+
+STRESS_EMAIL = "quota-stress@example.com"
+
+
+class StubMessage:
+    def __init__(self, content: str, usage: dict, finish_reason: str):
+        self.content = content
+        self.usage_metadata = usage
+        self.response_metadata = {"finish_reason": finish_reason}
+
+
+class StubLLM:
+    def __init__(self, latency: float, completion_tokens: int):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.billed = 0
+
+    async def ainvoke(self, prompt, max_tokens=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        output = self.completion_tokens if max_tokens is None else min(self.completion_tokens, max_tokens)
+        usage = {"input_tokens": estimate_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS, "output_tokens": output}
+        self.billed += usage["input_tokens"] + usage["output_tokens"]
+        finish_reason = "length" if output < self.completion_tokens else "stop"
+        return StubMessage('```json\n{"type": "blog_post", "data": "stub content"}\n```', usage, finish_reason)
+
+
+async def reset_user() -> int:
+    async with AsyncSessionLocal() as db:
+        user = await crud.get_user_by_email(db, STRESS_EMAIL)
+        if user is None:
+            user = await crud.create_user(db, email=STRESS_EMAIL, username="quota-stress", password="!")
+        await db.execute(delete(UserToken).where(UserToken.user_id == user.id))
+        await db.commit()
+    return user.id
+
+
+async def stress(requests: int, buffered: bool, llm: StubLLM) -> dict:
+    user_id = await reset_user()
+    llm.billed = 0
+    buffer = None
+    if buffered:
+        buffer = UsageBuffer(
+            USAGE_FLUSH_INTERVAL_SECONDS, USAGE_FLUSH_MAX_USERS, USAGE_MAX_PENDING_TOKENS, USAGE_IDLE_SECONDS
+        )
+        buffer.start()
+    generate_routes.usage_buffer = buffer
+
+    headers = {"Authorization": "Bearer " + create_access_token({"sub": STRESS_EMAIL})}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://stress", timeout=None) as client:
+        responses = await asyncio.gather(*(
+            client.post(
+                "/generate/generate-template",
+                json={"template_type": "blog_post", "details": f"quota stress {i}"},
+                headers=headers,
+            )
+            for i in range(requests)
+        ))
+    if buffer is not None:
+        await buffer.close()
+    generate_routes.usage_buffer = None
+
+    async with AsyncSessionLocal() as db:
+        usage = await crud.get_token_usage(db, user_id)
+    total = usage[0] if usage is not None else 0
+    report = {
+        "statuses": dict(Counter(r.status_code for r in responses)),
+        "billed_upstream": llm.billed,
+        "final_tokens_used": total,
+        "overshot": total > generate_routes.FREE_TOKEN_LIMIT,
+    }
+    assert not report["overshot"], report
+    assert total == llm.billed, report
+    return report
+
+
+async def run(args) -> dict:
+    await init_db()
+    llm = StubLLM(args.latency, args.completion_tokens)
+    openai_api.llm = llm
+    report = {
+        "requests": args.requests,
+        "limit": generate_routes.FREE_TOKEN_LIMIT,
+        "completion_tokens": args.completion_tokens,
+        "direct": await stress(args.requests, False, llm),
+        "usage_buffer": await stress(args.requests, True, llm),
+    }
+    await engine.dispose()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--completion-tokens", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
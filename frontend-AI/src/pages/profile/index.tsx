@@ -1,26 +1,46 @@
 import Link from 'next/link';
 import React, { useEffect, useState } from 'react';
 
-import { fetchProfileData } from '@/utils/api';
-
-interface SavedOutput {
-  id: number;
-  template_type: string;
-  content: string;
-  created_at: string;
-}
+import type { SavedOutputPreview } from '@/utils/api';
+import {
+  fetchProfileData,
+  fetchSavedOutput,
+  fetchSavedOutputs,
+} from '@/utils/api';
 
 interface Profile {
   username: string;
   email: string;
   tokens_used: number;
-  saved_outputs: SavedOutput[];
+  saved_outputs_count: number;
+  saved_outputs_by_type: Record<string, number>;
 }
 
 export default function ProfilePage() {
   const [profile, setProfile] = useState<Profile | null>(null);
+  const [outputs, setOutputs] = useState<SavedOutputPreview[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [fullContent, setFullContent] = useState<Record<number, string>>({});
   const [error, setError] = useState('');
 
+  const loadOutputs = (token: string, cursor: string | null) =>
+    fetchSavedOutputs(token, cursor)
+      .then((page) => {
+        setOutputs((prev) => (cursor ? [...prev, ...page.items] : page.items));
+        setNextCursor(page.next_cursor);
+      })
+      .catch((err) => setError(err.message));
+
+  const showFull = (id: number) => {
+    const token = localStorage.getItem('access_token');
+    if (!token) return;
+    fetchSavedOutput(token, id)
+      .then((output) =>
+        setFullContent((prev) => ({ ...prev, [id]: output.content })),
+      )
+      .catch((err) => setError(err.message));
+  };
+
   useEffect(() => {
     const token = localStorage.getItem('access_token');
     if (!token) {
@@ -31,6 +51,7 @@ export default function ProfilePage() {
     fetchProfileData(token)
       .then((data) => setProfile(data))
       .catch((err) => setError(err.message));
+    loadOutputs(token, null);
   }, []);
 
   if (error) return <div className="p-4 text-red-400">{error}</div>;
@@ -65,12 +86,14 @@ export default function ProfilePage() {
           </div>
         </div>
 
-        <h2 className="mb-5 text-3xl font-semibold">Saved Outputs</h2>
-        {profile.saved_outputs.length === 0 ? (
+        <h2 className="mb-5 text-3xl font-semibold">
+          Saved Outputs ({profile.saved_outputs_count})
+        </h2>
+        {outputs.length === 0 ? (
           <p className="text-indigo-200">No saved outputs yet.</p>
         ) : (
           <div className="grid grid-cols-1 gap-6 md:grid-cols-2">
-            {profile.saved_outputs.map((output) => (
+            {outputs.map((output) => (
               <div
                 key={output.id}
                 className="rounded-md bg-indigo-500/50  p-5 shadow-md transition-shadow duration-300 hover:shadow-xl"
@@ -79,8 +102,17 @@ export default function ProfilePage() {
                   {output.template_type.replace(/_/g, ' ')}
                 </h3>
                 <p className="mb-3 whitespace-pre-wrap text-sm">
-                  {output.content}
+                  {fullContent[output.id] ?? output.preview}
                 </p>
+                {output.truncated && fullContent[output.id] === undefined && (
+                  <button
+                    type="button"
+                    className="mb-2 block text-sm font-semibold text-indigo-200 hover:underline"
+                    onClick={() => showFull(output.id)}
+                  >
+                    Show full
+                  </button>
+                )}
                 <small className="text-indigo-300">
                   Created: {new Date(output.created_at).toLocaleString()}
                 </small>
@@ -88,6 +120,20 @@ export default function ProfilePage() {
             ))}
           </div>
         )}
+        {nextCursor && (
+          <div className="mt-6 flex justify-center">
+            <button
+              type="button"
+              className="rounded-md bg-indigo-500 px-4 py-2 font-semibold hover:bg-indigo-400"
+              onClick={() => {
+                const token = localStorage.getItem('access_token');
+                if (token) loadOutputs(token, nextCursor);
+              }}
+            >
+              Load more
+            </button>
+          </div>
+        )}
       </div>
     </div>
   );
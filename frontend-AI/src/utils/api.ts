@@ -92,6 +92,61 @@ export async function fetchProfileData(token?: string) {
   return data;
 }
 
+export interface SavedOutputPreview {
+  id: number;
+  template_type: string;
+  preview: string;
+  content_bytes: number;
+  truncated: boolean;
+  created_at: string;
+}
+
+export interface SavedOutputPage {
+  items: SavedOutputPreview[];
+  next_cursor: string | null;
+}
+
+/**
+ * Fetches one page of the user's saved outputs, newest first.
+ *
+ * @param token - The user's JWT access token for authentication.
+ * @param cursor - The `next_cursor` of the previous page, if any.
+ * @returns A page of output previews and the cursor of the next page.
+ */
+export async function fetchSavedOutputs(
+  token: string,
+  cursor?: string | null,
+): Promise<SavedOutputPage> {
+  const params = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+  const res = await fetch(`${AppConfig.apiUrl}/save/outputs${params}`, {
+    headers: { Authorization: `Bearer ${token}` },
+  });
+
+  if (!res.ok) {
+    const error = await res.json().catch(() => ({}));
+    throw new Error(error.detail || 'Failed to fetch saved outputs');
+  }
+  return res.json();
+}
+
+/**
+ * Fetches the full content of one saved output.
+ */
+export async function fetchSavedOutput(
+  token: string,
+  id: number,
+): Promise<{ id: number; template_type: string; content: string; created_at: string }> {
+  const res = await fetch(`${AppConfig.apiUrl}/save/outputs/${id}`, {
+    headers: { Authorization: `Bearer ${token}` },
+  });
+
+  if (!res.ok) {
+    const error = await res.json().catch(() => ({}));
+    throw new Error(error.detail || 'Failed to fetch saved output');
+  }
+  return res.json();
+}
+
 // SaveOutputRequest interface defines the expected structure for saving generated content.
 // - template_type: Specifies the type of content ("blog_post", "email_draft", or "image").
 // - content: The actual content to be saved.